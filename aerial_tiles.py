@@ -0,0 +1,160 @@
+"""
+Browserless engine for the historical aerial photos.
+
+Instead of screenshotting the visor after clicking each year, request each
+year's orthophoto straight from the IDEIB WMS: the view around the parcel
+is split into tiles, every tile of every year is fetched concurrently over
+the pooled HTTP session, and each year's tiles are mosaicked with Pillow,
+optionally with the parcel outline drawn on top, and saved with the
+capture module's format and size settings. The WMS URL and layer are
+templates on {year} so the engine can run against a local stand-in.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import capture
+import parcel_resolver
+from http_client import session, HTTP_TIMEOUT, HTTP_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+AERIAL_WMS_URL = os.environ.get(
+    'AERIAL_WMS_URL',
+    'https://ideib.caib.es/geoserveis/services/imatges/GOIB_Ortofoto_{year}_IB/MapServer/WMSServer')
+AERIAL_WMS_LAYER = os.environ.get('AERIAL_WMS_LAYER', '0')
+# Same size as the browser viewport, so both engines produce comparable images
+AERIAL_IMAGE_WIDTH = int(os.environ.get('AERIAL_IMAGE_WIDTH', 1280))
+AERIAL_IMAGE_HEIGHT = int(os.environ.get('AERIAL_IMAGE_HEIGHT', 800))
+AERIAL_TILE_SIZE = int(os.environ.get('AERIAL_TILE_SIZE', 512))
+AERIAL_PARCEL_BUFFER = float(os.environ.get('AERIAL_PARCEL_BUFFER', 60))  # metres around the parcel
+AERIAL_FETCH_WORKERS = int(os.environ.get('AERIAL_FETCH_WORKERS', HTTP_POOL_SIZE))
+AERIAL_OUTLINE = os.environ.get('AERIAL_OUTLINE', '1') != '0'
+
+OUTLINE_COLOUR = (255, 40, 40)
+OUTLINE_WIDTH = 3
+
+
+def settings():
+    """Everything that shapes the fetched images, e.g. for cache keys"""
+    return {
+        'wms_layer': AERIAL_WMS_LAYER,
+        'image_size': [AERIAL_IMAGE_WIDTH, AERIAL_IMAGE_HEIGHT],
+        'parcel_buffer': AERIAL_PARCEL_BUFFER,
+        'outline': AERIAL_OUTLINE,
+    }
+
+
+class AerialTilesError(Exception):
+    """Raised when the WMS does not answer a tile with an image"""
+
+
+def view_extent(parcel, width=AERIAL_IMAGE_WIDTH, height=AERIAL_IMAGE_HEIGHT, buffer=AERIAL_PARCEL_BUFFER):
+    """The parcel's bounding box plus buffer, widened to the image's aspect ratio"""
+    centre_x = (parcel.xmin + parcel.xmax) / 2
+    centre_y = (parcel.ymin + parcel.ymax) / 2
+    half_width = (parcel.xmax - parcel.xmin) / 2 + buffer
+    half_height = (parcel.ymax - parcel.ymin) / 2 + buffer
+    if half_width / half_height < width / height:
+        half_width = half_height * width / height
+    else:
+        half_height = half_width * height / width
+    return (centre_x - half_width, centre_y - half_height, centre_x + half_width, centre_y + half_height)
+
+
+def tile_grid(extent, width=AERIAL_IMAGE_WIDTH, height=AERIAL_IMAGE_HEIGHT, tile_size=AERIAL_TILE_SIZE):
+    """(left, top, tile width, tile height, tile extent) for every tile of the image"""
+    xmin, ymin, xmax, ymax = extent
+    x_per_pixel = (xmax - xmin) / width
+    y_per_pixel = (ymax - ymin) / height
+    tiles = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            tile_width = min(tile_size, width - left)
+            tile_height = min(tile_size, height - top)
+            tiles.append((left, top, tile_width, tile_height, (
+                xmin + left * x_per_pixel, ymax - (top + tile_height) * y_per_pixel,
+                xmin + (left + tile_width) * x_per_pixel, ymax - top * y_per_pixel)))
+    return tiles
+
+
+def fetch_tile(year, extent, width, height, wkid=parcel_resolver.SPATIAL_REFERENCE):
+    """One WMS GetMap image of the year's orthophoto"""
+    response = session.get(AERIAL_WMS_URL.format(year=year), params={
+        'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetMap',
+        'LAYERS': AERIAL_WMS_LAYER.format(year=year), 'STYLES': '',
+        'CRS': f'EPSG:{wkid}', 'BBOX': ','.join(f'{value:.3f}' for value in extent),
+        'WIDTH': width, 'HEIGHT': height, 'FORMAT': 'image/png',
+    }, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    if not response.headers.get('Content-Type', '').startswith('image/'):
+        # WMS errors come back as XML with a 200 status
+        raise AerialTilesError(f"WMS answered {year} with {response.text[:200]}")
+    return Image.open(BytesIO(response.content)).convert('RGB')
+
+
+def draw_outline(image, parcel, extent):
+    """Draw the parcel's rings (or its bounding box) on the image"""
+    xmin, ymin, xmax, ymax = extent
+    width, height = image.size
+
+    def to_pixel(x, y):
+        return ((x - xmin) / (xmax - xmin) * width, (ymax - y) / (ymax - ymin) * height)
+
+    rings = parcel.geometry or [[[parcel.xmin, parcel.ymin], [parcel.xmax, parcel.ymin],
+                                 [parcel.xmax, parcel.ymax], [parcel.xmin, parcel.ymax],
+                                 [parcel.xmin, parcel.ymin]]]
+    draw = ImageDraw.Draw(image)
+    for ring in rings:
+        draw.line([to_pixel(x, y) for x, y in ring], fill=OUTLINE_COLOUR, width=OUTLINE_WIDTH)
+
+
+def fetch_aerial_photos(referencia_catastral, years, directory, progress=None, on_capture=None):
+    """
+    One image per year, named like the browser screenshots
+    (foto_<referencia>_<year>_<timestamp>.<ext>) in directory. Returns the
+    paths in the order of years, skipping years the WMS failed to serve;
+    on_capture(year, path) is called as each one is saved.
+    """
+    progress = progress or (lambda step: None)
+    started = time.monotonic()
+    progress("Locating parcel")
+    parcel = parcel_resolver.parcel_index.resolve(referencia_catastral)
+    progress("Parcel located")
+    extent = view_extent(parcel)
+    grid = tile_grid(extent)
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    with ThreadPoolExecutor(max_workers=AERIAL_FETCH_WORKERS, thread_name_prefix='aerial-tiles') as executor:
+        # Every tile of every year is requested up front
+        futures = {year: [(left, top, executor.submit(fetch_tile, year, tile_extent, tile_width, tile_height,
+                                                      parcel.wkid))
+                          for left, top, tile_width, tile_height, tile_extent in grid]
+                   for year in years}
+        for year in years:
+            try:
+                image = Image.new('RGB', (AERIAL_IMAGE_WIDTH, AERIAL_IMAGE_HEIGHT))
+                for left, top, future in futures[year]:
+                    image.paste(future.result(), (left, top))
+                if AERIAL_OUTLINE:
+                    draw_outline(image, parcel, extent)
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                path = os.path.normpath(capture.save_image(
+                    image, os.path.join(directory, f"foto_{referencia_catastral}_{year}_{timestamp}")))
+                paths.append(path)
+                progress(f"Captured year {year}")
+                if on_capture:
+                    on_capture(year, path)
+            except Exception as e:
+                logger.error(f"Failed to fetch the {year} orthophoto for {referencia_catastral}: {str(e)}")
+    if not paths:
+        raise AerialTilesError(f"No orthophoto could be fetched for {referencia_catastral}")
+    logger.info(f"Fetched {len(paths)}/{len(years)} orthophotos for {referencia_catastral} "
+                f"in {time.monotonic() - started:.1f}s")
+    return paths
@@ -0,0 +1,56 @@
+"""
+ASGI entry point for either app:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+APP_MODULE picks the app (pdf-inundaciones-ideib or fotos-aereas-ideib;
+the module names have hyphens, so they are loaded from their files). The
+Flask routes run unchanged behind the WSGI adapter; with BROWSER_ENGINE=async
+their renders are coroutines on one browser, so requests waiting on the
+visor hold no browser thread.
+
+asgiref's WsgiToAsgi runs every request on one shared thread
+(thread_sensitive), which would serialise the routes: a slow upload or a
+long-lived /events stream would block everything else. Each request gets a
+ThreadSensitiveContext, and so a thread of its own, instead; at most
+ASGI_THREADS run at once and the rest wait for one to finish.
+"""
+import asyncio
+import importlib.util
+import os
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+APP_MODULE = os.environ.get('APP_MODULE', 'pdf-inundaciones-ideib')
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+
+class ThreadPerRequest:
+    """Runs each request of an ASGI-wrapped WSGI app on its own thread, ASGI_THREADS at a time"""
+
+    def __init__(self, application, threads=ASGI_THREADS):
+        self.application = application
+        self.threads = threads
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.application(scope, receive, send)
+            return
+        if self._slots is None:
+            # Created on the server's event loop
+            self._slots = asyncio.Semaphore(self.threads)
+        async with self._slots, ThreadSensitiveContext():
+            await self.application(scope, receive, send)
+
+
+def load_flask_app(name=APP_MODULE):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+app = ThreadPerRequest(WsgiToAsgi(load_flask_app()))
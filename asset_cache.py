@@ -0,0 +1,236 @@
+"""
+Disk-backed HTTP cache for the IDEIB visor's static assets.
+
+Every render uses a fresh browser context with an empty cache (and routing
+disables Chromium's HTTP cache anyway), so each page.goto would re-download
+the whole jimu/Dojo/ArcGIS JS framework. This page.route handler serves
+those assets (JS, CSS, images, config JSON) from disk, revalidates them with
+conditional requests once they are older than ASSET_CACHE_FRESH seconds,
+and stores new ones as they are fetched.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ASSET_CACHE_ENABLED = os.environ.get('ASSET_CACHE', '1') != '0'
+ASSET_CACHE_DIR = os.environ.get('ASSET_CACHE_DIR', os.path.join(os.getcwd(), 'downloads', 'asset_cache'))
+ASSET_CACHE_FRESH = float(os.environ.get('ASSET_CACHE_FRESH', 3600))
+# Assets whose URL carries a version are only revalidated after this long
+ASSET_CACHE_VERSIONED_FRESH = float(os.environ.get('ASSET_CACHE_VERSIONED_FRESH', 7 * 24 * 3600))
+ASSET_CACHE_MAX_BYTES = int(os.environ.get('ASSET_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+# The visor application itself and the ArcGIS JS API it loads
+CACHEABLE_URL = re.compile(os.environ.get(
+    'ASSET_CACHE_URL_PATTERN', r'^https://(ideib\.caib\.es/visor/|js\.arcgis\.com/)'), re.IGNORECASE)
+CACHEABLE_EXTENSION = re.compile(r'\.(js|css|png|jpe?g|gif|svg|json|html|woff2?)$', re.IGNORECASE)
+VERSIONED_URL = re.compile(r'[?&](v|wab_dv|version)=', re.IGNORECASE)
+# Response headers worth replaying
+KEPT_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control', 'access-control-allow-origin')
+
+
+class AssetCache:
+    def __init__(self, directory=ASSET_CACHE_DIR, max_bytes=ASSET_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'revalidated': 0, 'refreshed': 0, 'misses': 0, 'errors': 0,
+                          'bytes_served': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(os.path.getsize(os.path.join(directory, name))
+                                for name in os.listdir(directory) if name.endswith('.body'))
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @staticmethod
+    def cacheable(request):
+        if request.method != 'GET' or not CACHEABLE_URL.search(request.url):
+            return False
+        return bool(CACHEABLE_EXTENSION.search(request.url.split('?', 1)[0]))
+
+    def _paths(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, name)
+        return base + '.body', base + '.meta.json'
+
+    def _load(self, url):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def _store(self, url, response, body):
+        body_path, meta_path = self._paths(url)
+        headers = {k: v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS}
+        meta = {'url': url, 'status': response.status, 'headers': headers, 'validated_at': time.time()}
+        try:
+            replaced = os.path.getsize(body_path)
+        except OSError:
+            replaced = 0
+        for path, data, mode in ((body_path, body, 'wb'), (meta_path, json.dumps(meta), 'w')):
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, mode) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += len(body) - replaced
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self._prune()
+        return meta
+
+    def _touch(self, url, meta):
+        meta['validated_at'] = time.time()
+        _, meta_path = self._paths(url)
+        tmp_path = f'{meta_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _prune(self):
+        """Drop the least recently validated assets until under half the budget"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.body'):
+                path = os.path.join(self.directory, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes // 2:
+                break
+            for stale in (path, path[:-len('.body')] + '.meta.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
+        with self._lock:
+            self._total_bytes = total
+        logger.info(f"Asset cache pruned to {total / 1024 / 1024:.1f} MiB")
+
+    def _fresh(self, url, meta):
+        max_age = ASSET_CACHE_VERSIONED_FRESH if VERSIONED_URL.search(url) else ASSET_CACHE_FRESH
+        return time.time() - meta['validated_at'] < max_age
+
+    def _fulfill(self, route, meta, body):
+        self._count('bytes_served', len(body))
+        route.fulfill(status=meta['status'], headers=meta['headers'], body=body)
+
+    def handle(self, route):
+        request = route.request
+        if not self.cacheable(request):
+            route.fallback()
+            return
+        url = request.url
+        try:
+            meta, body = self._load(url)
+            if meta is not None and self._fresh(url, meta):
+                self._count('hits')
+                self._fulfill(route, meta, body)
+                return
+
+            headers = dict(request.headers)
+            if meta is not None:
+                if meta['headers'].get('etag'):
+                    headers['if-none-match'] = meta['headers']['etag']
+                if meta['headers'].get('last-modified'):
+                    headers['if-modified-since'] = meta['headers']['last-modified']
+            response = route.fetch(headers=headers)
+            if response.status == 304 and meta is not None:
+                self._count('revalidated')
+                self._touch(url, meta)
+                self._fulfill(route, meta, body)
+                return
+
+            body = response.body()
+            if response.status == 200:
+                self._count('refreshed' if meta is not None else 'misses')
+                self._store(url, response, body)
+            route.fulfill(response=response, body=body)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Asset cache could not serve {url}: {str(e)}")
+            try:
+                route.fallback()
+            except Exception:
+                pass  # Already fulfilled before the error
+
+    async def handle_async(self, route):
+        """handle() for async_playwright routes; the cache files are read and written off the event loop"""
+        request = route.request
+        if not self.cacheable(request):
+            await route.fallback()
+            return
+        url = request.url
+        loop = asyncio.get_running_loop()
+        try:
+            meta, body = await loop.run_in_executor(None, self._load, url)
+            if meta is not None and self._fresh(url, meta):
+                self._count('hits')
+                self._count('bytes_served', len(body))
+                await route.fulfill(status=meta['status'], headers=meta['headers'], body=body)
+                return
+
+            headers = dict(request.headers)
+            if meta is not None:
+                if meta['headers'].get('etag'):
+                    headers['if-none-match'] = meta['headers']['etag']
+                if meta['headers'].get('last-modified'):
+                    headers['if-modified-since'] = meta['headers']['last-modified']
+            response = await route.fetch(headers=headers)
+            if response.status == 304 and meta is not None:
+                self._count('revalidated')
+                await loop.run_in_executor(None, self._touch, url, meta)
+                self._count('bytes_served', len(body))
+                await route.fulfill(status=meta['status'], headers=meta['headers'], body=body)
+                return
+
+            body = await response.body()
+            if response.status == 200:
+                self._count('refreshed' if meta is not None else 'misses')
+                await loop.run_in_executor(None, self._store, url, response, body)
+            await route.fulfill(response=response, body=body)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Asset cache could not serve {url}: {str(e)}")
+            try:
+                await route.fallback()
+            except Exception:
+                pass  # Already fulfilled before the error
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'bytes': self._total_bytes, 'max_bytes': self.max_bytes})
+        return stats
+
+
+asset_cache = AssetCache()
+
+
+def install(page):
+    """
+    Serve the page's static visor assets from disk. Call before page.goto and
+    before request_filter.install: the last route registered runs first, so
+    the filter still sees every request before the cache does.
+    """
+    if ASSET_CACHE_ENABLED:
+        page.route('**/*', asset_cache.handle)
+
+
+async def install_async(page):
+    """install() for async_playwright pages"""
+    if ASSET_CACHE_ENABLED:
+        await page.route('**/*', asset_cache.handle_async)
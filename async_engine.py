@@ -0,0 +1,225 @@
+"""
+Asyncio browser engine: one Chromium multiplexing many renders.
+
+BrowserPool ties a thread to every browser and a render to each of them.
+Here a single event loop thread drives one browser (launched, or shared
+over BROWSER_CDP_URL) through async_playwright and every render is a
+coroutine on its own context, so a page waiting on the visor holds no
+thread. Up to ASYNC_MAX_CONTEXTS renders run at once; the rest wait for a
+slot, and give up after the lease timeout like the pool's callers.
+
+run(fn, *args) has the same shape as BrowserPool.run, with fn a coroutine
+function taking the page first (see async_steps.py), so the Flask routes
+and job workers use it unchanged; asyncio code can await submit()'s future
+with asyncio.wrap_future.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from playwright.async_api import async_playwright
+
+import forensics
+
+from browser_pool import (BROWSER_CDP_URL, BROWSER_LEASE_TIMEOUT, BROWSER_MAX_JOBS, DEFAULT_PAGE_TIMEOUT, VIEWPORT,
+                          LeaseTimeout, chromium_launch_options, shared_browser_lease)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_MAX_CONTEXTS = int(os.environ.get('ASYNC_MAX_CONTEXTS', 4))
+
+
+class AsyncBrowserEngine:
+    """An event loop thread owning one browser and running renders on it concurrently"""
+
+    def __init__(self, launch_options=None, max_contexts=ASYNC_MAX_CONTEXTS, max_jobs=BROWSER_MAX_JOBS,
+                 lease_timeout=BROWSER_LEASE_TIMEOUT, viewport=VIEWPORT, cdp_url=BROWSER_CDP_URL,
+                 recycle_check=None):
+        self.launch_options = launch_options or chromium_launch_options()
+        self.max_contexts = max(1, max_contexts)
+        self.max_jobs = max(1, max_jobs)
+        self.lease_timeout = lease_timeout
+        self.viewport = viewport
+        self.cdp_url = cdp_url
+        self.recycle_check = recycle_check
+        # As in BrowserPool, a shared Chromium is left to browser_server.py
+        self.recycling = cdp_url is None
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._playwright = None
+        self._browser = None
+        self._jobs_on_browser = 0
+        self._active = 0
+        self._waiting = 0
+        self._counters = {'jobs': 0, 'launches': 0, 'connects': 0, 'recycles': 0, 'crashes': 0,
+                          'lease_timeouts': 0}
+        self._wait_total = 0.0
+        self._wait_count = 0
+
+    def start(self):
+        """Start the event loop thread and Playwright if not already running"""
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever, name='async-browser', daemon=True)
+            self._thread.start()
+            # Loop-bound primitives have to be created on the loop (Python 3.9)
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self._loop = loop
+            logger.info(f"Async browser engine started, up to {self.max_contexts} concurrent renders")
+
+    def warm(self):
+        """Start the engine and launch its browser ahead of the first render"""
+        self.start()
+        asyncio.run_coroutine_threadsafe(self._ready_browser(), self._loop).result()
+
+    async def _setup(self):
+        self._slots = asyncio.Semaphore(self.max_contexts)
+        self._browser_lock = asyncio.Lock()
+        self._playwright = await async_playwright().start()
+
+    def shutdown(self):
+        """Close the browser and stop the loop"""
+        with self._start_lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._teardown(), loop).result(timeout=30)
+        except Exception as e:
+            logger.error(f"Error stopping the async browser engine: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=30)
+
+    async def _teardown(self):
+        await self._close_browser()
+        await self._playwright.stop()
+
+    async def _launch(self):
+        started = time.monotonic()
+        if self.cdp_url:
+            self._browser = await self._playwright.chromium.connect_over_cdp(self.cdp_url)
+            self._counters['connects'] += 1
+        else:
+            self._browser = await self._playwright.chromium.launch(**self.launch_options)
+            self._counters['launches'] += 1
+        self._jobs_on_browser = 0
+        logger.info(f"Async engine browser ready in {time.monotonic() - started:.1f}s")
+
+    async def _close_browser(self):
+        if self._browser is None:
+            return
+        try:
+            await self._browser.close()
+        except Exception as e:
+            logger.error(f"Error closing the async engine browser: {e}")
+        self._browser = None
+
+    async def _ready_browser(self):
+        async with self._browser_lock:
+            if self._browser is not None and not self._browser.is_connected():
+                logger.warning("Async engine browser crashed, relaunching")
+                self._counters['crashes'] += 1
+                self._browser = None
+            if self._browser is None:
+                await self._launch()
+            return self._browser
+
+    async def _maybe_recycle(self):
+        """Recycle the browser between renders once it is worn out or too large"""
+        if self._active or self._browser is None or not self.recycling:
+            return
+        async with self._browser_lock:
+            if self._jobs_on_browser >= self.max_jobs:
+                logger.info(f"Recycling the async engine browser after {self._jobs_on_browser} renders")
+            elif self.recycle_check is None or not self.recycle_check(self):
+                return
+            self._counters['recycles'] += 1
+            await self._close_browser()
+
+    @contextlib.asynccontextmanager
+    async def _server_lease(self):
+        """BrowserPool.server_lease for a render; the lock may block, so it is taken off the loop"""
+        if not self.cdp_url:
+            yield
+            return
+        lease = shared_browser_lease()
+        await asyncio.get_running_loop().run_in_executor(None, lease.__enter__)
+        try:
+            yield
+        finally:
+            lease.__exit__(None, None, None)
+
+    async def render(self, fn, *args, **kwargs):
+        """Await fn(page, *args, **kwargs) on a fresh context once a slot is free"""
+        queued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.lease_timeout)
+        except asyncio.TimeoutError:
+            self._counters['lease_timeouts'] += 1
+            raise LeaseTimeout(f"No render slot free after {self.lease_timeout:.0f}s")
+        finally:
+            self._waiting -= 1
+        self._wait_total += time.monotonic() - queued_at
+        self._wait_count += 1
+        self._active += 1
+        context = None
+        try:
+            async with self._server_lease():
+                try:
+                    browser = await self._ready_browser()
+                    context = await browser.new_context(viewport=self.viewport)
+                    page = await context.new_page()
+                    page.set_default_timeout(DEFAULT_PAGE_TIMEOUT)
+                    await forensics.attach_async(context, page)
+                    try:
+                        return await fn(page, *args, **kwargs)
+                    except Exception as e:
+                        await forensics.step_failed_async(page, 'job', getattr(fn, '__name__', 'job'), str(e))
+                        raise
+                finally:
+                    if context is not None:
+                        try:
+                            await context.close()
+                        except Exception as e:
+                            logger.error(f"Error closing context: {e}")
+        finally:
+            self._active -= 1
+            self._counters['jobs'] += 1
+            self._jobs_on_browser += 1
+            try:
+                await self._maybe_recycle()
+            finally:
+                self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule a render from any thread; returns a concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.render(fn, *args, **kwargs), self._loop)
+
+    def run(self, fn, *args, **kwargs):
+        """Blocking render for synchronous callers, like BrowserPool.run"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stats(self):
+        """Engine utilisation snapshot, with the same keys as BrowserPool.stats where they apply"""
+        stats = dict(self._counters)
+        stats.update({
+            'size': self.max_contexts,
+            'alive': 1 if self._browser is not None else 0,
+            'busy': self._active,
+            'queued': self._waiting,
+            'utilisation': self._active / self.max_contexts,
+            'avg_lease_wait_seconds': self._wait_total / self._wait_count if self._wait_count else 0.0,
+            'max_jobs_per_browser': self.max_jobs,
+            'lease_timeout_seconds': self.lease_timeout,
+            'shared_server': self.cdp_url is not None,
+            'recycling': self.recycling,
+        })
+        return stats
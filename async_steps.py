@@ -0,0 +1,675 @@
+"""
+Visor steps for async_playwright pages, run by the asyncio engine.
+
+Each coroutine mirrors the step of the same name in pdf-inundaciones-ideib.py
+or fotos-aereas-ideib.py: same selectors, waits, logging and step metrics
+(labelled with the flow being rendered through metrics.current_flow), so
+BROWSER_ENGINE can switch between the engines without changing the output.
+The entry points are render_flood_area_pdf, render_flood_area_pdfs and
+capture_aerial_photos; the app modules pass in what they own (visor URL,
+years, screenshot directory).
+"""
+import asyncio
+import functools
+import logging
+import os
+from datetime import datetime
+
+import async_waits as waits
+import asset_cache
+import capture
+import metrics
+import parcel_resolver
+import request_filter
+from step_sequence import AsyncStepSequence, Step, StepFailed
+
+logger = logging.getLogger(__name__)
+
+IDEIB_VISOR_URL = os.environ.get('IDEIB_VISOR_URL', 'https://ideib.caib.es/visor/')
+
+OK_SELECTOR = 'div.jimu-btn.jimu-float-trailing.enable-btn[data-dojo-attach-point="okNode"]'
+ZOOM_IN_SELECTOR = 'div.zoom.zoom-in.jimu-corner-top.firstFocusNode[data-dojo-attach-point="btnZoomIn"]'
+CERCA_AVANCADA_CLOSE_SELECTOR = 'div.close-icon.jimu-float-trailing[data-dojo-attach-point="closeNode"]'
+RISC_INUNDACIO_ADD_BUTTON = ('div.item-card-inner:has(h3.title:text("Xarxa Hidrogràfica i Risc Inundació de les Illes Balears")) '
+                             '[data-dojo-attach-point="addButton"]')
+PRINT_RESULT_SELECTOR = ':text("Mapa IDEIB")'
+PRINT_BUTTON_SELECTOR = '[data-dojo-attach-point="printButtonDijit"]'
+AFEGIR_DADES_SEARCH_BOX = 'input.search-textbox[data-dojo-attach-point="searchTextBox"]'
+AFEGIR_DADES_CLOSE_BUTTON = 'div.close-btn.jimu-vcenter[data-dojo-attach-point="closeNode"]'
+PRINT_JOB_URL_PATTERN = r'/GPServer/.+/(submitJob|execute)'
+PRINT_JOB_TIMEOUT = float(os.environ.get('PRINT_JOB_TIMEOUT', 180))
+# True once a layer of the flood service is on the map
+FLOOD_LAYER_ADDED_SCRIPT = """
+() => {
+    const map = window._viewerMap;
+    if (!map) return false;
+    const names = (map.layers || []).map(String);
+    for (const id of (map.layerIds || [])) {
+        const layer = map.getLayer(id);
+        names.push(id, (layer && (layer.url || layer.name || layer.title)) || '');
+    }
+    return names.some((name) => /inund/i.test(name));
+}
+"""
+HIDDEN_UI_IDS = [
+    'themes_IDEIBTheme_widgets_AnchorBarController_Widget_20', 'widgets_ideibSearch_Widget_22',
+    'themes_IDEIBTheme_widgets_Header_Widget_21', 'widgets_ZoomSlider_Widget_24',
+    'widgets_ideibStreetView', 'widgets_MyLocation_Widget_26',
+    'widgets_ideibHomeButton_Widget_25', 'widgets_ideibZoomExtent',
+    'widgets_ZoomSlider_Widget_24', 'dijit__WidgetBase_2', 'esri_dijit_OverviewMap_1'
+]
+
+
+async def _off_loop(fn, *args):
+    """Run blocking disk or image work on the default executor, off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def _no_progress(step):
+    pass
+
+
+# Steps shared by both flows
+
+@metrics.step()
+async def close_initial_modal(page):
+    """Close the initial modal that appears when the page loads"""
+    try:
+        logger.info("Waiting for the initial modal to appear...")
+        await waits.wait_for_visible(page, OK_SELECTOR, "initial_modal_shown", timeout=60, legacy_sleep=5)
+        logger.info("Closing initial modal...")
+        await page.locator(OK_SELECTOR).click()
+        await waits.wait_for_hidden(page, OK_SELECTOR, "initial_modal_closed", legacy_sleep=2)
+        logger.info("Initial modal closed successfully")
+    except Exception as e:
+        logger.error(f"Failed to close initial modal: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def click_locate_icon(page):
+    """Click the locate icon to open the search panel"""
+    try:
+        logger.info("Clicking locate icon...")
+        img = page.locator('img.icon[src*="/visor/widgets/ideibLocate/images/icon.png"]')
+        await img.wait_for(state="visible")
+        await img.locator('xpath=..').click()
+        await waits.wait_for_visible(page, 'div.tab.jimu-vcenter-text[label="Cadastre"]', "locate_panel_open",
+                                     legacy_sleep=1)
+        logger.info("Locate icon clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click locate icon: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def click_cadastre_tab(page):
+    """Click the Cadastre tab in the search panel"""
+    try:
+        logger.info("Clicking Cadastre tab...")
+        cadastre_tab = page.locator('div.tab.jimu-vcenter-text[label="Cadastre"]')
+        await cadastre_tab.wait_for(state="visible")
+        await cadastre_tab.click()
+        await waits.wait_for_visible(page, 'input#RC[name="search"]', "cadastre_tab_open", legacy_sleep=1)
+        logger.info("Cadastre tab clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click Cadastre tab: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def enter_cadastral_reference(page, referencia_catastral):
+    """Enter the cadastral reference and click search"""
+    try:
+        logger.info(f"Entering cadastral reference: {referencia_catastral}")
+        input_field = page.locator('input#RC[name="search"]')
+        await input_field.wait_for(state="visible")
+        await input_field.fill(referencia_catastral)
+
+        logger.info("Clicking search button...")
+        search_button = page.locator('div.locate-btn.btn-addressLocate[data-dojo-attach-point="btnRefCat"]')
+        await search_button.wait_for(state="visible")
+        # The map zooms to the parcel once the cadastre lookup answers
+        await waits.wait_for_map_update(page, search_button.click, "parcel_located", legacy_sleep=3)
+        logger.info("Search completed successfully")
+    except Exception as e:
+        logger.error(f"Failed to enter cadastral reference: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def close_cerca_avancada(page):
+    """Close the cerca avançada panel"""
+    try:
+        logger.info("Closing cerca avançada panel...")
+        close_button = page.locator(CERCA_AVANCADA_CLOSE_SELECTOR)
+        await close_button.wait_for(state="visible")
+        await close_button.click()
+        await waits.wait_for_hidden(page, CERCA_AVANCADA_CLOSE_SELECTOR, "cerca_avancada_closed", legacy_sleep=1)
+        logger.info("Cerca avançada panel closed successfully")
+    except Exception as e:
+        logger.error(f"Failed to close cerca avançada panel: {str(e)}")
+        return False
+
+
+async def zoom_in(page, times):
+    logger.info(f"Zooming in {times} times...")
+    zoom_in_button = page.locator(ZOOM_IN_SELECTOR)
+    await zoom_in_button.wait_for(state="visible")
+    for i in range(times):
+        await waits.wait_for_map_update(page, zoom_in_button.click, "zoom_in", legacy_sleep=0.5)
+        logger.info(f"Zoomed in {i+1}/{times} times")
+
+
+async def locate_with_visor(page, referencia_catastral):
+    """Centre the map on the parcel through the visor's cadastre search; False if a step failed"""
+    return (await click_locate_icon(page) is not False
+            and await click_cadastre_tab(page) is not False
+            and await enter_cadastral_reference(page, referencia_catastral) is not False
+            and await close_cerca_avancada(page) is not False)
+
+
+async def centre_map_on_parcel(page, referencia_catastral, index=None):
+    """parcel_resolver.centre_map_on_parcel for async pages; returns the extent moved to, or None"""
+    index = index or parcel_resolver.parcel_index
+    extent = parcel_resolver.indexed_extent(index.lookup(referencia_catastral))
+    if extent is not None:
+        try:
+            jumped = await page.evaluate(parcel_resolver.JUMP_TO_EXTENT_SCRIPT, [
+                extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'], extent['wkid']])
+        except Exception as e:
+            logger.error(f"Failed to jump to parcel extent: {str(e)}")
+            jumped = False
+        if jumped:
+            logger.info(f"Jumped straight to the indexed extent of {referencia_catastral}")
+            return extent
+
+    before = await _read_map_extent(page)
+    if not await locate_with_visor(page, referencia_catastral):
+        return None
+    after = await _read_map_extent(page)
+    # Only remember extents the locate actually moved the map to
+    if after is None or after == before:
+        logger.warning(f"Locating {referencia_catastral} did not move the map")
+        return None
+    index.remember_view_extent(referencia_catastral, after)
+    return after
+
+
+async def _read_map_extent(page):
+    try:
+        return await page.evaluate(parcel_resolver.READ_EXTENT_SCRIPT)
+    except Exception:
+        return None
+
+
+async def install_hooks(page, flow):
+    """Map hooks, asset cache and request filter; once per page, they stack if installed again"""
+    await waits.install_map_hooks(page)
+    await asset_cache.install_async(page)
+    await request_filter.install_async(page, flow)
+
+
+async def load_visor(page, flow, wait_until="networkidle", visor_url=None):
+    """Hook the page and open the visor"""
+    await install_hooks(page, flow)
+    await open_visor(page, flow, wait_until, visor_url)
+
+
+async def open_visor(page, flow, wait_until="networkidle", visor_url=None):
+    """(Re)load the visor on a page already hooked"""
+    with metrics.timed_step(flow, 'load_visor'):
+        await page.goto(visor_url or IDEIB_VISOR_URL, timeout=90000, wait_until="load")
+        await page.wait_for_load_state(wait_until, timeout=90000)
+
+
+# Flood PDF flow
+
+@metrics.step()
+async def click_afegir_dades(page):
+    """Click the afegir dades button"""
+    try:
+        logger.info("Clicking afegir dades button...")
+        afegir_dades_button = page.locator('div[data-dojo-attach-point="btnAddData"].layerList-btn')
+        await afegir_dades_button.wait_for(state="visible")
+        await afegir_dades_button.click()
+        logger.info("Afegir dades button clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click afegir dades button: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def input_inundacio_search(page):
+    """Input 'inund' into the search box and click the search button"""
+    try:
+        logger.info("Entering 'inund' into the search box...")
+        search_input = page.locator('input.search-textbox[data-dojo-attach-point="searchTextBox"]')
+        await search_input.wait_for(state="visible")
+        await search_input.fill("inund")
+        search_button = page.locator('button.btn.btn-confirm[data-dojo-attach-point="searchButton"]')
+        await search_button.wait_for(state="visible")
+        await search_button.click()
+        await waits.wait_for_visible(page, RISC_INUNDACIO_ADD_BUTTON, "inundacio_results", legacy_sleep=3)
+        logger.info("Search completed successfully")
+    except Exception as e:
+        logger.error(f"Failed to input inundacio search: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def add_layer_risc_inundacio(page):
+    """Click the 'Afegir' button for the Risc Inundació layer"""
+    try:
+        logger.info("Clicking the 'Afegir' button for Risc Inundació...")
+        add_button = page.locator(RISC_INUNDACIO_ADD_BUTTON)
+        await add_button.wait_for(state="visible")
+        await add_button.click()
+        logger.info("'Afegir' button for Risc Inundació clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click 'Afegir' button for Risc Inundació: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def close_afegir_dades(page):
+    """Close the afegir dades"""
+    try:
+        logger.info("Closing afegir dades...")
+        close_button = page.locator('div.close-btn.jimu-vcenter[data-dojo-attach-point="closeNode"]')
+        await close_button.wait_for(state="visible")
+        await close_button.click()
+        logger.info("Afegir dades closed successfully")
+    except Exception as e:
+        logger.error(f"Failed to close afegir dades: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def zoom_in_twice(page):
+    """Zoom in two times"""
+    try:
+        await zoom_in(page, 2)
+    except Exception as e:
+        logger.error(f"Failed to zoom in: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def click_print_icon(page):
+    """Click the print icon to open the print panel"""
+    try:
+        logger.info("Clicking print icon...")
+        img = page.locator('img.icon[src*="/visor/widgets/ideibPrint/images/icon.png"]')
+        await img.wait_for(state="visible")
+        await img.locator('xpath=..').click()
+        await waits.wait_for_visible(page, '[data-dojo-attach-point="printButtonDijit"]', "print_panel_open",
+                                     legacy_sleep=1)
+        logger.info("Print icon clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click print icon: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def click_imprimir(page):
+    """Click imprimir"""
+    try:
+        logger.info("Clicking imprimir...")
+        print_button = page.locator('[data-dojo-attach-point="printButtonDijit"]')
+        await print_button.wait_for(state="visible")
+        # The print widget submits an ExportWebMap job to the ArcGIS print service
+        if not await waits.wait_for_response(page, PRINT_JOB_URL_PATTERN, print_button.click,
+                                             "print_job_submitted", timeout=15, legacy_sleep=1):
+            raise Exception("No print job was submitted")
+        logger.info("Imprimir clicked successfully")
+    except Exception as e:
+        logger.error(f"Failed to click imprimir: {str(e)}")
+        return False
+
+
+async def count_print_results(page):
+    return await page.locator(PRINT_RESULT_SELECTOR).count()
+
+
+@metrics.step(returns_value=True)
+async def click_pdf(page, previous_results=0):
+    """Download the PDF of the print job that just finished"""
+    try:
+        logger.info("Clicking on the pdf...")
+        if not await waits.wait_for_visible(page, PRINT_RESULT_SELECTOR, "print_job_done", timeout=PRINT_JOB_TIMEOUT,
+                                            legacy_sleep=5, nth=previous_results):
+            raise Exception("Print job did not finish")
+        async with page.expect_download() as download_info:
+            await page.locator(PRINT_RESULT_SELECTOR).nth(previous_results).click()
+            logger.info("Mapa IDEIB clicked")
+        download = await download_info.value
+        logger.info(f"Download started: {download.suggested_filename}")
+        download_dir = os.path.join(os.getcwd(), 'downloads')
+        await _off_loop(functools.partial(os.makedirs, download_dir, exist_ok=True))
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        safe_filename = "".join([c for c in download.suggested_filename
+                                 if c.isalpha() or c.isdigit() or c in (' ', '.', '_')]).rstrip()
+        if not safe_filename.lower().endswith('.pdf'):
+            safe_filename += '.pdf'
+        pdf_path = os.path.join(download_dir, f'flood_area_{timestamp}_{safe_filename}')
+        await download.save_as(pdf_path)
+        logger.info(f"PDF downloaded successfully to {pdf_path}")
+        return pdf_path
+    except Exception as e:
+        logger.error(f"Failed to click mapa IDEIB: {str(e)}")
+        return None
+
+
+def is_visible(selector):
+    return lambda page: page.locator(selector).first.is_visible()
+
+
+def is_hidden(selector):
+    return lambda page: page.locator(selector).first.is_hidden()
+
+
+async def map_ready(page):
+    return await page.evaluate("() => !!window._viewerMap")
+
+
+async def flood_layer_added(page):
+    return await page.evaluate(FLOOD_LAYER_ADDED_SCRIPT)
+
+
+async def shows_extent(page, extent):
+    """parcel_resolver.shows_extent for async pages"""
+    current = await _read_map_extent(page)
+    if extent is None or current is None or current['wkid'] != extent['wkid']:
+        return False
+    x = (extent['xmin'] + extent['xmax']) / 2
+    y = (extent['ymin'] + extent['ymax']) / 2
+    return current['xmin'] <= x <= current['xmax'] and current['ymin'] <= y <= current['ymax']
+
+
+def prime_steps(visor_url=None):
+    """PRIME_STEPS of pdf-inundaciones-ideib.py; the page must already have its hooks installed"""
+    async def load(page):
+        logger.info("Navigating to IDEIB visor...")
+        await open_visor(page, 'pdf', visor_url=visor_url)
+
+    return AsyncStepSequence('pdf', [
+        Step('load_visor', load, check=map_ready),
+        Step('close_initial_modal', close_initial_modal, check=is_hidden(OK_SELECTOR)),
+        Step('click_afegir_dades', click_afegir_dades, check=is_visible(AFEGIR_DADES_SEARCH_BOX)),
+        Step('input_inundacio_search', input_inundacio_search, check=is_visible(RISC_INUNDACIO_ADD_BUTTON)),
+        Step('add_layer_risc_inundacio', add_layer_risc_inundacio, check=flood_layer_added),
+        Step('close_afegir_dades', close_afegir_dades, check=is_hidden(AFEGIR_DADES_CLOSE_BUTTON)),
+    ])
+
+
+async def prime_visor_page(page, visor_url=None):
+    """Visor loaded, initial modal closed and the flood layer added; raises StepFailed"""
+    await install_hooks(page, 'pdf')
+    await prime_steps(visor_url).run(page)
+
+
+def render_steps(referencia_catastral, result):
+    """render_steps of pdf-inundaciones-ideib.py: primed page to PDF, whose path goes in result['pdf_path']"""
+    async def centre(page):
+        with metrics.timed_step('pdf', 'centre_map_on_parcel'):
+            result['parcel_extent'] = await centre_map_on_parcel(page, referencia_catastral)
+        result['centred_extent'] = await _read_map_extent(page)
+        return result['parcel_extent'] is not None
+
+    async def centred(page):
+        return await shows_extent(page, result.get('parcel_extent'))
+
+    async def zoomed_in(page):
+        extent = await _read_map_extent(page)
+        before = result.get('centred_extent')
+        return (extent is not None and before is not None
+                and extent['xmax'] - extent['xmin'] < before['xmax'] - before['xmin'] and await centred(page))
+
+    async def submit_print(page):
+        result['previous_results'] = await count_print_results(page)
+        return await click_imprimir(page)
+
+    async def download(page):
+        result['pdf_path'] = await click_pdf(page, result['previous_results'])
+        return result['pdf_path'] is not None
+
+    return AsyncStepSequence('pdf', [
+        Step('centre_map_on_parcel', centre, check=centred, before="Locating parcel", after="Parcel located"),
+        Step('zoom_in_twice', zoom_in_twice, check=zoomed_in, retry_from='centre_map_on_parcel'),
+        Step('click_print_icon', click_print_icon, check=is_visible(PRINT_BUTTON_SELECTOR), before="Printing map"),
+        Step('click_imprimir', submit_print, after="Print submitted"),
+        Step('click_pdf', download, retry_from='click_imprimir', before="Downloading PDF"),
+    ])
+
+
+async def _render_on_primed_page(page, referencia_catastral, progress):
+    """The PDF's path, or None once a step has run out of retries"""
+    result = {}
+    try:
+        await render_steps(referencia_catastral, result).run(page, progress)
+    except StepFailed as e:
+        logger.error(f"Flood PDF for {referencia_catastral} failed: {str(e)}")
+        return None
+    finally:
+        request_filter.log_summary(page, f"Flood PDF for {referencia_catastral}")
+    return result['pdf_path']
+
+
+async def render_flood_area_pdf(page, referencia_catastral, progress=None, visor_url=None):
+    """Prime the page and render the reference's flood PDF; returns its path"""
+    metrics.current_flow.set('pdf')
+    progress = progress or _no_progress
+    await prime_visor_page(page, visor_url)
+    progress("Visor loaded with the flood layer")
+    return await _render_on_primed_page(page, referencia_catastral, progress)
+
+
+async def render_flood_area_pdfs(page, referencias, progress=None, visor_url=None):
+    """Several references on one page; returns {referencia: (pdf_path or None, error or None)}"""
+    metrics.current_flow.set('pdf')
+    progress = progress or _no_progress
+    await prime_visor_page(page, visor_url)
+    results = {}
+    for i, referencia_catastral in enumerate(referencias):
+        progress(f"Rendering {referencia_catastral} ({i + 1}/{len(referencias)})")
+        try:
+            pdf_path = await _render_on_primed_page(page, referencia_catastral, _no_progress)
+        except Exception as e:
+            pdf_path = None
+            logger.error(f"Error rendering {referencia_catastral} in batch: {e}")
+        if pdf_path:
+            results[referencia_catastral] = (pdf_path, None)
+            continue
+        results[referencia_catastral] = (None, 'Failed to generate PDF')
+        if i + 1 < len(referencias):
+            # The visor may be left half-way through a step, start the next one clean
+            # The hooks are still on the page, reinstalling them would count every request twice
+            logger.info("Re-priming the visor after a failed reference...")
+            try:
+                await prime_steps(visor_url).run(page)
+            except Exception as e:
+                logger.error(f"Could not re-prime the visor, failing the rest of the batch: {str(e)}")
+                for remaining in referencias[i + 1:]:
+                    results[remaining] = (None, 'Visor could not be prepared')
+                break
+    return results
+
+
+# Aerial photos flow
+
+@metrics.step()
+async def close_left_column(page):
+    """Close/minimize the left column"""
+    try:
+        left_column = page.locator('.bar.max')
+        if await left_column.is_visible():
+            await left_column.click()
+            await left_column.click()
+            logger.info("Left column closed/minimized.")
+    except Exception as e:
+        logger.error(f"Failed to close/minimize left column: {str(e)}")
+        return False
+
+
+async def hide_ui_elements(page):
+    """Hide various UI elements to clean up the view"""
+    for element_id in HIDDEN_UI_IDS:
+        try:
+            if await page.locator(f'#{element_id}').is_visible():
+                await page.evaluate(f"document.getElementById('{element_id}').style.display = 'none';")
+                logger.info(f'Hidden: {element_id}')
+        except Exception as e:
+            logger.error(f'Failed to hide {element_id}: {str(e)}')
+
+
+@metrics.step()
+async def zoom_in_three_times(page):
+    """Zoom in three times"""
+    try:
+        await zoom_in(page, 3)
+    except Exception as e:
+        logger.error(f"Failed to zoom in: {str(e)}")
+        return False
+
+
+@metrics.step()
+async def select_historical_photos(page, first_year):
+    """Click on the historical photos option"""
+    try:
+        logger.info("Selecting historical photos option...")
+        historical_photos = page.locator('img[alt="Fotografies històriques de totes les illes"]')
+        await historical_photos.wait_for(state="visible")
+        await historical_photos.click()
+        await waits.wait_for_visible(page, f'span:text("{first_year}")', "historical_years_listed", legacy_sleep=2)
+        logger.info("Historical photos option selected successfully")
+    except Exception as e:
+        logger.error(f"Failed to select historical photos: {str(e)}")
+        return False
+
+
+async def click_year(page, year):
+    """Click a year's label without waiting for its imagery; returns the map update count"""
+    logger.info(f"Selecting year {year}...")
+    year_element = page.locator(f'span:text("{year}")')
+    await year_element.wait_for(state="visible")
+    return await waits.start_map_update(page, year_element.click)
+
+
+@metrics.step(returns_value=True)
+async def take_screenshot(page, referencia_catastral, year, directory):
+    """Take a screenshot of the current view"""
+    try:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        await _off_loop(functools.partial(os.makedirs, directory, exist_ok=True))
+        path = await capture.screenshot_async(page, os.path.join(directory, f"foto_{referencia_catastral}_{year}_{timestamp}"))
+        logger.info(f"Screenshot saved as {path}")
+        return os.path.normpath(path)
+    except Exception as e:
+        logger.error(f"Failed to take screenshot: {str(e)}")
+        return None
+
+
+@metrics.step(returns_value=True)
+async def select_year_and_screenshot(page, year, referencia_catastral, directory, updates_before=None,
+                                     clicked=False):
+    """Select a year (unless already clicked with click_year) and take a screenshot"""
+    try:
+        if not clicked:
+            updates_before = await click_year(page, year)
+        await waits.finish_map_update(page, updates_before, "year_imagery_loaded", timeout=20, legacy_sleep=5)
+        screenshot_path = await take_screenshot(page, referencia_catastral, year, directory)
+        logger.info(f"Year {year} selected and screenshot taken successfully")
+        return screenshot_path
+    except Exception as e:
+        logger.error(f"Failed to select year {year}: {str(e)}")
+        return None
+
+
+async def position_on_parcel(page, referencia_catastral, first_year, progress=None):
+    """Bring a loaded visor page to the parcel, zoomed in, with the historical photos listed"""
+    progress = progress or _no_progress
+    await close_initial_modal(page)
+    await close_left_column(page)
+    progress("Locating parcel")
+    with metrics.timed_step('aerial', 'centre_map_on_parcel'):
+        await centre_map_on_parcel(page, referencia_catastral)
+    progress("Parcel located")
+    await zoom_in_three_times(page)
+    await hide_ui_elements(page)
+    await select_historical_photos(page, first_year)
+
+
+async def capture_aerial_photos(page, referencia_catastral, years, directory, progress=None, on_capture=None,
+                                page_count=1, visor_url=None):
+    """
+    Capture the years on page plus page_count - 1 extra pages of its
+    context, in waves like capture_years in fotos-aereas-ideib.py. Calls
+    on_capture(year, path, duplicate_of) in year order, on an executor thread
+    since it may write to disk; returns the paths
+    in year order.
+    """
+    metrics.current_flow.set('aerial')
+    progress = progress or _no_progress
+    extra_pages = [await page.context.new_page() for _ in range(max(1, page_count) - 1)]
+    # Extra pages load the visor while the first one locates the parcel
+    loading = [asyncio.ensure_future(load_visor(extra_page, 'aerial', visor_url=visor_url))
+               for extra_page in extra_pages]
+    try:
+        await load_visor(page, 'aerial', visor_url=visor_url)
+        progress("Visor loaded")
+        await position_on_parcel(page, referencia_catastral, years[0], progress)
+        # The first page stored the parcel's extent, so the others jump straight to it
+        pages = [page]
+        for extra_page, loaded in zip(extra_pages, loading):
+            try:
+                await loaded
+                await position_on_parcel(extra_page, referencia_catastral, years[0])
+                pages.append(extra_page)
+            except Exception as e:
+                logger.error(f"Failed to prepare an extra capture page: {str(e)}")
+
+        duplicates = capture.DuplicateFilter() if capture.CAPTURE_DEDUPE != 'off' else None
+        captured = {}
+        pending = list(years)
+        while pending:
+            wave = list(zip(pages, pending))
+            pending = pending[len(wave):]
+            logger.info(f"Capturing years {[year for _, year in wave]} on {len(wave)} page(s)")
+            clicks = await asyncio.gather(*[click_year(wave_page, year) for wave_page, year in wave],
+                                          return_exceptions=True)
+            for (wave_page, year), updates_before in zip(wave, clicks):
+                if isinstance(updates_before, Exception):
+                    logger.error(f"Failed to select year {year}: {str(updates_before)}")
+                    screenshot_path = await select_year_and_screenshot(wave_page, year, referencia_catastral,
+                                                                       directory)
+                else:
+                    screenshot_path = await select_year_and_screenshot(wave_page, year, referencia_catastral,
+                                                                       directory, updates_before, clicked=True)
+                if not screenshot_path:
+                    continue
+                duplicate_of = await _off_loop(duplicates.check, year, screenshot_path) if duplicates else None
+                if duplicate_of and capture.CAPTURE_DEDUPE == 'drop':
+                    logger.warning(f"Dropping year {year}, identical to {duplicate_of} (imagery not loaded)")
+                    await _off_loop(os.remove, screenshot_path)
+                    progress(f"Dropped year {year}")
+                    if on_capture:
+                        await _off_loop(on_capture, year, None, duplicate_of)
+                    continue
+                if duplicate_of:
+                    logger.warning(f"Year {year} looks identical to {duplicate_of}, its imagery may not have loaded")
+                captured[year] = screenshot_path
+                progress(f"Captured year {year}")
+                if on_capture:
+                    # Usually stores the photo in the result cache (move and hash)
+                    await _off_loop(on_capture, year, screenshot_path, duplicate_of)
+    finally:
+        for loaded in loading:
+            loaded.cancel()
+        for extra_page in extra_pages:
+            try:
+                await extra_page.close()
+            except Exception:
+                pass
+    request_filter.log_summary(page, f"Aerial photos for {referencia_catastral}")
+    return [captured[year] for year in years if year in captured]
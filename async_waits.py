@@ -0,0 +1,91 @@
+"""
+The condition-based waits of waits.py for async_playwright pages.
+
+Same names, timeouts and statistics as the synchronous versions (they are
+recorded in waits.wait_stats), so /stats compares both engines side by side.
+"""
+import logging
+import re
+import time
+
+from waits import MAP_HOOK_SCRIPT, MAP_UPDATED_SCRIPT, _ms, wait_stats
+
+logger = logging.getLogger(__name__)
+
+
+async def _timed_wait(name, legacy_sleep, wait):
+    """Await wait(), record its duration and return False instead of raising on timeout"""
+    started = time.monotonic()
+    ok = True
+    try:
+        await wait()
+    except Exception as e:
+        ok = False
+        logger.warning(f"Wait '{name}' gave up after {time.monotonic() - started:.1f}s: {str(e)}")
+    elapsed = time.monotonic() - started
+    wait_stats.record(name, elapsed, ok, legacy_sleep)
+    logger.info(f"Wait '{name}' took {elapsed:.2f}s (was a fixed {legacy_sleep}s sleep)")
+    return ok
+
+
+async def install_map_hooks(page):
+    """Register the update-end counter; must be called before page.goto"""
+    await page.add_init_script(MAP_HOOK_SCRIPT)
+
+
+async def wait_for_visible(page, selector, name, timeout=None, legacy_sleep=0, nth=0):
+    return await _timed_wait(name, legacy_sleep, lambda: page.locator(selector).nth(nth).wait_for(
+        state="visible", timeout=_ms(timeout)))
+
+
+async def wait_for_hidden(page, selector, name, timeout=None, legacy_sleep=0):
+    return await _timed_wait(name, legacy_sleep, lambda: page.locator(selector).first.wait_for(
+        state="hidden", timeout=_ms(timeout)))
+
+
+async def wait_for_function(page, expression, name, arg=None, timeout=None, legacy_sleep=0):
+    return await _timed_wait(name, legacy_sleep, lambda: page.wait_for_function(
+        expression, arg=arg, timeout=_ms(timeout)))
+
+
+async def wait_for_response(page, url_pattern, action, name, timeout=None, legacy_sleep=0):
+    """Await action() and wait for a response whose URL matches url_pattern"""
+    pattern = re.compile(url_pattern, re.IGNORECASE)
+
+    async def wait():
+        async with page.expect_response(lambda response: bool(pattern.search(response.url)),
+                                        timeout=_ms(timeout)):
+            await action()
+    return await _timed_wait(name, legacy_sleep, wait)
+
+
+async def wait_for_network_idle(page, name, timeout=None, legacy_sleep=0):
+    return await _timed_wait(name, legacy_sleep, lambda: page.wait_for_load_state(
+        "networkidle", timeout=_ms(timeout)))
+
+
+async def map_update_count(page):
+    try:
+        return await page.evaluate("() => window.__ideibMapHooked ? window.__ideibMapUpdates : null")
+    except Exception:
+        return None
+
+
+async def start_map_update(page, action):
+    """Await action() without waiting for the map; returns the count for finish_map_update"""
+    before = await map_update_count(page)
+    await action()
+    return before
+
+
+async def finish_map_update(page, before, name, timeout=None, legacy_sleep=0):
+    if before is None:
+        return await wait_for_network_idle(page, name, timeout=timeout, legacy_sleep=legacy_sleep)
+    return await wait_for_function(page, MAP_UPDATED_SCRIPT, name, arg=before,
+                                   timeout=timeout, legacy_sleep=legacy_sleep)
+
+
+async def wait_for_map_update(page, action, name, timeout=None, legacy_sleep=0):
+    """Await action() and wait for the map to finish drawing (network idle if unhooked)"""
+    before = await start_map_update(page, action)
+    return await finish_map_update(page, before, name, timeout=timeout, legacy_sleep=legacy_sleep)
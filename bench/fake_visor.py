@@ -0,0 +1,262 @@
+"""
+Local stand-in for the IDEIB visor and the services the flows call.
+
+Serves a static visor (bench/visor_static) with the selectors the flows
+drive, map tiles, a per-year orthophoto WMS, the ArcGIS ExportWebMap print
+task (submitJob, execute, job status and Output_File) with a fixed PDF, and
+the Catastro WFS and OVC coordinate lookups. Every service sleeps for a configurable latency so
+slow upstreams can be reproduced:
+
+    python bench/fake_visor.py --port 8765 --latency print=5 --latency tile=0.2
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'visor_static')
+PRINT_TASK_PATH = '/geoserveis/rest/services/Utilities/PrintingTools/GPServer/Export%20Web%20Map%20Task'
+
+# Seconds each service takes to answer
+DEFAULT_LATENCY = {
+    'page': 0.5,     # visor HTML
+    'map': 0.5,      # from page load to the map being created
+    'search': 0.3,   # add-data layer search
+    'locate': 0.5,   # cadastre lookup
+    'tile': 0.05,    # each map tile
+    'print': 3.0,    # print job, from submission to success
+    'catastro': 0.3, # Catastro WFS / OVC lookups
+}
+
+
+def png(width, height, rgb):
+    """A solid-colour PNG"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    row = b'\x00' + bytes(rgb) * width
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * height))
+            + chunk(b'IEND', b''))
+
+
+def pdf(title):
+    """A one-page PDF showing title"""
+    stream = f'BT /F1 24 Tf 72 720 Td ({title}) Tj ET'.encode('latin-1')
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
+
+
+def parcel_box(reference):
+    """A deterministic 40x40 m parcel in Mallorca for any reference"""
+    digest = hashlib.sha1(reference[:14].upper().encode('utf-8')).digest()
+    x = 460000 + int.from_bytes(digest[:4], 'big') % 60000
+    y = 4370000 + int.from_bytes(digest[4:8], 'big') % 50000
+    return x, y, x + 40, y + 40
+
+
+class FakeVisor:
+    """Latencies and print job bookkeeping shared by the request handlers"""
+
+    def __init__(self, latency=None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.pdf = pdf('Mapa IDEIB')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def sleep(self, name):
+        time.sleep(self.latency.get(name, 0))
+
+    def submit_job(self):
+        with self._lock:
+            job_id = f'j{len(self._jobs) + 1:06d}'
+            self._jobs[job_id] = time.monotonic()
+        return job_id
+
+    def job_status(self, job_id):
+        with self._lock:
+            submitted = self._jobs.get(job_id)
+        if submitted is None:
+            return 'esriJobFailed'
+        if time.monotonic() - submitted < self.latency['print']:
+            return 'esriJobExecuting'
+        return 'esriJobSucceeded'
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'FakeVisor/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def visor(self):
+        return self.server.visor
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data, status=200):
+        self._send(json.dumps(data).encode('utf-8'), 'application/json', status)
+
+    def _base_url(self):
+        return f'http://{self.headers.get("Host")}'
+
+    def do_GET(self):
+        self.visor.requests += 1
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        if path in ('/visor', '/visor/', '/visor/index.html'):
+            self.visor.sleep('page')
+            with open(os.path.join(STATIC_DIR, 'index.html'), encoding='utf-8') as f:
+                html = f.read().replace('__LATENCY__', json.dumps(self.visor.latency))
+            return self._send(html.encode('utf-8'), 'text/html; charset=utf-8')
+        if path in ('/visor/visor.js', '/visor/visor.css'):
+            with open(os.path.join(STATIC_DIR, os.path.basename(path)), 'rb') as f:
+                body = f.read()
+            kind = 'application/javascript' if path.endswith('.js') else 'text/css'
+            return self._send(body, kind)
+        if path.startswith('/visor/') and path.endswith('.png'):
+            return self._send(png(24, 24, (40, 90, 160)), 'image/png')
+        if path == '/visor/locate':
+            self.visor.sleep('locate')
+            xmin, ymin, xmax, ymax = parcel_box(query.get('rc', ''))
+            return self._json({'extent': {'xmin': xmin - 200, 'ymin': ymin - 200,
+                                          'xmax': xmax + 200, 'ymax': ymax + 200}})
+        match = re.match(r'^/tile/(\d+)/(\d+)/(\d+)$', path)
+        if match:
+            self.visor.sleep('tile')
+            colour = hashlib.md5(f"{query.get('layer')}{path}".encode('utf-8')).digest()[:3]
+            return self._send(png(256, 256, colour), 'image/png')
+        match = re.match(r'^/wms/(\d{4})$', path)
+        if match:
+            # Orthophoto WMS for the tile engine, one solid colour per year and tile
+            self.visor.sleep('tile')
+            width, height = int(query.get('WIDTH', 256)), int(query.get('HEIGHT', 256))
+            colour = hashlib.md5(f"{match.group(1)}{query.get('BBOX')}".encode('utf-8')).digest()[:3]
+            return self._send(png(width, height, colour), 'image/png')
+        if path.startswith(f'{PRINT_TASK_PATH}/jobs/'):
+            parts = path[len(PRINT_TASK_PATH) + len('/jobs/'):].split('/')
+            job_id = parts[0]
+            if len(parts) == 1:
+                return self._json({'jobId': job_id, 'jobStatus': self.visor.job_status(job_id)})
+            return self._json({'paramName': 'Output_File',
+                               'value': {'url': f'{self._base_url()}/output/{job_id}.pdf'}})
+        if path.startswith('/output/') and path.endswith('.pdf'):
+            return self._send(self.visor.pdf, 'application/pdf')
+        if path == '/catastro/wfs':
+            self.visor.sleep('catastro')
+            xmin, ymin, xmax, ymax = parcel_box(query.get('refcat', ''))
+            ring = f'{xmin} {ymin} {xmax} {ymin} {xmax} {ymax} {xmin} {ymax} {xmin} {ymin}'
+            gml = ('<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+                   'xmlns:gml="http://www.opengis.net/gml/3.2"><wfs:member><gml:posList>'
+                   f'{ring}</gml:posList></wfs:member></wfs:FeatureCollection>')
+            return self._send(gml.encode('utf-8'), 'text/xml')
+        if path == '/catastro/coordinates':
+            self.visor.sleep('catastro')
+            xmin, ymin, xmax, ymax = parcel_box(query.get('RC', ''))
+            xml = (f'<consulta_coordenadas><coord><geo><xcen>{(xmin + xmax) / 2}</xcen>'
+                   f'<ycen>{(ymin + ymax) / 2}</ycen></geo></coord></consulta_coordenadas>')
+            return self._send(xml.encode('utf-8'), 'text/xml')
+        self._json({'error': 'Not found'}, 404)
+
+    def do_POST(self):
+        self.visor.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path == f'{PRINT_TASK_PATH}/submitJob':
+            return self._json({'jobId': self.visor.submit_job(), 'jobStatus': 'esriJobSubmitted'})
+        if path == f'{PRINT_TASK_PATH}/execute':
+            self.visor.sleep('print')
+            job_id = self.visor.submit_job()
+            return self._json({'results': [{'paramName': 'Output_File',
+                                            'value': {'url': f'{self._base_url()}/output/{job_id}.pdf'}}]})
+        self._json({'error': 'Not found'}, 404)
+
+
+def start(port=0, latency=None):
+    """Serve the stand-in visor from a background thread; returns the server"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.visor = FakeVisor(latency)
+    threading.Thread(target=server.serve_forever, name='fake-visor', daemon=True).start()
+    return server
+
+
+def base_url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def service_environment(server):
+    """Environment pointing both flows and the direct print engine at server"""
+    url = base_url(server)
+    return {
+        'IDEIB_VISOR_URL': f'{url}/visor/',
+        'IDEIB_PRINT_URL': f'{url}{PRINT_TASK_PATH}',
+        'CATASTRO_WFS_URL': f'{url}/catastro/wfs',
+        'CATASTRO_COORDINATES_URL': f'{url}/catastro/coordinates',
+        'AERIAL_WMS_URL': f'{url}/wms/{{year}}',
+    }
+
+
+def parse_latency(values):
+    """['print=5', 'tile=0.2'] -> {'print': 5.0, 'tile': 0.2}"""
+    latency = {}
+    for value in values or []:
+        name, _, seconds = value.partition('=')
+        if name not in DEFAULT_LATENCY:
+            raise ValueError(f"Unknown latency '{name}', expected one of: {', '.join(DEFAULT_LATENCY)}")
+        latency[name] = float(seconds)
+    return latency
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Serve the stand-in IDEIB visor')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', action='append', metavar='NAME=SECONDS',
+                        help=f"Override a latency ({', '.join(DEFAULT_LATENCY)})")
+    args = parser.parse_args()
+    server = start(args.port, parse_latency(args.latency))
+    for name, value in service_environment(server).items():
+        print(f'{name}={value}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,278 @@
+"""
+Offline benchmark of the flood PDF and aerial photo flows.
+
+Runs get_flood_area_pdf or get_aerial_photos against the stand-in visor
+(bench/fake_visor.py) at one or more concurrency levels and records, per
+level, end-to-end latency, throughput and the per-step latencies from the
+Prometheus step histograms, plus the peak RSS of Python and the browsers.
+Results are written as JSON named after the current commit, so two runs
+can be compared:
+
+    python bench/run_benchmark.py run --flow pdf --requests 6 --concurrency 1,2
+    python bench/run_benchmark.py compare bench/results/a.json bench/results/b.json
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import fake_visor
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'bench', 'results')
+FLOWS = {
+    'pdf': ('pdf-inundaciones-ideib.py', 'get_flood_area_pdf'),
+    'aerial': ('fotos-aereas-ideib.py', 'get_aerial_photos'),
+}
+RSS_SAMPLE_INTERVAL = 0.5
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def load_app(flow):
+    """Import a flow's app module (the file names are not valid module names)"""
+    filename, function = FLOWS[flow]
+    sys.path.insert(0, REPO_DIR)
+    spec = importlib.util.spec_from_file_location(f'bench_{flow}_app', os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, getattr(module, function)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(values):
+    return {
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'max': max(values) if values else None,
+    }
+
+
+def step_totals(metrics):
+    """{step: [count, seconds, failures]} from the step metrics so far"""
+    totals = {}
+    for family in metrics.STEP_SECONDS.collect():
+        for sample in family.samples:
+            name = sample.labels['step']
+            if sample.name.endswith('_count'):
+                totals.setdefault(name, [0, 0.0, 0])[0] = sample.value
+            elif sample.name.endswith('_sum'):
+                totals.setdefault(name, [0, 0.0, 0])[1] = sample.value
+    for family in metrics.STEP_TOTAL.collect():
+        for sample in family.samples:
+            if sample.name.endswith('_total') and sample.labels['outcome'] == 'failure':
+                totals.setdefault(sample.labels['step'], [0, 0.0, 0])[2] = sample.value
+    return totals
+
+
+def step_deltas(before, after):
+    steps = {}
+    for name, (count, seconds, failures) in after.items():
+        count_before, seconds_before, failures_before = before.get(name, (0, 0.0, 0))
+        count -= count_before
+        if count:
+            steps[name] = {'count': int(count), 'mean_seconds': (seconds - seconds_before) / count,
+                           'failures': int(failures - failures_before)}
+    return steps
+
+
+class RssSampler(threading.Thread):
+    """Tracks the peak RSS of this process and of the browsers it started"""
+
+    def __init__(self, metrics):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.metrics = metrics
+        self.peak = {'python_bytes': 0, 'browsers_bytes': 0, 'total_bytes': 0}
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(RSS_SAMPLE_INTERVAL):
+            python_rss = self.metrics.rss_bytes(os.getpid())
+            browsers_rss = self.metrics.browser_memory()['rss_bytes']
+            self.peak['python_bytes'] = max(self.peak['python_bytes'], python_rss)
+            self.peak['browsers_bytes'] = max(self.peak['browsers_bytes'], browsers_rss)
+            self.peak['total_bytes'] = max(self.peak['total_bytes'], python_rss + browsers_rss)
+
+    def stop(self):
+        self._halt.set()
+
+
+def run_level(render, metrics, flow, concurrency, requests, engine):
+    """Render `requests` distinct references with `concurrency` callers at once"""
+    references = [f'{concurrency:02d}BENCH{index:07d}' for index in range(requests)]
+    kwargs = {'engine': engine}
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def one(reference):
+        nonlocal failures
+        started = time.monotonic()
+        ok = bool(render(reference, **kwargs))
+        elapsed = time.monotonic() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                failures += 1
+
+    steps_before = step_totals(metrics)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, references))
+    wall = time.monotonic() - started
+    logger.info(f"Concurrency {concurrency}: {len(latencies)}/{requests} succeeded in {wall:.1f}s")
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'succeeded': len(latencies),
+        'failed': failures,
+        'wall_seconds': wall,
+        'throughput_per_minute': 60 * len(latencies) / wall if wall else 0.0,
+        'latency_seconds': latency_summary(latencies),
+        'steps': step_deltas(steps_before, step_totals(metrics)),
+    }
+
+
+def run(args):
+    latency = fake_visor.parse_latency(args.latency)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    workdir = tempfile.mkdtemp(prefix='ideib_bench_')
+    server = None
+    if args.visor_url:
+        os.environ['IDEIB_VISOR_URL'] = args.visor_url
+    else:
+        server = fake_visor.start(latency=latency)
+        os.environ.update(fake_visor.service_environment(server))
+    # Fresh state in a scratch directory, one browser per concurrent caller
+    os.environ.update({
+        'PARCEL_INDEX_PATH': os.path.join(workdir, 'parcels.sqlite'),
+        'RESULT_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'ASSET_CACHE_DIR': os.path.join(workdir, 'asset_cache'),
+        'BROWSER_POOL_SIZE': str(max(levels)),
+        'BROWSER_HEADLESS': '1',
+        # The benchmark warms up on its own (--warmup)
+        'WARMUP': '0',
+    })
+    os.chdir(workdir)
+
+    app, render = load_app(args.flow)
+    import metrics  # Loaded by the app from REPO_DIR
+    sampler = RssSampler(metrics)
+    sampler.start()
+    results = []
+    try:
+        if args.warmup:
+            logger.info("Warming up the browser pool...")
+            render('00WARMUP0000000', engine=args.engine)
+        for level in levels:
+            results.append(run_level(render, metrics, args.flow, level, args.requests, args.engine))
+    finally:
+        sampler.stop()
+        app.browser_pool.shutdown()
+        app.async_engine.shutdown()
+        if server is not None:
+            server.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(),
+        'flow': args.flow,
+        'engine': args.engine,
+        'visor': args.visor_url or 'fake',
+        'latency': server.visor.latency if server is not None else None,
+        'levels': results,
+        'peak_rss': sampler.peak,
+        'waits': app.waits.wait_stats.snapshot(),
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{report['commit']}_{args.flow}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {path}")
+    for level in results:
+        print(f"  concurrency {level['concurrency']}: {level['succeeded']}/{level['requests']} ok, "
+              f"mean {level['latency_seconds']['mean'] or 0:.2f}s, p95 {level['latency_seconds']['p95'] or 0:.2f}s, "
+              f"{level['throughput_per_minute']:.1f}/min")
+    print(f"  peak RSS {sampler.peak['total_bytes'] / 1024 / 1024:.0f} MiB")
+
+
+def _change(old, new):
+    if old in (None, 0) or new is None:
+        return ''
+    return f'{100 * (new - old) / old:+.1f}%'
+
+
+def compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+    print(f"{baseline['commit']} -> {candidate['commit']} ({candidate['flow']})")
+    old_levels = {level['concurrency']: level for level in baseline['levels']}
+    for level in candidate['levels']:
+        old = old_levels.get(level['concurrency'])
+        if old is None:
+            continue
+        print(f"concurrency {level['concurrency']}:")
+        for key in ('mean', 'p95'):
+            a, b = old['latency_seconds'][key], level['latency_seconds'][key]
+            print(f"  latency {key:<4} {a or 0:8.2f}s -> {b or 0:8.2f}s {_change(a, b)}")
+        a, b = old['throughput_per_minute'], level['throughput_per_minute']
+        print(f"  throughput   {a:8.1f}  -> {b:8.1f}  /min {_change(a, b)}")
+        for step in sorted(set(old['steps']) | set(level['steps'])):
+            a = old['steps'].get(step, {}).get('mean_seconds')
+            b = level['steps'].get(step, {}).get('mean_seconds')
+            print(f"  {step:<28} {a or 0:8.2f}s -> {b or 0:8.2f}s {_change(a, b)}")
+    a, b = baseline['peak_rss']['total_bytes'], candidate['peak_rss']['total_bytes']
+    print(f"peak RSS {a / 1024 / 1024:.0f} MiB -> {b / 1024 / 1024:.0f} MiB {_change(a, b)}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description='Benchmark the browser flows against the stand-in visor')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the benchmark and write a JSON report')
+    run_parser.add_argument('--flow', choices=sorted(FLOWS), default='pdf')
+    run_parser.add_argument('--engine', choices=('browser', 'direct', 'tiles'), default='browser',
+                            help="'direct' applies to the pdf flow, 'tiles' to the aerial flow")
+    run_parser.add_argument('--requests', type=int, default=4, help='References rendered per concurrency level')
+    run_parser.add_argument('--concurrency', default='1', help='Comma-separated concurrency levels, e.g. 1,2,4')
+    run_parser.add_argument('--latency', action='append', metavar='NAME=SECONDS',
+                            help=f"Stand-in visor latency override ({', '.join(fake_visor.DEFAULT_LATENCY)})")
+    run_parser.add_argument('--visor-url', help='Benchmark another visor instead of starting the stand-in')
+    run_parser.add_argument('--no-warmup', dest='warmup', action='store_false',
+                            help='Include the first browser launch in the measurements')
+    run_parser.add_argument('--output', default=RESULTS_DIR)
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
@@ -0,0 +1,171 @@
+// Stand-in for the IDEIB Web AppBuilder visor. Reproduces the DOM the flows
+// drive and a minimal esri map (window._viewerMap with update-end events,
+// setExtent and the AMD require used to build extents), with the latencies
+// configured on the server in window.FAKE_LATENCY (seconds).
+(function () {
+    const latency = (name) => ((window.FAKE_LATENCY || {})[name] || 0) * 1000;
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+    const PRINT_TASK = '/geoserveis/rest/services/Utilities/PrintingTools/GPServer/Export%20Web%20Map%20Task';
+    const YEARS = [1956, 1984, 1989, 2001, 2002, 2006, 2008, 2010, 2012, 2015, 2018, 2021, 2023];
+    const LAYERS = ['Xarxa Hidrogràfica i Risc Inundació de les Illes Balears', 'Zones inundables de les Illes Balears'];
+
+    function Extent(xmin, ymin, xmax, ymax, spatialReference) {
+        this.xmin = xmin; this.ymin = ymin; this.xmax = xmax; this.ymax = ymax;
+        this.spatialReference = spatialReference || new SpatialReference({wkid: 25831});
+    }
+    function SpatialReference(options) { this.wkid = options.wkid; }
+    const modules = {'esri/geometry/Extent': Extent, 'esri/SpatialReference': SpatialReference};
+    window.require = (names, callback) => setTimeout(() => callback(...names.map((name) => modules[name])), 0);
+
+    class FakeMap {
+        constructor(tiles) {
+            this.tiles = tiles;
+            this.spatialReference = new SpatialReference({wkid: 25831});
+            this.extent = new Extent(440000, 4350000, 540000, 4430000, this.spatialReference);
+            this.zoom = 8;
+            this.basemap = 'topo';
+            this.layers = [];
+            this.updating = false;
+            this._listeners = {};
+            this._token = 0;
+        }
+
+        on(event, listener) {
+            (this._listeners[event] = this._listeners[event] || []).push(listener);
+            return {remove: () => { this._listeners[event] = this._listeners[event].filter((l) => l !== listener); }};
+        }
+
+        _emit(event) {
+            (this._listeners[event] || []).slice().forEach((listener) => listener({}));
+        }
+
+        // Redraw the tiles and fire update-end once they have all loaded
+        update() {
+            const token = ++this._token;
+            this.updating = true;
+            this._emit('update-start');
+            this.tiles.innerHTML = '';
+            const loads = [];
+            for (let row = 0; row < 4; row++) {
+                for (let col = 0; col < 5; col++) {
+                    const img = document.createElement('img');
+                    loads.push(new Promise((resolve) => { img.onload = img.onerror = resolve; }));
+                    const x = Math.round(this.extent.xmin / 100) + col;
+                    const y = Math.round(this.extent.ymin / 100) + row;
+                    img.src = `/tile/${this.zoom}/${y}/${x}?layer=${encodeURIComponent(this.basemap)}`;
+                    this.tiles.appendChild(img);
+                }
+            }
+            return Promise.all(loads).then(() => {
+                if (token !== this._token) return;
+                this.updating = false;
+                this._emit('update-end');
+            });
+        }
+
+        setExtent(extent) {
+            this.extent = new Extent(extent.xmin, extent.ymin, extent.xmax, extent.ymax, this.spatialReference);
+            return this.update();
+        }
+
+        zoomIn() {
+            const e = this.extent;
+            const dx = (e.xmax - e.xmin) / 4, dy = (e.ymax - e.ymin) / 4;
+            this.zoom += 1;
+            return this.setExtent({xmin: e.xmin + dx, ymin: e.ymin + dy, xmax: e.xmax - dx, ymax: e.ymax - dy});
+        }
+    }
+
+    const $ = (selector) => document.querySelector(selector);
+    const show = (element, visible) => { element.hidden = !visible; };
+
+    async function searchLayers() {
+        const results = $('#addDataResults');
+        results.innerHTML = '';
+        await sleep(latency('search'));
+        const term = $('[data-dojo-attach-point="searchTextBox"]').value.toLowerCase();
+        LAYERS.filter((title) => title.toLowerCase().includes(term)).forEach((title) => {
+            const card = document.createElement('div');
+            card.className = 'item-card-inner';
+            card.innerHTML = `<h3 class="title"></h3><div class="btn" data-dojo-attach-point="addButton">Afegir</div>`;
+            card.querySelector('h3').textContent = title;
+            card.querySelector('[data-dojo-attach-point="addButton"]').addEventListener('click', () => {
+                window._viewerMap.layers.push(title);
+                const item = document.createElement('li');
+                item.textContent = title;
+                $('#layers').appendChild(item);
+                window._viewerMap.update();
+            });
+            results.appendChild(card);
+        });
+    }
+
+    async function locateParcel() {
+        const reference = $('#RC').value.trim();
+        const response = await fetch(`/visor/locate?rc=${encodeURIComponent(reference)}`);
+        if (!response.ok) return;
+        const parcel = await response.json();
+        await window._viewerMap.setExtent(parcel.extent);
+    }
+
+    async function printMap() {
+        const map = window._viewerMap;
+        const body = new URLSearchParams({
+            Web_Map_as_JSON: JSON.stringify({mapOptions: {extent: map.extent}, operationalLayers: map.layers}),
+            Format: 'PDF', Layout_Template: 'A4 Portrait', f: 'json',
+        });
+        const job = await (await fetch(`${PRINT_TASK}/submitJob`, {method: 'POST', body})).json();
+        let status = job.jobStatus;
+        while (status !== 'esriJobSucceeded') {
+            if (status === 'esriJobFailed') return;
+            await sleep(250);
+            status = (await (await fetch(`${PRINT_TASK}/jobs/${job.jobId}?f=json`)).json()).jobStatus;
+        }
+        const result = await (await fetch(`${PRINT_TASK}/jobs/${job.jobId}/results/Output_File?f=json`)).json();
+        const link = document.createElement('a');
+        link.href = result.value.url;
+        link.download = 'Mapa IDEIB.pdf';
+        link.textContent = 'Mapa IDEIB';
+        $('#printResults').appendChild(link);
+    }
+
+    function listYears() {
+        const years = $('#years');
+        years.innerHTML = '';
+        YEARS.forEach((year) => {
+            const span = document.createElement('span');
+            span.textContent = String(year);
+            span.addEventListener('click', () => {
+                window._viewerMap.basemap = `ortofoto_${year}`;
+                window._viewerMap.update();
+            });
+            years.appendChild(span);
+        });
+        show(years, true);
+    }
+
+    document.addEventListener('DOMContentLoaded', () => {
+        const map = new FakeMap($('#tiles'));
+        // The real visor creates the map a moment after the page has loaded
+        setTimeout(() => { window._viewerMap = map; map.update(); }, latency('map'));
+
+        $('[data-dojo-attach-point="okNode"]').addEventListener('click', () => show($('#modal'), false));
+        $('.bar.max').addEventListener('click', () => $('.left-column').classList.toggle('collapsed'));
+
+        $('[data-dojo-attach-point="btnAddData"]').addEventListener('click', () => show($('#addDataPanel'), true));
+        $('[data-dojo-attach-point="searchButton"]').addEventListener('click', searchLayers);
+        $('.close-btn[data-dojo-attach-point="closeNode"]').addEventListener('click', () => show($('#addDataPanel'), false));
+
+        $('img.icon[src*="ideibLocate"]').parentElement.addEventListener('click', () => show($('#locatePanel'), true));
+        $('.tab[label="Cadastre"]').addEventListener('click', () => show($('#cadastreTab'), true));
+        $('[data-dojo-attach-point="btnRefCat"]').addEventListener('click', locateParcel);
+        $('.close-icon[data-dojo-attach-point="closeNode"]').addEventListener('click', () => show($('#locatePanel'), false));
+
+        $('[data-dojo-attach-point="btnZoomIn"]').addEventListener('click', () => map.zoomIn());
+
+        $('img.icon[src*="ideibPrint"]').parentElement.addEventListener('click', () => show($('#printPanel'), true));
+        $('[data-dojo-attach-point="printButtonDijit"]').addEventListener('click', printMap);
+
+        $('img[alt="Fotografies històriques de totes les illes"]').addEventListener('click', listYears);
+    });
+})();
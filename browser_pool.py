@@ -0,0 +1,390 @@
+"""
+Process-wide pool of warm Chromium browsers.
+
+Playwright's sync API objects can only be used from the thread that created
+them, so each browser lives in its own worker thread. Callers hand a job to
+the pool and the next free worker runs it against a fresh browser context,
+keeping the expensive Chromium launch out of the request path.
+
+A pool can also be given a primer: a function that brings a page to a state
+every job starts from (e.g. the visor with the flood layer loaded). Workers
+keep one primed page on standby and refill it while idle, so jobs skip the
+fixed part of the flow.
+
+With BROWSER_CDP_URL set (see browser_server.py) the workers connect to
+one shared Chromium over CDP instead of launching their own, so several
+gunicorn workers can share a browser that outlives them.
+
+A recycle_check(pool) callable, if given, is asked after every job whether
+the browser that ran it should be closed and relaunched (e.g. because it
+has grown too large). Browsers are also recycled after max_jobs jobs.
+Neither applies over CDP, where closing the connection leaves the shared
+Chromium running: each job holds a shared_browser_lease instead, and
+browser_server.py restarts an oversized Chromium while nobody holds one.
+"""
+import contextlib
+import fcntl
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from playwright.sync_api import sync_playwright
+
+import forensics
+
+logger = logging.getLogger(__name__)
+
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', 1))
+BROWSER_MAX_JOBS = int(os.environ.get('BROWSER_MAX_JOBS', 20))
+BROWSER_LEASE_TIMEOUT = float(os.environ.get('BROWSER_LEASE_TIMEOUT', 300))
+# Primed pages older than this are discarded, the visor session may have gone stale
+PRIMED_PAGE_MAX_AGE = float(os.environ.get('PRIMED_PAGE_MAX_AGE', 600))
+# Endpoint of a shared browser server to connect to instead of launching Chromium
+BROWSER_CDP_URL = os.environ.get('BROWSER_CDP_URL')
+# Locked by the jobs on the shared browser, so browser_server.py knows when it is idle
+BROWSER_SERVER_LOCK_FILE = os.environ.get('BROWSER_SERVER_LOCK_FILE',
+                                          os.path.join(tempfile.gettempdir(), 'ideib-browser-server.lock'))
+
+VIEWPORT = {"width": 1280, "height": 800}
+DEFAULT_PAGE_TIMEOUT = 60000  # 60 seconds
+
+
+class LeaseTimeout(Exception):
+    """Raised when no browser became free within the lease timeout"""
+
+
+@contextlib.contextmanager
+def shared_browser_lease(lock_file=BROWSER_SERVER_LOCK_FILE):
+    """
+    Shared lock held by a job on the shared Chromium. browser_server.py takes
+    it exclusively to restart the browser, so it never does so under a job
+    and new jobs wait until the browser is back.
+    """
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def chromium_launch_options(headless=True):
+    """Launch options shared by both flows, tuned for the Fly VM in production"""
+    is_production = os.environ.get('FLY_APP_NAME') is not None
+    return {
+        "headless": headless,
+        # Args for better containerized browser support and memory optimization
+        "args": [
+            "--disable-dev-shm-usage",
+            "--no-sandbox",
+            "--disable-setuid-sandbox",
+            "--disable-gpu",
+            "--disable-software-rasterizer",
+            "--single-process",
+            "--disable-extensions",
+            "--disable-popup-blocking"
+        ] if is_production else []
+    }
+
+
+_IDLE = object()
+
+
+def _close_quietly(context):
+    if context is None:
+        return
+    try:
+        context.close()
+    except Exception as e:
+        logger.error(f"Error closing context: {e}")
+
+
+class _Job:
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.started = threading.Event()
+        self.submitted_at = time.monotonic()
+
+
+class _BrowserWorker(threading.Thread):
+    """Owns one Playwright instance and one Chromium browser"""
+
+    def __init__(self, pool, index):
+        super().__init__(name=f"browser-pool-{index}", daemon=True)
+        self.pool = pool
+        self.index = index
+        self.browser = None
+        self.jobs_on_browser = 0
+        self.busy = False
+        self.standby = None  # (context, page, primed_at)
+
+    def run(self):
+        with sync_playwright() as p:
+            self.playwright = p
+            while True:
+                if self.browser is None:
+                    self._launch()
+                job = self._next_job()
+                if job is None:
+                    break
+                if job is not _IDLE:
+                    self._run_job(job)
+            self._close_browser()
+
+    def _next_job(self):
+        """Take the next job, priming a standby page first if the queue is empty"""
+        try:
+            return self.pool._jobs.get_nowait()
+        except queue.Empty:
+            pass
+        self._refill_standby()
+        try:
+            return self.pool._jobs.get(timeout=self.pool.primed_max_age if self.pool.primer else None)
+        except queue.Empty:
+            return _IDLE
+
+    def _new_page(self):
+        context = self.browser.new_context(viewport=self.pool.viewport)
+        page = context.new_page()
+        page.set_default_timeout(DEFAULT_PAGE_TIMEOUT)
+        forensics.attach(context, page)
+        return context, page
+
+    def _standby_is_fresh(self):
+        return (self.standby is not None
+                and time.monotonic() - self.standby[2] < self.pool.primed_max_age
+                and not self.standby[1].is_closed())
+
+    def _refill_standby(self):
+        if self.pool.primer is None or self.browser is None or self._standby_is_fresh():
+            return
+        self._discard_standby()
+        context = None
+        try:
+            started = time.monotonic()
+            context, page = self._new_page()
+            self.pool.primer(page)
+            self.standby = (context, page, time.monotonic())
+            self.pool._count('primes')
+            logger.info(f"Browser {self.index} primed a standby page in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            self.pool._count('prime_failures')
+            logger.error(f"Failed to prime standby page on browser {self.index}: {str(e)}")
+            _close_quietly(context)
+
+    def _discard_standby(self):
+        if self.standby is not None:
+            _close_quietly(self.standby[0])
+            self.standby = None
+
+    def _take_page(self):
+        """Hand out the standby page if it is still fresh, else a newly primed one"""
+        if self._standby_is_fresh():
+            context, page, _ = self.standby
+            self.standby = None
+            self.pool._count('primed_hits')
+            return context, page
+        self._discard_standby()
+        context, page = self._new_page()
+        if self.pool.primer is not None:
+            self.pool._count('primed_misses')
+            try:
+                self.pool.primer(page)
+            except Exception:
+                _close_quietly(context)
+                raise
+        return context, page
+
+    def _launch(self):
+        try:
+            started = time.monotonic()
+            if self.pool.cdp_url:
+                # Closing a connected browser only drops its contexts and disconnects
+                self.browser = self.playwright.chromium.connect_over_cdp(self.pool.cdp_url)
+                self.pool._count('connects')
+                logger.info(f"Browser {self.index} connected to {self.pool.cdp_url} "
+                            f"in {time.monotonic() - started:.1f}s")
+            else:
+                self.browser = self.playwright.chromium.launch(**self.pool.launch_options)
+                self.pool._count('launches')
+                logger.info(f"Browser {self.index} launched in {time.monotonic() - started:.1f}s")
+            self.jobs_on_browser = 0
+        except Exception as e:
+            self.browser = None
+            logger.error(f"Failed to launch browser {self.index}: {str(e)}")
+
+    def _close_browser(self):
+        self._discard_standby()
+        if self.browser is None:
+            return
+        try:
+            self.browser.close()
+        except Exception as e:
+            logger.error(f"Error closing browser {self.index}: {e}")
+        self.browser = None
+
+    def _run_job(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return  # The caller gave up waiting for a lease
+        job.started.set()
+        self.pool._record_wait(time.monotonic() - job.submitted_at)
+        with self.pool.server_lease():
+            self._run_leased_job(job)
+
+    def _run_leased_job(self, job):
+        if self.browser is None or not self.browser.is_connected():
+            self._close_browser()
+            self._launch()
+        if self.browser is None:
+            job.future.set_exception(RuntimeError("No browser available"))
+            return
+
+        self.busy = True
+        context = None
+        page = None
+        try:
+            context, page = self._take_page()
+            job.future.set_result(job.fn(page, *job.args, **job.kwargs))
+        except Exception as e:
+            forensics.step_failed(page, 'job', getattr(job.fn, '__name__', 'job'), str(e))
+            job.future.set_exception(e)
+        finally:
+            if page is not None:
+                try:
+                    page.close()
+                except Exception as e:
+                    logger.error(f"Error closing page: {e}")
+            if context is not None:
+                try:
+                    context.close()
+                except Exception as e:
+                    logger.error(f"Error closing context: {e}")
+            self.busy = False
+            self.pool._count('jobs')
+            self.jobs_on_browser += 1
+
+        if not self.browser.is_connected():
+            logger.warning(f"Browser {self.index} crashed, relaunching")
+            self.pool._count('crashes')
+            self._close_browser()
+        elif self.pool.recycling and self.jobs_on_browser >= self.pool.max_jobs:
+            logger.info(f"Recycling browser {self.index} after {self.jobs_on_browser} jobs")
+            self.pool._count('recycles')
+            self._close_browser()
+        elif self.pool.recycling and self.pool.recycle_check is not None and self._recycle_requested():
+            logger.info(f"Recycling browser {self.index} at the request of the recycle check")
+            self.pool._count('recycles')
+            self._close_browser()
+
+    def _recycle_requested(self):
+        try:
+            return self.pool.recycle_check(self.pool)
+        except Exception as e:
+            logger.error(f"Recycle check failed: {str(e)}")
+            return False
+
+
+class BrowserPool:
+    """Keeps `size` Chromium instances alive and runs jobs on fresh contexts"""
+
+    def __init__(self, launch_options=None, size=BROWSER_POOL_SIZE,
+                 max_jobs=BROWSER_MAX_JOBS, lease_timeout=BROWSER_LEASE_TIMEOUT,
+                 viewport=VIEWPORT, primer=None, primed_max_age=PRIMED_PAGE_MAX_AGE, recycle_check=None,
+                 cdp_url=BROWSER_CDP_URL):
+        self.launch_options = launch_options or chromium_launch_options()
+        self.size = max(1, size)
+        self.max_jobs = max(1, max_jobs)
+        self.lease_timeout = lease_timeout
+        self.viewport = viewport
+        self.primer = primer
+        self.primed_max_age = primed_max_age
+        self.recycle_check = recycle_check
+        self.cdp_url = cdp_url
+        # Disconnecting from a shared Chromium frees nothing, so it is never recycled
+        self.recycling = cdp_url is None
+        self._jobs = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._counters = {'jobs': 0, 'launches': 0, 'connects': 0, 'recycles': 0, 'crashes': 0, 'lease_timeouts': 0,
+                          'primes': 0, 'prime_failures': 0, 'primed_hits': 0, 'primed_misses': 0}
+        self._wait_total = 0.0
+        self._wait_count = 0
+
+    def start(self):
+        """Start the worker threads (and their browsers) if not already running"""
+        with self._lock:
+            if self._workers:
+                return
+            for index in range(self.size):
+                worker = _BrowserWorker(self, index)
+                worker.start()
+                self._workers.append(worker)
+            logger.info(f"Browser pool started with {self.size} browser(s)")
+            if not self.recycling:
+                logger.info(f"Connected to the shared Chromium at {self.cdp_url}, browsers are not recycled")
+
+    def shutdown(self):
+        """Stop the workers and close their browsers"""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run fn(page, *args, **kwargs) on a fresh context of a pooled browser
+        (already primed when the pool has a primer) and return its result. Raises LeaseTimeout if no browser is free in time.
+        """
+        self.start()
+        job = _Job(fn, args, kwargs)
+        self._jobs.put(job)
+        if not job.started.wait(self.lease_timeout) and job.future.cancel():
+            self._count('lease_timeouts')
+            raise LeaseTimeout(f"No browser free after {self.lease_timeout:.0f}s")
+        return job.future.result()
+
+    def server_lease(self):
+        """shared_browser_lease() on a shared Chromium, nothing to hold otherwise"""
+        if self.cdp_url:
+            return shared_browser_lease()
+        return contextlib.nullcontext()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _record_wait(self, seconds):
+        with self._lock:
+            self._wait_total += seconds
+            self._wait_count += 1
+
+    def stats(self):
+        """Pool utilisation snapshot for monitoring"""
+        with self._lock:
+            busy = sum(1 for worker in self._workers if worker.busy)
+            alive = sum(1 for worker in self._workers if worker.browser is not None)
+            standby = sum(1 for worker in self._workers if worker.standby is not None)
+            stats = dict(self._counters)
+            stats.update({
+                'size': self.size,
+                'alive': alive,
+                'busy': busy,
+                'queued': self._jobs.qsize(),
+                'standby_pages': standby,
+                'utilisation': busy / self.size,
+                'avg_lease_wait_seconds': self._wait_total / self._wait_count if self._wait_count else 0.0,
+                'max_jobs_per_browser': self.max_jobs,
+                'lease_timeout_seconds': self.lease_timeout,
+                'shared_server': self.cdp_url is not None,
+                'recycling': self.recycling,
+            })
+        return stats
@@ -0,0 +1,255 @@
+"""
+Long-lived Chromium the app server connects to over CDP.
+
+Run at boot in front of the app server (a single worker, see jobs.py):
+
+    python browser_server.py -- gunicorn --workers 1 --threads 16 pdf-inundaciones-ideib:app
+
+The supervisor starts Chromium with a remote debugging port, passes its
+endpoint to the command as BROWSER_CDP_URL (BrowserPool then connects to it
+instead of launching a browser, and each job gets its own context), checks
+/json/version every BROWSER_SERVER_HEALTH_INTERVAL seconds and restarts
+Chromium when it exits or stops answering. Without a command it only runs
+the browser, for apps started separately with BROWSER_CDP_URL set.
+
+The workers cannot recycle a browser they share, so the supervisor does:
+once Chromium's processes grow past BROWSER_SERVER_RECYCLE_MB it restarts
+it at the first health check where no job holds a shared_browser_lease.
+The workers reconnect on their next job.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import metrics
+from browser_pool import BROWSER_SERVER_LOCK_FILE, chromium_launch_options
+
+logger = logging.getLogger(__name__)
+
+BROWSER_SERVER_HOST = os.environ.get('BROWSER_SERVER_HOST', '127.0.0.1')
+BROWSER_SERVER_PORT = int(os.environ.get('BROWSER_SERVER_PORT', 9222))
+BROWSER_SERVER_HEADLESS = os.environ.get('BROWSER_SERVER_HEADLESS', '1') != '0'
+BROWSER_SERVER_HEALTH_INTERVAL = float(os.environ.get('BROWSER_SERVER_HEALTH_INTERVAL', 10))
+BROWSER_SERVER_MAX_FAILURES = int(os.environ.get('BROWSER_SERVER_MAX_FAILURES', 3))
+# Where the current Chromium pid is written, so the app can account for its memory
+BROWSER_SERVER_PID_FILE = os.environ.get('BROWSER_SERVER_PID_FILE',
+                                         os.path.join(tempfile.gettempdir(), 'ideib-browser-server.pid'))
+# 0 never restarts Chromium for its size
+BROWSER_SERVER_RECYCLE_MB = float(os.environ.get('BROWSER_SERVER_RECYCLE_MB',
+                                                 os.environ.get('GOVERNOR_BROWSER_RECYCLE_MB', 600)))
+STARTUP_TIMEOUT = 30
+MB = 1024 * 1024
+
+
+def chromium_executable():
+    """Path of the Chromium build installed by `playwright install chromium`"""
+    from playwright.sync_api import sync_playwright
+    with sync_playwright() as p:
+        return p.chromium.executable_path
+
+
+def healthy(endpoint, timeout=5):
+    """True if Chromium answers its DevTools version endpoint"""
+    try:
+        with urllib.request.urlopen(f'{endpoint}/json/version', timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+
+class BrowserServer:
+    """Runs one Chromium with remote debugging and keeps it alive"""
+
+    def __init__(self, host=BROWSER_SERVER_HOST, port=BROWSER_SERVER_PORT, headless=BROWSER_SERVER_HEADLESS,
+                 health_interval=BROWSER_SERVER_HEALTH_INTERVAL, max_failures=BROWSER_SERVER_MAX_FAILURES,
+                 pid_file=BROWSER_SERVER_PID_FILE, recycle_mb=BROWSER_SERVER_RECYCLE_MB,
+                 lock_file=BROWSER_SERVER_LOCK_FILE):
+        self.host = host
+        self.port = port
+        self.headless = headless
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.pid_file = pid_file
+        self.recycle_bytes = recycle_mb * MB
+        self.lock_file = lock_file
+        self.executable = None
+        self.process = None
+        self.restarts = 0
+        self.recycles = 0
+        self._recycle_pending = False
+        self._user_data_dir = None
+        self._halt = threading.Event()
+
+    @property
+    def endpoint(self):
+        return f'http://{self.host}:{self.port}'
+
+    def command(self):
+        args = [self.executable, f'--remote-debugging-address={self.host}', f'--remote-debugging-port={self.port}',
+                f'--user-data-dir={self._user_data_dir}', '--no-first-run', '--no-default-browser-check']
+        if self.headless:
+            args.append('--headless=new')
+        # Same tuning as the browsers the pool launches itself
+        args.extend(chromium_launch_options(self.headless)['args'])
+        args.append('about:blank')
+        return args
+
+    def start(self):
+        """Launch Chromium and wait until its endpoint answers"""
+        if self.executable is None:
+            self.executable = chromium_executable()
+        self._user_data_dir = tempfile.mkdtemp(prefix='ideib-chromium-')
+        started = time.monotonic()
+        self.process = subprocess.Popen(self.command(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while not healthy(self.endpoint, timeout=1):
+            if self.process.poll() is not None or time.monotonic() - started > STARTUP_TIMEOUT:
+                self._kill()
+                raise RuntimeError(f"Chromium did not start on {self.endpoint}")
+            time.sleep(0.2)
+        try:
+            with open(self.pid_file, 'w') as f:
+                f.write(str(self.process.pid))
+        except OSError as e:
+            logger.warning(f"Could not write {self.pid_file}: {str(e)}")
+        logger.info(f"Browser server listening on {self.endpoint} (pid {self.process.pid}) "
+                    f"after {time.monotonic() - started:.1f}s")
+
+    def _kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+        if self._user_data_dir:
+            shutil.rmtree(self._user_data_dir, ignore_errors=True)
+            self._user_data_dir = None
+
+    def restart(self):
+        self.restarts += 1
+        self._kill()
+        delay = min(30, 2 ** min(self.restarts, 5))
+        while not self._halt.is_set():
+            try:
+                self.start()
+                return
+            except Exception as e:
+                logger.error(f"Failed to restart the browser server, retrying in {delay}s: {str(e)}")
+                self._halt.wait(delay)
+
+    def rss_bytes(self):
+        """Resident memory of Chromium and every process it started"""
+        if self.process is None:
+            return 0
+        pids = [self.process.pid] + metrics.descendant_pids(self.process.pid)
+        return sum(metrics.rss_bytes(pid) for pid in pids)
+
+    def recycle_if_idle(self):
+        """Restart Chromium if it is past recycle_mb and no job holds a lease; True if it was restarted"""
+        if not self.recycle_bytes:
+            return False
+        size = self.rss_bytes()
+        if size <= self.recycle_bytes:
+            self._recycle_pending = False
+            return False
+        with open(self.lock_file, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not self._recycle_pending:
+                    logger.info(f"Browser server at {size / MB:.0f} MB, restarting it once no job is running")
+                    self._recycle_pending = True
+                return False
+            try:
+                logger.warning(f"Browser server at {size / MB:.0f} MB and idle, restarting it")
+                self.recycles += 1
+                self._recycle_pending = False
+                self._kill()
+                try:
+                    self.start()
+                except Exception as e:
+                    logger.error(f"Failed to start the browser server after recycling it: {str(e)}")
+                    self.restart()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return True
+
+    def supervise(self):
+        """Health-check until stop(), restarting Chromium when it exits or stops answering"""
+        failures = 0
+        while not self._halt.wait(self.health_interval):
+            if self.process is None or self.process.poll() is not None:
+                logger.warning("Browser server exited, restarting")
+                failures = 0
+                self.restart()
+            elif healthy(self.endpoint):
+                failures = 0
+                self.recycle_if_idle()
+            else:
+                failures += 1
+                logger.warning(f"Browser server health check failed ({failures}/{self.max_failures})")
+                if failures >= self.max_failures:
+                    failures = 0
+                    self.restart()
+
+    def stop(self):
+        self._halt.set()
+        self._kill()
+        try:
+            os.remove(self.pid_file)
+        except OSError:
+            pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Run a shared Chromium for the app workers')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='App server to run with BROWSER_CDP_URL set (after --)')
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+
+    server = BrowserServer()
+    server.start()
+    supervisor = threading.Thread(target=server.supervise, name='browser-server', daemon=True)
+    supervisor.start()
+
+    child = None
+    if command:
+        env = dict(os.environ, BROWSER_CDP_URL=server.endpoint, BROWSER_SERVER_PID_FILE=server.pid_file,
+                   BROWSER_SERVER_LOCK_FILE=server.lock_file)
+        child = subprocess.Popen(command, env=env)
+
+    def shutdown(signum, frame):
+        if child is not None and child.poll() is None:
+            child.send_signal(signum)
+        else:
+            server.stop()
+            sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    try:
+        if child is not None:
+            code = child.wait()
+        else:
+            threading.Event().wait()
+            code = 0
+    finally:
+        server.stop()
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
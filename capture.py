@@ -0,0 +1,178 @@
+"""
+Screenshot output options for the aerial photos.
+
+Frames show the whole viewport unless clipped to the map element or to a box centred on the parcel
+(the map is centred on it before capturing), saved as PNG, JPEG or WebP at
+a given quality and downscaled. Comparing each frame's pixels with the
+previous one lets the flow spot a year identical to the one before it,
+which means its imagery never loaded, and flag or drop it. Consecutive
+orthophotos can look alike, so near-identical frames only count with the
+perceptual difference hash, which is opt-in (CAPTURE_DEDUPE_METHOD=dhash).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 'viewport' (whole page, as before clipping existed), 'map' (the map element) or 'parcel'
+# (CAPTURE_PARCEL_BOX around the map centre); the last two are opt-in
+CAPTURE_CLIP = os.environ.get('CAPTURE_CLIP', 'viewport')
+CAPTURE_MAP_SELECTOR = os.environ.get('CAPTURE_MAP_SELECTOR', '#map')
+CAPTURE_PARCEL_BOX = os.environ.get('CAPTURE_PARCEL_BOX', '800x600')
+CAPTURE_FORMAT = os.environ.get('CAPTURE_FORMAT', 'png').lower()  # png, jpeg or webp
+CAPTURE_QUALITY = int(os.environ.get('CAPTURE_QUALITY', 85))  # JPEG and WebP only
+CAPTURE_MAX_WIDTH = int(os.environ.get('CAPTURE_MAX_WIDTH', 0))  # 0 keeps the captured size
+# 'off', 'flag' (keep and report) or 'drop' frames identical to the previous year
+CAPTURE_DEDUPE = os.environ.get('CAPTURE_DEDUPE', 'flag')
+# 'pixels' (exactly the same image) or 'dhash' (perceptually the same, within CAPTURE_DEDUPE_DISTANCE)
+CAPTURE_DEDUPE_METHOD = os.environ.get('CAPTURE_DEDUPE_METHOD', 'pixels')
+CAPTURE_DEDUPE_DISTANCE = int(os.environ.get('CAPTURE_DEDUPE_DISTANCE', 2))  # differing bits of 64
+
+EXTENSIONS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+
+def settings():
+    """Everything that shapes the saved frames, e.g. for cache keys"""
+    return {
+        'clip': CAPTURE_CLIP,
+        'parcel_box': CAPTURE_PARCEL_BOX if CAPTURE_CLIP == 'parcel' else None,
+        'format': CAPTURE_FORMAT,
+        'quality': CAPTURE_QUALITY if CAPTURE_FORMAT != 'png' else None,
+        'max_width': CAPTURE_MAX_WIDTH,
+    }
+
+
+def clip_box(page):
+    """The screenshot clip for CAPTURE_CLIP, or None for the whole viewport"""
+    if CAPTURE_CLIP == 'viewport':
+        return None
+    try:
+        box = page.locator(CAPTURE_MAP_SELECTOR).first.bounding_box()
+    except Exception as e:
+        logger.warning(f"Could not find the map element to clip to: {str(e)}")
+        return None
+    return _clip_around(box, page.viewport_size)
+
+
+async def clip_box_async(page):
+    """clip_box() for async_playwright pages"""
+    if CAPTURE_CLIP == 'viewport':
+        return None
+    try:
+        box = await page.locator(CAPTURE_MAP_SELECTOR).first.bounding_box()
+    except Exception as e:
+        logger.warning(f"Could not find the map element to clip to: {str(e)}")
+        return None
+    return _clip_around(box, page.viewport_size)
+
+
+def _clip_around(box, viewport):
+    """The clip for the map element's box, kept inside the viewport"""
+    if not box:
+        return None
+    viewport = viewport or {'width': box['x'] + box['width'], 'height': box['y'] + box['height']}
+    if CAPTURE_CLIP == 'parcel':
+        width, height = (int(value) for value in CAPTURE_PARCEL_BOX.lower().split('x'))
+        centre_x = box['x'] + box['width'] / 2
+        centre_y = box['y'] + box['height'] / 2
+        box = {'x': centre_x - width / 2, 'y': centre_y - height / 2, 'width': width, 'height': height}
+    # Keep the clip inside the viewport
+    x = max(0, box['x'])
+    y = max(0, box['y'])
+    return {'x': x, 'y': y,
+            'width': min(box['x'] + box['width'], viewport['width']) - x,
+            'height': min(box['y'] + box['height'], viewport['height']) - y}
+
+
+def save_image(image, path_base):
+    """Save a Pillow image in CAPTURE_FORMAT, downscaled to CAPTURE_MAX_WIDTH; returns the path"""
+    if CAPTURE_MAX_WIDTH and image.width > CAPTURE_MAX_WIDTH:
+        height = round(image.height * CAPTURE_MAX_WIDTH / image.width)
+        image = image.resize((CAPTURE_MAX_WIDTH, height), Image.LANCZOS)
+    path = f"{path_base}.{EXTENSIONS[CAPTURE_FORMAT]}"
+    if CAPTURE_FORMAT == 'jpeg':
+        image.convert('RGB').save(path, 'JPEG', quality=CAPTURE_QUALITY, optimize=True)
+    elif CAPTURE_FORMAT == 'webp':
+        image.save(path, 'WEBP', quality=CAPTURE_QUALITY, method=4)
+    else:
+        image.save(path, 'PNG', optimize=True)
+    return path
+
+
+def _save_png(png, path_base):
+    return save_image(Image.open(BytesIO(png)), path_base)
+
+
+def screenshot(page, path_base):
+    """Capture the page with the configured clip, format and size; returns the file path"""
+    clip = clip_box(page)
+    if CAPTURE_FORMAT in ('png', 'jpeg') and not CAPTURE_MAX_WIDTH:
+        # Chromium encodes these itself
+        path = f"{path_base}.{EXTENSIONS[CAPTURE_FORMAT]}"
+        page.screenshot(path=path, clip=clip, type=CAPTURE_FORMAT,
+                        quality=CAPTURE_QUALITY if CAPTURE_FORMAT == 'jpeg' else None)
+        return path
+    return _save_png(page.screenshot(clip=clip, type='png'), path_base)
+
+
+async def screenshot_async(page, path_base):
+    """screenshot() for async_playwright pages; Pillow encodes off the event loop"""
+    clip = await clip_box_async(page)
+    if CAPTURE_FORMAT in ('png', 'jpeg') and not CAPTURE_MAX_WIDTH:
+        path = f"{path_base}.{EXTENSIONS[CAPTURE_FORMAT]}"
+        await page.screenshot(path=path, clip=clip, type=CAPTURE_FORMAT,
+                              quality=CAPTURE_QUALITY if CAPTURE_FORMAT == 'jpeg' else None)
+        return path
+    png = await page.screenshot(clip=clip, type='png')
+    return await asyncio.get_running_loop().run_in_executor(None, _save_png, png, path_base)
+
+
+def pixel_digest(path):
+    """SHA-256 of the decoded pixels, so two encodings of the same image match"""
+    with Image.open(path) as image:
+        digest = hashlib.sha256(f'{image.mode}:{image.width}x{image.height}:'.encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def dhash(path):
+    """64-bit difference hash: which of each pair of neighbouring pixels is brighter"""
+    with Image.open(path) as image:
+        small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class DuplicateFilter:
+    """Spots frames identical (or, with method 'dhash', perceptually identical) to the previous one"""
+
+    def __init__(self, method=CAPTURE_DEDUPE_METHOD, distance=CAPTURE_DEDUPE_DISTANCE):
+        self.method = method
+        self.distance = distance
+        self._previous = None
+
+    def _same(self, a, b):
+        if self.method == 'dhash':
+            return bin(a ^ b).count('1') <= self.distance
+        return a == b
+
+    def check(self, label, path):
+        """The label of the previous frame if path looks the same, else None"""
+        try:
+            fingerprint = dhash(path) if self.method == 'dhash' else pixel_digest(path)
+        except Exception as e:
+            logger.warning(f"Could not fingerprint {path}: {str(e)}")
+            return None
+        previous, self._previous = self._previous, (label, fingerprint)
+        if previous is not None and self._same(previous[1], fingerprint):
+            return previous[0]
+        return None
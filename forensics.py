@@ -0,0 +1,350 @@
+"""
+Debugging bundles for failed visor steps.
+
+Every browser page gets a ring buffer of its last FORENSICS_HAR_ENTRIES
+network exchanges kept in memory, and with FORENSICS_TRACE=1 a Playwright
+trace (actions, console and timings, without DOM snapshots unless
+FORENSICS_TRACE_SNAPSHOTS=1). Nothing is written while a render succeeds.
+The first step that fails on a page writes one compressed bundle to
+FORENSICS_DIR; inside a StepSequence (see deferred) a failure only counts
+once the sequence gives up, not when a retry fixes it:
+
+    info.json      step, flow, error, URL, title and time
+    trace.zip      the trace so far, if tracing (open with `playwright show-trace`)
+    network.har    the recent requests as HAR 1.2
+    screenshot.png the viewport at the time of the failure
+    page.html      the DOM at the time of the failure
+
+and logs one line pointing to it. The directory is capped at
+FORENSICS_MAX_BYTES and FORENSICS_MAX_AGE seconds (oldest bundles go
+first), and at most one bundle is written every FORENSICS_MIN_INTERVAL
+seconds, so a visor outage does not fill the disk.
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+FORENSICS = os.environ.get('FORENSICS', '1') != '0'
+FORENSICS_DIR = os.environ.get('FORENSICS_DIR', os.path.join(os.getcwd(), 'downloads', 'forensics'))
+FORENSICS_MAX_BYTES = int(os.environ.get('FORENSICS_MAX_BYTES', 100 * 1024 * 1024))
+FORENSICS_MAX_AGE = float(os.environ.get('FORENSICS_MAX_AGE', 3 * 24 * 3600))
+FORENSICS_MIN_INTERVAL = float(os.environ.get('FORENSICS_MIN_INTERVAL', 10))
+# Tracing costs every action some time and memory, so it is opt-in
+FORENSICS_TRACE = os.environ.get('FORENSICS_TRACE', '0') == '1'
+FORENSICS_TRACE_SNAPSHOTS = os.environ.get('FORENSICS_TRACE_SNAPSHOTS', '0') == '1'
+FORENSICS_HAR_ENTRIES = int(os.environ.get('FORENSICS_HAR_ENTRIES', 300))
+SCREENSHOT_TIMEOUT = 10000
+
+
+class BundleStore:
+    """Directory of zipped bundles bounded in size, age and write rate"""
+
+    def __init__(self, directory=FORENSICS_DIR, max_bytes=FORENSICS_MAX_BYTES, max_age=FORENSICS_MAX_AGE,
+                 min_interval=FORENSICS_MIN_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_write = None
+        self._counters = {'written': 0, 'rate_limited': 0, 'evicted': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def reserve(self):
+        """True if a bundle may be written now; False (and counted) while rate limited"""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_write is not None and now - self._last_write < self.min_interval:
+                self._counters['rate_limited'] += 1
+                return False
+            self._last_write = now
+            return True
+
+    def write(self, name, files):
+        """Zip {filename: bytes} into the directory; returns the bundle path"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{name}.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            for filename, data in files.items():
+                bundle.writestr(filename, data)
+        self._count('written')
+        self.evict()
+        return path
+
+    def _bundles(self):
+        bundles = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return bundles
+        for filename in names:
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            bundles.append((stat.st_mtime, stat.st_size, path))
+        return sorted(bundles)
+
+    def evict(self):
+        """Remove bundles past max_age, then the oldest until under max_bytes"""
+        bundles = self._bundles()
+        total = sum(size for _, size, _ in bundles)
+        now = time.time()
+        for mtime, size, path in bundles:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._count('evicted')
+
+    def stats(self):
+        bundles = self._bundles()
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({
+            'enabled': FORENSICS,
+            'bundles': len(bundles),
+            'bytes': sum(size for _, size, _ in bundles),
+            'max_bytes': self.max_bytes,
+        })
+        return stats
+
+
+bundle_store = BundleStore()
+
+
+class _Session:
+    """What is recorded for one page until its first failure"""
+
+    def __init__(self, context, tracing):
+        self.context = context
+        self.tracing = tracing
+        self.captured = False
+        self.deferred = 0
+        self.entries = collections.deque(maxlen=FORENSICS_HAR_ENTRIES)
+
+    def on_response(self, response):
+        request = response.request
+        self.entries.append({
+            'started': time.time(),
+            'method': request.method,
+            'url': request.url,
+            'resource_type': request.resource_type,
+            'status': response.status,
+            'status_text': response.status_text,
+            'content_type': response.headers.get('content-type', ''),
+            'size': int(response.headers.get('content-length') or -1),
+            'timing': request.timing,
+        })
+
+    def on_request_failed(self, request):
+        self.entries.append({
+            'started': time.time(),
+            'method': request.method,
+            'url': request.url,
+            'resource_type': request.resource_type,
+            'status': 0,
+            'status_text': request.failure or 'failed',
+            'content_type': '',
+            'size': -1,
+            'timing': request.timing,
+        })
+
+    def har(self):
+        """The recorded exchanges as a minimal HAR 1.2 log"""
+        entries = []
+        for entry in self.entries:
+            timing = entry['timing'] or {}
+            wait = max(0, timing.get('responseStart', -1) - max(0, timing.get('requestStart', 0)))
+            total = timing.get('responseEnd', -1)
+            entries.append({
+                'startedDateTime': datetime.fromtimestamp(entry['started']).isoformat(),
+                'time': max(0, total),
+                'request': {'method': entry['method'], 'url': entry['url'], 'httpVersion': '', 'headers': [],
+                            'queryString': [], 'cookies': [], 'headersSize': -1, 'bodySize': -1},
+                'response': {'status': entry['status'], 'statusText': entry['status_text'], 'httpVersion': '',
+                             'headers': [], 'cookies': [], 'redirectURL': '', 'headersSize': -1,
+                             'bodySize': entry['size'],
+                             'content': {'size': entry['size'], 'mimeType': entry['content_type']}},
+                'cache': {},
+                'timings': {'send': 0, 'wait': wait, 'receive': max(0, total - wait)},
+                '_resourceType': entry['resource_type'],
+            })
+        return {'log': {'version': '1.2', 'creator': {'name': 'pdf-inundaciones-ideib', 'version': '1'},
+                        'entries': entries}}
+
+
+_sessions = weakref.WeakKeyDictionary()
+
+
+def _trace_options():
+    return {'screenshots': False, 'snapshots': FORENSICS_TRACE_SNAPSHOTS, 'sources': False}
+
+
+def _new_session(context, page, tracing):
+    session = _Session(context, tracing)
+    page.on('response', session.on_response)
+    page.on('requestfailed', session.on_request_failed)
+    _sessions[page] = session
+
+
+def attach(context, page):
+    """Start recording a new page of context; call before it is used"""
+    if not FORENSICS:
+        return
+    tracing = False
+    if FORENSICS_TRACE:
+        try:
+            context.tracing.start(**_trace_options())
+            tracing = True
+        except Exception as e:
+            logger.warning(f"Could not start tracing: {str(e)}")
+    _new_session(context, page, tracing)
+
+
+async def attach_async(context, page):
+    """attach() for async_playwright pages"""
+    if not FORENSICS:
+        return
+    tracing = False
+    if FORENSICS_TRACE:
+        try:
+            await context.tracing.start(**_trace_options())
+            tracing = True
+        except Exception as e:
+            logger.warning(f"Could not start tracing: {str(e)}")
+    _new_session(context, page, tracing)
+
+
+@contextlib.contextmanager
+def deferred(page):
+    """Step failures on page within the block are left to the caller, which may still retry them"""
+    session = _sessions.get(page) if page is not None else None
+    if session is None:
+        yield
+        return
+    session.deferred += 1
+    try:
+        yield
+    finally:
+        session.deferred -= 1
+
+
+def _claim(page):
+    """The page's session if this failure should produce a bundle, else None"""
+    session = _sessions.get(page) if page is not None else None
+    if session is None or session.captured or session.deferred:
+        return None
+    # Later failures on the same page usually follow from the first one
+    session.captured = True
+    if not bundle_store.reserve():
+        logger.warning("Step failed, forensics bundle skipped (rate limited)")
+        return None
+    return session
+
+
+def _bundle_name(flow, step):
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{flow}_{step}"
+
+
+def _info(flow, step, error, url, title):
+    return json.dumps({'flow': flow, 'step': step, 'error': error, 'url': url, 'title': title,
+                       'time': datetime.now().isoformat()}, indent=2)
+
+
+def _read_and_remove(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def _trace_path():
+    handle, path = tempfile.mkstemp(prefix='ideib-trace-', suffix='.zip')
+    os.close(handle)
+    return path
+
+
+def _store(session, flow, step, files):
+    files['network.har'] = json.dumps(session.har())
+    try:
+        path = bundle_store.write(_bundle_name(flow, step), files)
+    except Exception as e:
+        bundle_store._count('errors')
+        logger.error(f"Failed to write forensics bundle: {str(e)}")
+        return None
+    logger.error(f"Step '{step}' ({flow}) failed, forensics bundle: {path}")
+    return path
+
+
+def step_failed(page, flow, step, error=None):
+    """Write the page's bundle if this is its first failure; returns the bundle path or None"""
+    session = _claim(page)
+    if session is None:
+        return None
+    files = {}
+    url = title = None
+    try:
+        url = page.url
+        title = page.title()
+        files['screenshot.png'] = page.screenshot(timeout=SCREENSHOT_TIMEOUT)
+        files['page.html'] = page.content()
+    except Exception as e:
+        logger.warning(f"Incomplete forensics capture: {str(e)}")
+    if session.tracing:
+        try:
+            trace_path = _trace_path()
+            session.context.tracing.stop(path=trace_path)
+            files['trace.zip'] = _read_and_remove(trace_path)
+        except Exception as e:
+            logger.warning(f"Could not save the trace: {str(e)}")
+    files['info.json'] = _info(flow, step, error, url, title)
+    return _store(session, flow, step, files)
+
+
+async def step_failed_async(page, flow, step, error=None):
+    """step_failed() for async_playwright pages; the bundle is written off the event loop"""
+    session = _claim(page)
+    if session is None:
+        return None
+    files = {}
+    url = title = None
+    try:
+        url = page.url
+        title = await page.title()
+        files['screenshot.png'] = await page.screenshot(timeout=SCREENSHOT_TIMEOUT)
+        files['page.html'] = await page.content()
+    except Exception as e:
+        logger.warning(f"Incomplete forensics capture: {str(e)}")
+    if session.tracing:
+        try:
+            trace_path = _trace_path()
+            await session.context.tracing.stop(path=trace_path)
+            files['trace.zip'] = _read_and_remove(trace_path)
+        except Exception as e:
+            logger.warning(f"Could not save the trace: {str(e)}")
+    files['info.json'] = _info(flow, step, error, url, title)
+    return await asyncio.get_running_loop().run_in_executor(None, _store, session, flow, step, files)
+
+
+def stats():
+    return bundle_store.stats()
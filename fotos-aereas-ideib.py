@@ -1,11 +1,30 @@
-from playwright.sync_api import sync_playwright
-import time
+import contextlib
 import logging
-from flask import Flask, render_template, request, send_file, jsonify, after_this_request
+from flask import Flask, Response, render_template, request, jsonify
 import os
+import json
 from datetime import datetime
 import zipfile # Added for zipping files
 import tempfile # Added for temporary zip file
+import shutil
+from browser_pool import BrowserPool, chromium_launch_options
+from async_engine import AsyncBrowserEngine
+import async_steps
+from result_cache import ResultCache, normalise_reference
+from singleflight import SingleFlight
+import parcel_resolver
+import request_filter
+import asset_cache
+import forensics
+import aerial_tiles
+import capture
+import metrics
+from governor import governor
+from warmup import Warmup, WARMUP_PRELOAD, register_health_routes, wait_until
+from jobs import (JOB_WAIT_TIMEOUT, JOB_WORKERS, JobQueue, QueueFull, register_job_routes, run_job_and_send,
+                  queue_full_response, send_job_result, send_result)
+from zip_stream import ZipStream
+import waits
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,6 +35,44 @@ years_to_screenshot = [1956, 1984, 1989, 2001, 2002, 2006, 2008, 2010, 2012, 201
 
 app = Flask(__name__)
 
+# Overridable so the flows can run against the stand-in visor in bench/
+IDEIB_VISOR_URL = os.environ.get('IDEIB_VISOR_URL', 'https://ideib.caib.es/visor/')
+
+# Warm Chromium instances shared by every request
+# Headless in production (or with BROWSER_HEADLESS=1), headed in local testing
+launch_options = chromium_launch_options(
+    headless=os.environ.get('FLY_APP_NAME') is not None or os.environ.get('BROWSER_HEADLESS') == '1')
+browser_pool = BrowserPool(launch_options=launch_options, recycle_check=governor.should_recycle_browser)
+# 'pool' runs each capture on a browser thread of its own, 'async' runs them as
+# coroutines on one browser (see async_engine.py), ASYNC_MAX_CONTEXTS at a time
+BROWSER_ENGINE = os.environ.get('BROWSER_ENGINE', 'pool')
+async_engine = AsyncBrowserEngine(launch_options=launch_options, recycle_check=governor.should_recycle_browser)
+photos_flight = SingleFlight('aerial photos')
+
+# Pages capturing years side by side in one browser. Each page is assumed to
+# cost AERIAL_PAGE_MEMORY_MB, and fewer are used when that would take the
+# browsers past AERIAL_MEMORY_BUDGET_MB (the Fly VM has 1 GB)
+AERIAL_PARALLEL_PAGES = int(os.environ.get('AERIAL_PARALLEL_PAGES', 3))
+AERIAL_MEMORY_BUDGET_MB = float(os.environ.get('AERIAL_MEMORY_BUDGET_MB', 700))
+AERIAL_PAGE_MEMORY_MB = float(os.environ.get('AERIAL_PAGE_MEMORY_MB', 150))
+
+# 'browser' screenshots the visor, 'tiles' fetches the orthophotos from the
+# WMS (see aerial_tiles.py) and falls back to the browser on failure
+AERIAL_ENGINES = ('browser', 'tiles')
+AERIAL_ENGINE = os.environ.get('AERIAL_ENGINE', 'browser')
+# The synchronous routes stream the ZIP as photos are captured
+AERIAL_STREAM_ZIP = os.environ.get('AERIAL_STREAM_ZIP', '1') != '0'
+
+# Past years' orthophotos never change, so their photos are cached for good;
+# the newest year may still be re-flown and is captured again after a while
+AERIAL_CACHE = os.environ.get('AERIAL_CACHE', '1') != '0'
+AERIAL_CACHE_DIR = os.environ.get('AERIAL_CACHE_DIR', os.path.join(os.getcwd(), 'downloads', 'aerial_cache'))
+AERIAL_CACHE_LATEST_TTL = float(os.environ.get('AERIAL_CACHE_LATEST_TTL', 7 * 24 * 3600))
+AERIAL_CACHE_MAX_BYTES = int(os.environ.get('AERIAL_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Frames flagged as duplicates are never reused, only kept this long for the requests zipping them
+AERIAL_DUPLICATE_TTL = float(os.environ.get('AERIAL_DUPLICATE_TTL', 3600))
+photo_cache = ResultCache(directory=AERIAL_CACHE_DIR, ttl=AERIAL_CACHE_LATEST_TTL, max_bytes=AERIAL_CACHE_MAX_BYTES)
+
 # Create a directory for storing screenshots if it doesn't exist
 SCREENSHOT_DIR = "screenshots"
 if not os.path.exists(SCREENSHOT_DIR):
@@ -30,18 +87,22 @@ def maximize_window(page):
     except Exception as e:
         logger.error(f"Failed to maximize window: {str(e)}")
 
+@metrics.step('aerial')
 def close_initial_modal(page):
     """Close the initial modal that appears when the page loads"""
     try:
         logger.info("Closing initial modal...")
-        ok_button = page.locator('div.jimu-btn.jimu-float-trailing.enable-btn[data-dojo-attach-point="okNode"]')
+        ok_selector = 'div.jimu-btn.jimu-float-trailing.enable-btn[data-dojo-attach-point="okNode"]'
+        ok_button = page.locator(ok_selector)
         ok_button.wait_for(state="visible")
         ok_button.click()
-        time.sleep(0.5)  # Reduced wait time
+        waits.wait_for_hidden(page, ok_selector, "initial_modal_closed", legacy_sleep=0.5)
         logger.info("Initial modal closed successfully")
     except Exception as e:
         logger.error(f"Failed to close initial modal: {str(e)}")
+        return False
 
+@metrics.step('aerial')
 def click_locate_icon(page):
     """Click the locate icon to open the search panel"""
     try:
@@ -50,11 +111,13 @@ def click_locate_icon(page):
         img.wait_for(state="visible")
         parent = img.locator('xpath=..')
         parent.click()
-        time.sleep(1)  # Reduced wait
+        waits.wait_for_visible(page, 'div.tab.jimu-vcenter-text[label="Cadastre"]', "locate_panel_open", legacy_sleep=1)
         logger.info("Locate icon clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click locate icon: {str(e)}")
+        return False
 
+@metrics.step('aerial')
 def click_cadastre_tab(page):
     """Click the Cadastre tab in the search panel"""
     try:
@@ -62,11 +125,13 @@ def click_cadastre_tab(page):
         cadastre_tab = page.locator('div.tab.jimu-vcenter-text[label="Cadastre"]')
         cadastre_tab.wait_for(state="visible")
         cadastre_tab.click()
-        time.sleep(1)  # Reduced wait
+        waits.wait_for_visible(page, 'input#RC[name="search"]', "cadastre_tab_open", legacy_sleep=1)
         logger.info("Cadastre tab clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click Cadastre tab: {str(e)}")
+        return False
 
+@metrics.step('aerial')
 def enter_cadastral_reference(page, referencia_catastral):
     """Enter the cadastral reference and click search"""
     try:
@@ -78,26 +143,28 @@ def enter_cadastral_reference(page, referencia_catastral):
         logger.info("Clicking search button...")
         search_button = page.locator('div.locate-btn.btn-addressLocate[data-dojo-attach-point="btnRefCat"]')
         search_button.wait_for(state="visible")
-        search_button.click()
-        
-        time.sleep(3)  # Wait for results to load
+        # The map zooms to the parcel once the cadastre lookup answers
+        waits.wait_for_map_update(page, search_button.click, "parcel_located", legacy_sleep=3)
         logger.info("Search completed successfully")
     except Exception as e:
         logger.error(f"Failed to enter cadastral reference: {str(e)}")
+        return False
 
+@metrics.step('aerial')
 def close_left_column(page):
     """Close/minimize the left column"""
     try:
         left_column = page.locator('.bar.max')
         if left_column.is_visible():
-            time.sleep(0.3)  # Reduced wait
+            # click() already waits for the bar to stop animating
             left_column.click()  # First click
-            time.sleep(0.3)  # Reduced wait
             left_column.click()  # Second click
             logger.info("Left column closed/minimized.")
     except Exception as e:
         logger.error(f"Failed to close/minimize left column: {str(e)}")
+        return False
 
+@metrics.step('aerial')
 def close_cerca_avancada(page):
     """Close the cerca avançada panel"""
     try:
@@ -105,10 +172,12 @@ def close_cerca_avancada(page):
         close_button = page.locator('div.close-icon.jimu-float-trailing[data-dojo-attach-point="closeNode"]')
         close_button.wait_for(state="visible")
         close_button.click()
-        time.sleep(1)  # Wait for panel to close
+        waits.wait_for_hidden(page, 'div.close-icon.jimu-float-trailing[data-dojo-attach-point="closeNode"]',
+                              "cerca_avancada_closed", legacy_sleep=1)
         logger.info("Cerca avançada panel closed successfully")
     except Exception as e:
         logger.error(f"Failed to close cerca avançada panel: {str(e)}")
+        return False
 
 def hide_ui_elements(page):
     """Hide various UI elements to clean up the view"""
@@ -129,6 +198,7 @@ def hide_ui_elements(page):
         except Exception as e:
             logger.error(f'Failed to hide {element_id}: {str(e)}')
 
+@metrics.step('aerial')
 def zoom_in_three_times(page):
     """Zoom in three times"""
     try:
@@ -137,12 +207,13 @@ def zoom_in_three_times(page):
         zoom_in_button.wait_for(state="visible")
         
         for i in range(3):
-            zoom_in_button.click()
-            time.sleep(0.5)  # Reduced wait
+            waits.wait_for_map_update(page, zoom_in_button.click, "zoom_in", legacy_sleep=0.5)
             logger.info(f"Zoomed in {i+1}/3 times")
     except Exception as e:
         logger.error(f"Failed to zoom in: {str(e)}")
+        return False
 
+@metrics.step('aerial', returns_value=True)
 def take_screenshot(page, referencia_catastral, year=None):
     """Take a screenshot of the current view"""
     try:
@@ -153,19 +224,19 @@ def take_screenshot(page, referencia_catastral, year=None):
             
         if year:
             # Use only the base filename for the zip archive, store in SCREENSHOT_DIR
-            base_filename = f"foto_{referencia_catastral}_{year}_{timestamp}.png"
-            screenshot_path = os.path.join(SCREENSHOT_DIR, base_filename)
+            base_filename = f"foto_{referencia_catastral}_{year}_{timestamp}"
         else:
-            base_filename = f"foto_{referencia_catastral}_{timestamp}.png"
-            screenshot_path = os.path.join(SCREENSHOT_DIR, base_filename)
-            
-        page.screenshot(path=screenshot_path)
+            base_filename = f"foto_{referencia_catastral}_{timestamp}"
+
+        # The extension follows CAPTURE_FORMAT
+        screenshot_path = capture.screenshot(page, os.path.join(SCREENSHOT_DIR, base_filename))
         logger.info(f"Screenshot saved as {screenshot_path}")
         return os.path.normpath(screenshot_path) # Return the full path
     except Exception as e:
         logger.error(f"Failed to take screenshot: {str(e)}")
         return None
 
+@metrics.step('aerial')
 def select_historical_photos(page):
     """Click on the historical photos option"""
     try:
@@ -173,19 +244,34 @@ def select_historical_photos(page):
         historical_photos = page.locator('img[alt="Fotografies històriques de totes les illes"]')
         historical_photos.wait_for(state="visible")
         historical_photos.click()
-        time.sleep(2)  # Wait for the options to load
+        # Wait for the year options to load
+        waits.wait_for_visible(page, f'span:text("{years_to_screenshot[0]}")', "historical_years_listed", legacy_sleep=2)
         logger.info("Historical photos option selected successfully")
     except Exception as e:
         logger.error(f"Failed to select historical photos: {str(e)}")
+        return False
+
+def click_year(page, year):
+    """
+    Click a year's label without waiting for its imagery; returns the map
+    update count to pass to select_year_and_screenshot as updates_before
+    """
+    logger.info(f"Selecting year {year}...")
+    year_element = page.locator(f'span:text("{year}")')
+    year_element.wait_for(state="visible")
+    return waits.start_map_update(page, year_element.click)
 
-def select_year_and_screenshot(page, year, referencia_catastral):
-    """Select a specific year and take a screenshot"""
+@metrics.step('aerial', returns_value=True)
+def select_year_and_screenshot(page, year, referencia_catastral, clicked=False, updates_before=None):
+    """
+    Select a specific year and take a screenshot. With clicked, the year was
+    already clicked with click_year and only its imagery is waited for.
+    """
     try:
-        logger.info(f"Selecting year {year}...")
-        year_element = page.locator(f'span:text("{year}")')
-        year_element.wait_for(state="visible")
-        year_element.click()
-        time.sleep(5)  # Wait for the image to load
+        if not clicked:
+            updates_before = click_year(page, year)
+        # Wait for the year's orthophoto tiles to be drawn
+        waits.finish_map_update(page, updates_before, "year_imagery_loaded", timeout=20, legacy_sleep=5)
         screenshot_path = take_screenshot(page, referencia_catastral, year)
         logger.info(f"Year {year} selected and screenshot taken successfully")
         return screenshot_path
@@ -193,95 +279,297 @@ def select_year_and_screenshot(page, year, referencia_catastral):
         logger.error(f"Failed to select year {year}: {str(e)}")
         return None
 
-def get_aerial_photos(referencia_catastral):
+def locate_with_visor(page, referencia_catastral):
+    """Centre the map on the parcel through the visor's cadastre search"""
+    click_locate_icon(page)
+    click_cadastre_tab(page)
+    enter_cadastral_reference(page, referencia_catastral)
+    close_cerca_avancada(page)
+
+def _no_progress(step):
+    pass
+
+def start_loading_visor(page):
+    """Hook the page and start navigating to the visor without waiting for it"""
+    waits.install_map_hooks(page)
+    asset_cache.install(page)
+    request_filter.install(page, 'aerial')
+    page.goto(IDEIB_VISOR_URL, timeout=90000, wait_until="commit")
+
+def position_on_parcel(page, referencia_catastral, progress=None):
+    """Bring a loading visor page to the parcel, zoomed in, with the historical photos listed"""
+    progress = progress or _no_progress
+    with metrics.timed_step('aerial', 'load_visor'):
+        page.wait_for_load_state("load", timeout=90000)  # 90 seconds timeout for initial load
+        page.wait_for_load_state("networkidle", timeout=90000)
+    progress("Visor loaded")
+
+    # Skip maximize_window as we already set viewport size
+    logger.info("Setting up the view...")
+    close_initial_modal(page)
+    close_left_column(page)
+    progress("Locating parcel")
+    with metrics.timed_step('aerial', 'centre_map_on_parcel'):
+        parcel_resolver.centre_map_on_parcel(page, referencia_catastral,
+                                             lambda: locate_with_visor(page, referencia_catastral))
+    progress("Parcel located")
+    zoom_in_three_times(page)
+    hide_ui_elements(page)
+    select_historical_photos(page)
+
+def browser_memory_mb():
+    return metrics.browser_memory()['rss_bytes'] / 1024 / 1024
+
+def plan_capture_pages(year_count):
+    """How many pages to capture with: AERIAL_PARALLEL_PAGES, fewer if the memory budget cannot hold them"""
+    wanted = max(1, min(AERIAL_PARALLEL_PAGES, year_count))
+    affordable = int((AERIAL_MEMORY_BUDGET_MB - browser_memory_mb()) // AERIAL_PAGE_MEMORY_MB)
+    pages = max(1, min(wanted, affordable))
+    if pages < wanted:
+        logger.info(f"Capturing on {pages} page(s) instead of {wanted} to stay within "
+                    f"{AERIAL_MEMORY_BUDGET_MB:.0f} MB")
+    return pages
+
+def capture_years(pages, referencia_catastral, years, progress, on_capture=None):
+    """
+    Capture the years in waves, one year per page: every page of a wave is
+    clicked first so their imagery loads at the same time, then each is
+    captured. Calls on_capture(year, path, duplicate_of) in year order as
+    they are taken; with CAPTURE_DEDUPE a frame identical to the previous
+    year's is flagged through duplicate_of, or dropped and reported with a
+    None path. Returns {year: screenshot path}.
+    """
+    captured = {}
+    duplicates = capture.DuplicateFilter() if capture.CAPTURE_DEDUPE != 'off' else None
+    pending = list(years)
+    while pending:
+        wave = list(zip(pages, pending))
+        pending = pending[len(wave):]
+        logger.info(f"Capturing years {[year for _, year in wave]} on {len(wave)} page(s)")
+        updates_before = {}
+        if len(wave) > 1:
+            for wave_page, year in wave:
+                try:
+                    updates_before[year] = click_year(wave_page, year)
+                except Exception as e:
+                    logger.error(f"Failed to select year {year}: {str(e)}")
+        for wave_page, year in wave:
+            if year in updates_before:
+                screenshot_path = select_year_and_screenshot(wave_page, year, referencia_catastral,
+                                                             clicked=True, updates_before=updates_before[year])
+            else:
+                screenshot_path = select_year_and_screenshot(wave_page, year, referencia_catastral)
+            if not screenshot_path:
+                continue
+            duplicate_of = duplicates.check(year, screenshot_path) if duplicates else None
+            if duplicate_of and capture.CAPTURE_DEDUPE == 'drop':
+                logger.warning(f"Dropping year {year}, identical to {duplicate_of} (imagery not loaded)")
+                os.remove(screenshot_path)
+                progress(f"Dropped year {year}")
+                if on_capture:
+                    on_capture(year, None, duplicate_of)
+                continue
+            if duplicate_of:
+                logger.warning(f"Year {year} looks identical to {duplicate_of}, its imagery may not have loaded")
+            captured[year] = screenshot_path
+            progress(f"Captured year {year}")
+            if on_capture:
+                on_capture(year, screenshot_path, duplicate_of)
+
+        # Give a page back if the browser has grown past the budget
+        if pending and len(pages) > 1 and browser_memory_mb() > AERIAL_MEMORY_BUDGET_MB:
+            logger.warning(f"Browser memory over {AERIAL_MEMORY_BUDGET_MB:.0f} MB, "
+                           f"continuing on {len(pages) - 1} page(s)")
+            try:
+                pages[-1].close()
+            except Exception:
+                pass
+            pages = pages[:-1]
+    return captured
+
+def capture_aerial_photos(page, referencia_catastral, progress=None, on_capture=None, years=None):
+    """Drive the visor on a pooled page and return the list of screenshot paths"""
+    progress = progress or _no_progress
+    years = years or years_to_screenshot
+
+    # Extra pages in the same browser start loading the visor while the
+    # first one locates the parcel, then capture years side by side with it
+    logger.info("Navigating to IDEIB website...")
+    page_count = plan_capture_pages(len(years))
+    start_loading_visor(page)
+    extra_pages = []
+    try:
+        for _ in range(page_count - 1):
+            extra_page = page.context.new_page()
+            extra_pages.append(extra_page)
+            start_loading_visor(extra_page)
+
+        position_on_parcel(page, referencia_catastral, progress)
+        pages = [page]
+        for extra_page in extra_pages:
+            # The first page stored the parcel's extent, so these jump straight to it
+            try:
+                position_on_parcel(extra_page, referencia_catastral)
+                pages.append(extra_page)
+            except Exception as e:
+                logger.error(f"Failed to prepare an extra capture page: {str(e)}")
+
+        logger.info(f"Taking screenshots for years: {years}")
+        captured = capture_years(pages, referencia_catastral, years, progress, on_capture)
+    finally:
+        for extra_page in extra_pages:
+            try:
+                extra_page.close()
+            except Exception:
+                pass
+
+    request_filter.log_summary(page, f"Aerial photos for {referencia_catastral}")
+    # Same order as years, whichever page captured each year
+    return [captured[year] for year in years if year in captured]
+
+def capture_with_engine(referencia_catastral, progress=None, engine='browser', on_capture=None, years=None):
+    """Photos from the WMS ('tiles', falling back to the browser on failure) or the visor"""
+    years = years or years_to_screenshot
+    if engine == 'tiles':
+        captured = []
+
+        def on_tile_capture(year, path):
+            captured.append(year)
+            if on_capture:
+                on_capture(year, path)
+        try:
+            return aerial_tiles.fetch_aerial_photos(referencia_catastral, years, SCREENSHOT_DIR,
+                                                    progress=progress, on_capture=on_tile_capture)
+        except Exception as e:
+            logger.error(f"Tile engine failed for {referencia_catastral}, falling back to the browser: {e}")
+        if captured:
+            # Years already handed to on_capture cannot be taken back
+            raise Exception(f"Tile engine stopped after {len(captured)} year(s)")
+    if BROWSER_ENGINE == 'async':
+        return async_engine.run(async_steps.capture_aerial_photos, referencia_catastral, years, SCREENSHOT_DIR,
+                                progress=progress, on_capture=on_capture,
+                                page_count=plan_capture_pages(len(years)), visor_url=IDEIB_VISOR_URL)
+    return browser_pool.run(capture_aerial_photos, referencia_catastral, progress=progress, on_capture=on_capture,
+                            years=years)
+
+def photo_cache_key(referencia_catastral, year, engine):
+    """Cache key of one year's photo: the reference, the year and everything that shapes the image"""
+    settings = capture.settings()
+    if engine == 'tiles':
+        settings.update(aerial_tiles.settings())
+    return photo_cache.key(referencia_catastral, year=year, engine=engine, **settings)
+
+def cached_photos(referencia_catastral, engine, workdir):
+    """
+    {year: path} of the years with a fresh photo in the cache, checked out
+    into workdir so an eviction cannot delete them before they are sent
+    """
+    if not AERIAL_CACHE:
+        return {}
+    cached = {}
+    for year in years_to_screenshot:
+        entry = photo_cache.checkout(photo_cache_key(referencia_catastral, year, engine), workdir)
+        if entry is not None:
+            cached[year] = entry['path']
+    return cached
+
+@contextlib.contextmanager
+def photo_workdir():
+    """Private directory for the cached photos one request checks out, removed afterwards"""
+    workdir = tempfile.mkdtemp(prefix='checkout_', dir=SCREENSHOT_DIR)
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def capture_and_cache(referencia_catastral, years, progress=None, engine='browser', on_capture=None):
+    """Capture the given years and move each photo into the cache as it is taken"""
+    stored = {}
+
+    def on_photo(year, path, duplicate_of=None):
+        if AERIAL_CACHE and path:
+            try:
+                if duplicate_of:
+                    # Frames that look like the previous year's may not have loaded, so they are not
+                    # reused: they go under a key of their own and expire once the zips are written
+                    key = photo_cache.key(referencia_catastral, duplicate=os.path.basename(path))
+                    ttl = AERIAL_DUPLICATE_TTL
+                else:
+                    key = photo_cache_key(referencia_catastral, year, engine)
+                    ttl = None if year == max(years_to_screenshot) else float('inf')
+                entry = photo_cache.put(key, path, ttl=ttl,
+                                        referencia_catastral=normalise_reference(referencia_catastral), year=year)
+                stored[path] = entry['path']
+                path = entry['path']
+            except Exception as e:
+                logger.error(f"Failed to cache the {year} photo of {referencia_catastral}: {str(e)}")
+        if on_capture:
+            on_capture(year, path, duplicate_of)
+
+    paths = capture_with_engine(referencia_catastral, progress, engine, on_photo, years)
+    return [stored.get(path, path) for path in paths]
+
+def get_aerial_photos(referencia_catastral, workdir, progress=None, engine='browser', on_capture=None):
     """
     Navigate to the IDEIB website and retrieve aerial photos for the given cadastral reference
-    Returns a list of screenshot paths
+    Returns a list of screenshot paths. Only the years missing from the
+    cache are captured; with every year cached no browser is used.
+    on_capture(year, path, duplicate_of) is called in year order: cached
+    years up to the first missing one right away, the others as the capture
+    gets past them. A request that joins a run already in flight gets the
+    captured years at the end. Cached photos are checked out into workdir
+    (see photo_workdir), which the caller removes once they are sent.
     """
-    screenshot_paths = []
+    progress = progress or _no_progress
+    handed_over = set()
+
+    def hand_over(year, path, duplicate_of=None):
+        handed_over.add(year)
+        if on_capture:
+            on_capture(year, path, duplicate_of)
+
+    def hand_over_until(until=None, captured=None):
+        """Hand over the cached (or captured) years before until that have not been yet"""
+        for year in years_to_screenshot:
+            if year == until:
+                break
+            if year in handed_over:
+                continue
+            if year in cached:
+                progress(f"Year {year} from cache")
+                hand_over(year, cached[year])
+            elif captured and year in captured:
+                hand_over(year, captured[year])
+
+    def on_photo(year, path, duplicate_of=None):
+        # Captures arrive in year order, the cached years before this one go first
+        hand_over_until(year)
+        hand_over(year, path, duplicate_of)
+
     try:
-        # Check if running on Fly.io or similar cloud environment
-        is_production = os.environ.get('FLY_APP_NAME') is not None
-
-        with sync_playwright() as p:
-            # Launch browser - use headless True in production, False in local testing
-            launch_options = {
-                "headless": is_production, 
-                # Add args for better containerized browser support and memory optimization
-                "args": [
-                    "--disable-dev-shm-usage",
-                    "--no-sandbox",
-                    "--disable-setuid-sandbox",
-                    "--disable-gpu",
-                    "--disable-software-rasterizer",
-                    "--single-process",
-                    "--disable-extensions",
-                    "--disable-popup-blocking"
-                ] if is_production else []
-            }
-            
-            # Add timeout for page operations
-            browser = p.chromium.launch(**launch_options)
-            
-            # Increase timeout to 60 seconds for all operations
-            # Set a viewport size that's not too large to reduce memory usage
-            page = browser.new_page(
-                viewport={"width": 1280, "height": 800}
-            )
-            page.set_default_timeout(60000)  # 60 seconds
-            
-            # Navigate to the IDEIB website with longer timeout
-            logger.info("Navigating to IDEIB website...")
-            page.goto("https://ideib.caib.es/visor/", timeout=90000)  # 90 seconds timeout for initial load
-            page.wait_for_load_state("networkidle", timeout=90000)
-            
-            # Execute all steps in sequence
-            # Skip maximize_window as we already set viewport size
-            logger.info("Setting up the view...")
-            
-            # Reduce wait times between actions
-            close_initial_modal(page)
-            close_left_column(page)
-            click_locate_icon(page)
-            click_cadastre_tab(page)
-            enter_cadastral_reference(page, referencia_catastral)
-            close_cerca_avancada(page)
-            zoom_in_three_times(page)
-            hide_ui_elements(page)
-            
-            # Process years in batches to reduce memory pressure
-            logger.info(f"Taking screenshots for years: {years_to_screenshot}")
-            select_historical_photos(page)
-            
-            # Process years in batches to reduce memory pressure
-            batch_size = 4
-            for i in range(0, len(years_to_screenshot), batch_size):
-                batch = years_to_screenshot[i:i+batch_size]
-                logger.info(f"Processing batch of years: {batch}")
-                
-                for year in batch:
-                    screenshot_path = select_year_and_screenshot(page, year, referencia_catastral)
-                    if screenshot_path:
-                        screenshot_paths.append(screenshot_path)
-                
-                # Close and reopen contexts between batches to free memory
-                if i + batch_size < len(years_to_screenshot):
-                    logger.info("Freeing memory between batches...")
-                    # Do a simple browser operation to flush memory
-                    page.evaluate("() => { try { window.gc && window.gc(); } catch(e) {} }")
-            
-            browser.close()
-            
+        cached = cached_photos(referencia_catastral, engine, workdir)
+        missing = [year for year in years_to_screenshot if year not in cached]
+        hand_over_until(missing[0] if missing else None)
+        captured = {}
+        if missing:
+            # Concurrent requests for the same reference and years share one run
+            flight_key = f"{normalise_reference(referencia_catastral)}:{engine}:{','.join(map(str, missing))}"
+            paths = photos_flight.do(flight_key, capture_and_cache, referencia_catastral, missing, progress,
+                                     engine, on_photo)
+            captured = {photo_year(path): path for path in paths}
+        else:
+            logger.info(f"Every aerial photo of {referencia_catastral} is cached, no capture needed")
+        hand_over_until(captured=captured)
+        return [cached.get(year) or captured[year] for year in years_to_screenshot
+                if year in cached or year in captured]
     except Exception as e:
         logger.error(f"Error retrieving aerial photos: {str(e)}")
         # Ensure partial results aren't returned on error
         return [] # Return empty list on failure
-    
-    return screenshot_paths # Returns list of full paths
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', job_kind='photos')
 
 # Add a route to explicitly handle favicon requests and avoid triggering photo generation
 @app.route('/favicon.ico')
@@ -290,6 +578,23 @@ def favicon():
     # return '', 204
     return jsonify({'error': 'Not Found'}), 404 
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'browser_pool': browser_pool.stats(),
+        'async_engine': async_engine.stats(),
+        'waits': waits.wait_stats.snapshot(),
+        'network': request_filter.stats(),
+        'asset_cache': asset_cache.asset_cache.stats(),
+        'parcel_index': parcel_resolver.parcel_index.stats(),
+        'coalescing': photos_flight.stats(),
+        'photo_cache': photo_cache.stats(),
+        'jobs': job_queue.stats(),
+        'memory': governor.stats(),
+        'forensics': forensics.stats(),
+        'warmup': warmup.stats(),
+    })
+
 @app.route('/get_photos', methods=['POST'])
 def get_photos():
     referencia_catastral = request.form.get('referencia_catastral')
@@ -297,7 +602,7 @@ def get_photos():
         # Maybe render index with an error message instead of JSON?
         return jsonify({'error': 'Please provide a cadastral reference'}), 400
     
-    return process_and_zip_photos(referencia_catastral)
+    return send_photos(referencia_catastral, request.form.get('engine', AERIAL_ENGINE))
 
 # New route to fetch photos directly via URL path
 @app.route('/<string:referencia_catastral>', methods=['GET'])
@@ -306,57 +611,230 @@ def get_photos_by_url(referencia_catastral):
     if not referencia_catastral:
         return jsonify({'error': 'Please provide a cadastral reference in the URL path'}), 400
     
-    return process_and_zip_photos(referencia_catastral)
+    return send_photos(referencia_catastral, request.args.get('engine', AERIAL_ENGINE))
 
-def process_and_zip_photos(referencia_catastral):
-    """Helper function to get photos, zip them, and return for download."""
+def zip_photos(referencia_catastral, screenshot_paths):
+    """Zip the photos into a temporary file and return its path"""
+    # Create a temporary zip file
+    # Using tempfile ensures it's created securely and OS-independently
+    temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip", prefix=f"fotos_{referencia_catastral}_")
+    zip_path = temp_zip.name
+    logger.info(f"Creating zip archive at: {zip_path}")
     try:
-        screenshot_paths = get_aerial_photos(referencia_catastral)
-        if not screenshot_paths:
-            return jsonify({'error': 'No screenshots were generated, check the reference or logs'}), 500
-        
-        # Create a temporary zip file
-        # Using tempfile ensures it's created securely and OS-independently
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip", prefix=f"fotos_{referencia_catastral}_")
-        zip_path = temp_zip.name
-        logger.info(f"Creating zip archive at: {zip_path}")
-        
         with zipfile.ZipFile(temp_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for file_path in screenshot_paths:
                 # Add file to zip, using only the base filename inside the archive
-                zipf.write(file_path, os.path.basename(file_path))
-        
+                try:
+                    zipf.write(file_path, os.path.basename(file_path))
+                except FileNotFoundError:
+                    # A fresh capture the cache evicted before it got here
+                    logger.warning(f"Photo {file_path} disappeared before it was zipped, leaving it out")
         temp_zip.close() # Close the file handle
-        
-        # Schedule the zip file for deletion after the request is sent
-        @after_this_request
-        def cleanup(response):
-            try:
-                os.remove(zip_path)
-                logger.info(f"Successfully removed temporary zip file: {zip_path}")
-                # Optionally remove the original screenshots too
-                # for file_path in screenshot_paths:
-                #     os.remove(file_path)
-                # logger.info(f"Successfully removed original screenshot files.")
-            except Exception as error:
-                logger.error(f"Error removing temporary zip file {zip_path}: {error}")
-            return response
-            
-        # Send the zip file as an attachment
-        zip_download_name = f"fotos_{referencia_catastral}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        logger.info(f"Sending zip file {zip_path} as attachment: {zip_download_name}")
-        return send_file(zip_path, as_attachment=True, download_name=zip_download_name)
+    except Exception:
+        temp_zip.close()
+        os.remove(zip_path)
+        raise
+    return zip_path
 
-    except Exception as e:
-        logger.error(f"Error processing request for {referencia_catastral}: {str(e)}")
-        # Clean up zip file if it exists and an error occurred before sending
-        if 'zip_path' in locals() and os.path.exists(zip_path):
-             try:
-                 os.remove(zip_path)
-                 logger.info(f"Cleaned up zip file {zip_path} after error.")
-             except Exception as cleanup_error:
-                 logger.error(f"Error cleaning up zip file {zip_path} after error: {cleanup_error}")
-        return jsonify({'error': str(e)}), 500
+def aerial_photos_job(job):
+    """Job handler: capture the photos for job.params and zip them"""
+    referencia_catastral = job.params['referencia_catastral']
+    engine = job.params.get('engine', AERIAL_ENGINE)
+    if engine not in AERIAL_ENGINES:
+        raise ValueError(f"Invalid engine, use one of: {', '.join(AERIAL_ENGINES)}")
+    with photo_workdir() as workdir:
+        screenshot_paths = get_aerial_photos(referencia_catastral, workdir, progress=job.report, engine=engine)
+        if not screenshot_paths:
+            raise Exception('No screenshots were generated, check the reference or logs')
+        zip_path = zip_photos(referencia_catastral, screenshot_paths)
+
+    return {
+        'path': zip_path,
+        'download_name': f"fotos_{referencia_catastral}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        'mimetype': 'application/zip',
+        # The zip is removed once sent (or when the job expires)
+        'delete_after': True,
+    }
+
+def photo_year(path):
+    """The year in a photo's file name (foto_<referencia>_<year>_<timestamp>.<ext>)"""
+    return int(os.path.basename(path).rsplit('_', 3)[1])
+
+def photo_manifest(streamed, duplicates):
+    """manifest.json of a streamed ZIP: every year's outcome"""
+    manifest = []
+    for year in years_to_screenshot:
+        if year in streamed:
+            entry = {'year': year, 'status': 'ok', 'filename': os.path.basename(streamed[year])}
+        elif year in duplicates:
+            entry = {'year': year, 'status': 'dropped'}
+        else:
+            entry = {'year': year, 'status': 'failed'}
+        if year in duplicates:
+            entry['duplicate_of'] = duplicates[year]
+        manifest.append(entry)
+    return json.dumps(manifest, indent=2)
+
+def aerial_photos_stream_job(job):
+    """
+    Job handler: capture the photos for job.params and add each to the
+    job's ZipStream as soon as it is taken, then a manifest.json listing
+    every year's outcome
+    """
+    zip_stream = job.params.get('zip_stream')
+    if zip_stream is None:
+        raise ValueError("Streaming jobs are created by the photo routes, use kind 'photos' instead")
+    referencia_catastral = job.params['referencia_catastral']
+    engine = job.params.get('engine', AERIAL_ENGINE)
+    streamed = {}
+    duplicates = {}
+
+    def on_capture(year, path, duplicate_of=None):
+        if duplicate_of:
+            duplicates[year] = duplicate_of
+        if path is None:
+            return
+        try:
+            zip_stream.add_file(path, os.path.basename(path))
+        except FileNotFoundError:
+            # A fresh capture the cache evicted before it got here, the manifest reports it failed
+            logger.warning(f"Photo {path} disappeared before it was streamed, leaving it out")
+            return
+        streamed[year] = path
+
+    # The stream opens each photo as it is added, so the checkouts can go with the job
+    try:
+        with photo_workdir() as workdir:
+            get_aerial_photos(referencia_catastral, workdir, progress=job.report, engine=engine,
+                              on_capture=on_capture)
+        if streamed:
+            zip_stream.add_bytes('manifest.json', photo_manifest(streamed, duplicates))
+    finally:
+        zip_stream.close()
+    if not streamed:
+        raise Exception('No screenshots were generated, check the reference or logs')
+    return {'streamed': len(streamed)}
+
+def stream_zipped_photos(referencia_catastral, engine=AERIAL_ENGINE):
+    """
+    Send the ZIP while it is being produced: each year's photo goes out as
+    soon as it is captured, so the first bytes follow the first capture.
+    """
+    zip_stream = ZipStream()
+    try:
+        job = job_queue.submit('photos_stream', referencia_catastral=referencia_catastral, engine=engine,
+                               zip_stream=zip_stream)
+    except QueueFull as e:
+        return queue_full_response(e)
+    if not zip_stream.wait_started(JOB_WAIT_TIMEOUT):
+        # Closed empty means the job is failing, otherwise it is still on its first photo
+        if not zip_stream.closed or not job.done.wait(JOB_WAIT_TIMEOUT):
+            job_queue.discard(job)
+            logger.warning(f"Job {job.id} captured nothing in {JOB_WAIT_TIMEOUT:.0f}s, no longer waiting for it")
+            return jsonify({'error': 'The capture is taking too long; the photos it takes are cached, '
+                                     'try again later'}), 504
+        # Nothing was captured: answer with the job's error instead of an empty ZIP
+        job_queue.discard(job)
+        return send_job_result(job)
+
+    def generate():
+        try:
+            yield from zip_stream
+        finally:
+            job_queue.discard(job)
+
+    download_name = f"fotos_{referencia_catastral}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        # Let proxies pass each chunk through instead of buffering the response
+        'X-Accel-Buffering': 'no',
+        # Progress of the capture while the ZIP downloads
+        'X-Job-Events': f'/jobs/{job.id}/events',
+    })
+
+def send_photos(referencia_catastral, engine=AERIAL_ENGINE):
+    """Stream the ZIP, or build it first and send it whole when AERIAL_STREAM_ZIP=0"""
+    if engine not in AERIAL_ENGINES:
+        return jsonify({'error': f"Invalid engine, use one of: {', '.join(AERIAL_ENGINES)}"}), 400
+    response = send_cached_photos(referencia_catastral, engine)
+    if response is not None:
+        return response
+    if AERIAL_STREAM_ZIP:
+        return stream_zipped_photos(referencia_catastral, engine)
+    return process_and_zip_photos(referencia_catastral, engine)
+
+def send_cached_photos(referencia_catastral, engine=AERIAL_ENGINE):
+    """
+    The ZIP straight from the cache when every year is in it, with no
+    queueing behind the captures; None when a year has to be captured
+    """
+    if not AERIAL_CACHE:
+        return None
+    with photo_workdir() as workdir:
+        cached = cached_photos(referencia_catastral, engine, workdir)
+        if len(cached) < len(years_to_screenshot):
+            return None
+        logger.info(f"Every aerial photo of {referencia_catastral} is cached, sending them without a job")
+        download_name = f"fotos_{referencia_catastral}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        paths = [cached[year] for year in years_to_screenshot]
+        if AERIAL_STREAM_ZIP:
+            # The stream holds the photos open, so the checkouts can go right away
+            zip_stream = ZipStream()
+            for path in paths:
+                zip_stream.add_file(path, os.path.basename(path))
+            zip_stream.add_bytes('manifest.json', photo_manifest(cached, {}))
+            zip_stream.close()
+            return Response(iter(zip_stream), mimetype='application/zip', headers={
+                'Content-Disposition': f'attachment; filename="{download_name}"',
+                'X-Accel-Buffering': 'no',
+            })
+        zip_path = zip_photos(referencia_catastral, paths)
+    response = send_result({'path': zip_path, 'download_name': download_name, 'mimetype': 'application/zip'})
+    response.call_on_close(lambda: os.remove(zip_path))
+    return response
+
+def process_and_zip_photos(referencia_catastral, engine=AERIAL_ENGINE):
+    """Helper function to get photos, zip them, and return for download."""
+    if engine not in AERIAL_ENGINES:
+        return jsonify({'error': f"Invalid engine, use one of: {', '.join(AERIAL_ENGINES)}"}), 400
+    return run_job_and_send(job_queue, 'photos', referencia_catastral=referencia_catastral, engine=engine)
+
+# Every capture, synchronous or not, goes through this bounded queue
+def warm_browser():
+    if BROWSER_ENGINE == 'async':
+        async_engine.warm()
+    else:
+        browser_pool.start()
+        wait_until(lambda: browser_pool.stats()['alive'] > 0)
+
+def preload_visor_page(page):
+    """Load the visor once so its assets are cached before the first request"""
+    start_loading_visor(page)
+    page.wait_for_load_state("networkidle", timeout=90000)
+
+def preload_visor():
+    if BROWSER_ENGINE == 'async':
+        async_engine.run(async_steps.load_visor, 'aerial', visor_url=IDEIB_VISOR_URL)
+    else:
+        browser_pool.run(preload_visor_page)
+
+warmup = Warmup()
+
+job_queue = JobQueue({'photos': warmup.record_first_result('photos', aerial_photos_job),
+                      'photos_stream': warmup.record_first_result('photos_stream', aerial_photos_stream_job)},
+                     # Each job worker blocks on its capture, the async engine needs one per context to fill them
+                     workers=max(JOB_WORKERS, async_engine.max_contexts) if BROWSER_ENGINE == 'async' else JOB_WORKERS,
+                     governor=governor)
+register_job_routes(app, job_queue)
+register_health_routes(app, warmup)
+metrics.register_metrics_route(app, browser_pool=browser_pool.stats, async_engine=async_engine.stats,
+                               jobs=job_queue.stats,
+                               asset_cache=asset_cache.asset_cache.stats,
+                               parcel_index=parcel_resolver.parcel_index.stats, coalescing=photos_flight.stats,
+                               photo_cache=photo_cache.stats, memory=governor.stats, forensics=forensics.stats,
+                               warmup=warmup.gauges)
+# Launch the browser (and load the visor once) before the first request
+warmup.start([('browser_start', warm_browser)] + ([('visor_preload', preload_visor)] if WARMUP_PRELOAD else []))
 
 # Removed the /screenshots/<path:filename> route as it's no longer needed
 # @app.route('/screenshots/<path:filename>')
@@ -0,0 +1,155 @@
+"""
+Memory governor for the 1 GB VM.
+
+Chromium runs with --single-process, and two renders at once or one long
+aerial run can take the VM past its memory, which restarts the machine.
+The governor watches the RSS of the app and the browsers it started (and
+the machine's available memory) and:
+
+- rejects new jobs (503 with Retry-After) while memory is past GOVERNOR_REJECT_MB,
+- holds queued jobs until there is GOVERNOR_JOB_MB of headroom for them,
+- has a browser recycled once it grows past GOVERNOR_BROWSER_RECYCLE_MB.
+
+A job is always let through when nothing else is running, since waiting
+could not free anything.
+"""
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+GOVERNOR = os.environ.get('GOVERNOR', '1') != '0'
+MEMORY_LIMIT_MB = float(os.environ.get('MEMORY_LIMIT_MB', 1024))
+GOVERNOR_JOB_MB = float(os.environ.get('GOVERNOR_JOB_MB', 250))  # expected growth of one running job
+GOVERNOR_REJECT_MB = float(os.environ.get('GOVERNOR_REJECT_MB', 900))
+GOVERNOR_BROWSER_RECYCLE_MB = float(os.environ.get('GOVERNOR_BROWSER_RECYCLE_MB', 600))
+# A newly admitted job counts as GOVERNOR_JOB_MB until its memory has had time to show up
+GOVERNOR_SETTLE_SECONDS = float(os.environ.get('GOVERNOR_SETTLE_SECONDS', 10))
+GOVERNOR_POLL_SECONDS = 1.0
+
+
+class Overloaded(Exception):
+    """Raised when a job is submitted while memory is past the rejection threshold"""
+
+
+def available_bytes():
+    """MemAvailable of the machine, or None where /proc/meminfo cannot be read"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+class MemoryGovernor:
+    """Admission control and browser recycling driven by measured memory"""
+
+    def __init__(self, enabled=GOVERNOR, limit_mb=MEMORY_LIMIT_MB, job_mb=GOVERNOR_JOB_MB,
+                 reject_mb=GOVERNOR_REJECT_MB, recycle_mb=GOVERNOR_BROWSER_RECYCLE_MB,
+                 settle_seconds=GOVERNOR_SETTLE_SECONDS):
+        self.enabled = enabled
+        self.limit_bytes = limit_mb * MB
+        self.job_bytes = job_mb * MB
+        self.reject_bytes = reject_mb * MB
+        self.recycle_bytes = recycle_mb * MB
+        self.settle_seconds = settle_seconds
+        self._lock = threading.Lock()
+        self._admitted_at = []
+        self._counters = {'admitted': 0, 'delayed': 0, 'forced': 0, 'rejected': 0, 'recycles': 0}
+
+    def usage(self):
+        """(bytes used by the app and its browsers, bytes of headroom left)"""
+        used = metrics.rss_bytes(os.getpid()) + metrics.browser_memory()['rss_bytes']
+        headroom = self.limit_bytes - used
+        available = available_bytes()
+        if available is not None:
+            headroom = min(headroom, available)
+        return used, headroom
+
+    def _reserved_bytes(self, now):
+        self._admitted_at = [at for at in self._admitted_at if now - at < self.settle_seconds]
+        return len(self._admitted_at) * self.job_bytes
+
+    def check_submission(self):
+        """Raise Overloaded if memory is already too high to take more work"""
+        if not self.enabled:
+            return
+        used, _ = self.usage()
+        if used > self.reject_bytes:
+            with self._lock:
+                self._counters['rejected'] += 1
+            logger.warning(f"Rejecting job, memory at {used / MB:.0f} MB")
+            raise Overloaded(f"Server is low on memory ({used / MB:.0f} MB in use), try again later")
+
+    def wait_for_headroom(self, running, report=None):
+        """
+        Block until a job fits in memory. running() returns the number of
+        jobs in progress; report(step) is told once if the job has to wait.
+        """
+        if not self.enabled:
+            return
+        waiting_since = None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                used, headroom = self.usage()
+                reserved = self._reserved_bytes(now)
+                idle = running() == 0 and not reserved
+                if headroom - reserved >= self.job_bytes or idle:
+                    if headroom - reserved < self.job_bytes:
+                        self._counters['forced'] += 1
+                        logger.warning(f"Starting a job with {headroom / MB:.0f} MB of headroom, nothing else is running")
+                    elif waiting_since is not None:
+                        logger.info(f"Job admitted after waiting {now - waiting_since:.1f}s for memory")
+                    self._admitted_at.append(now)
+                    self._counters['admitted'] += 1
+                    return
+                first_wait = waiting_since is None
+                if first_wait:
+                    waiting_since = now
+                    self._counters['delayed'] += 1
+            if first_wait:
+                logger.info(f"Holding a job: {used / MB:.0f} MB in use, {headroom / MB:.0f} MB of headroom")
+                if report:
+                    report("Waiting for memory")
+            time.sleep(GOVERNOR_POLL_SECONDS)
+
+    def should_recycle_browser(self, pool):
+        """BrowserPool recycle check: True when the average browser has grown past the threshold"""
+        if not self.enabled:
+            return False
+        browsers = metrics.browser_memory()['rss_bytes']
+        per_browser = browsers / max(1, pool.stats()['alive'])
+        if per_browser <= self.recycle_bytes:
+            return False
+        with self._lock:
+            self._counters['recycles'] += 1
+        logger.warning(f"Browser memory at {per_browser / MB:.0f} MB, recycling")
+        return True
+
+    def stats(self):
+        used, headroom = self.usage()
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'enabled': self.enabled,
+                'used_bytes': used,
+                'headroom_bytes': headroom,
+                'reserved_bytes': self._reserved_bytes(time.monotonic()),
+                'limit_bytes': self.limit_bytes,
+                'reject_bytes': self.reject_bytes,
+                'recycle_bytes': self.recycle_bytes,
+            })
+        return stats
+
+
+governor = MemoryGovernor()
@@ -0,0 +1,22 @@
+"""
+Pooled HTTP session shared by the browserless code paths (print service,
+Catastro lookups), so connections to the same hosts are reused.
+"""
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 8))
+
+
+def _make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = _make_session()
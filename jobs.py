@@ -0,0 +1,414 @@
+"""
+Asynchronous job API backed by a bounded queue of worker threads.
+
+POST /jobs returns a job id straight away, GET /jobs/<id> reports status and
+progress, GET /jobs/<id>/events streams them as Server-Sent Events and
+GET /jobs/<id>/result sends the finished file. The synchronous
+routes submit a job and wait for it, so every render goes through the same
+queue and its depth and throughput can be observed and tuned. A memory
+governor, if given, can turn submissions away and hold queued jobs until
+there is room for them.
+
+Jobs, their event streams and results live in the memory of the process
+that created them, so the job API needs the app to run in a single
+process: register_job_routes takes a lock on JOB_LOCK_DIR/ideib-jobs-<app>.lock
+and a second worker of the same app fails to start.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import Response, jsonify, request, send_file, after_this_request
+
+import metrics
+from governor import Overloaded
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 20))
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', 3600))  # seconds a finished job is kept
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 30))  # seconds suggested to rejected clients
+JOB_EVENTS_KEEPALIVE = float(os.environ.get('JOB_EVENTS_KEEPALIVE', 15))  # seconds between SSE keep-alives
+# Seconds a synchronous route waits for its job before pointing the client at it (under gunicorn's 600 s timeout)
+JOB_WAIT_TIMEOUT = float(os.environ.get('JOB_WAIT_TIMEOUT', 540))
+JOB_LOCK_DIR = os.environ.get('JOB_LOCK_DIR', tempfile.gettempdir())
+# A graceful restart starts the new worker before the old one has gone
+PROCESS_LOCK_TIMEOUT = 30
+
+_process_locks = {}
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+class Job:
+    """
+    One unit of work. Handlers read `params`, call `report(step)` as they go
+    and return a result dict with the file to send:
+    {'path', 'download_name', 'mimetype', optional 'etag', 'last_modified',
+    'headers' and 'delete_after' (remove the file when the job expires)}.
+    """
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'
+        self.progress = None
+        self.steps = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.changed = threading.Condition()
+
+    def report(self, step):
+        """Record progress; called from whichever thread is doing the work"""
+        with self.changed:
+            self.progress = step
+            self.steps.append({'step': step, 'at': time.time()})
+            self.changed.notify_all()
+        logger.info(f"Job {self.id} ({self.kind}): {step}")
+
+    def notify(self):
+        """Wake the event streams after a status change"""
+        with self.changed:
+            self.changed.notify_all()
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'steps': [{'step': s['step'], 'elapsed_seconds': round(s['at'] - self.created_at, 3)}
+                      for s in list(self.steps)],
+            'created_at': datetime.fromtimestamp(self.created_at).isoformat(),
+            'status_url': f'/jobs/{self.id}',
+        }
+        if self.started_at is not None:
+            data['queue_wait_seconds'] = round(self.started_at - self.created_at, 3)
+        if self.finished_at is not None:
+            data['run_seconds'] = round(self.finished_at - self.started_at, 3)
+        if self.status == 'done':
+            data['result_url'] = f'/jobs/{self.id}/result'
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+
+class JobQueue:
+    """Bounded FIFO of jobs processed by a fixed number of worker threads"""
+
+    def __init__(self, handlers, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, result_ttl=JOB_RESULT_TTL,
+                 governor=None):
+        self.handlers = handlers
+        self.governor = governor
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self._queue_wait_total = 0.0
+        self._run_total = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind, **params):
+        """Queue a job and return it; raises QueueFull (also when low on memory) or ValueError for unknown kinds"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind '{kind}', expected one of: {', '.join(self.handlers)}")
+        if self.governor is not None:
+            try:
+                self.governor.check_submission()
+            except Overloaded as e:
+                with self._lock:
+                    self._counters['rejected'] += 1
+                raise QueueFull(str(e))
+        self.start()
+        self._purge_expired()
+        job = Job(kind, params)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise QueueFull(f"Job queue is full ({self.max_queued} jobs waiting)")
+        with self._lock:
+            self._jobs[job.id] = job
+            self._counters['submitted'] += 1
+        logger.info(f"Queued job {job.id} ({kind}), {self._queue.qsize()} job(s) waiting")
+        return job
+
+    def get(self, job_id):
+        self._purge_expired()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if self.governor is not None:
+                self.governor.wait_for_headroom(lambda: self._busy, job.report)
+            with self._lock:
+                self._busy += 1
+            job.status = 'running'
+            job.started_at = time.time()
+            job.notify()
+            try:
+                job.result = self.handlers[job.kind](job)
+                job.status = 'done'
+            except Exception as e:
+                logger.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished_at = time.time()
+            with self._lock:
+                self._busy -= 1
+                self._counters['completed' if job.status == 'done' else 'failed'] += 1
+                self._queue_wait_total += job.started_at - job.created_at
+                self._run_total += job.finished_at - job.started_at
+            metrics.observe_job(job)
+            job.done.set()
+            job.notify()
+
+    def discard(self, job, delay=0):
+        """Forget a job and delete its result file if it owns it"""
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        result = job.result or {}
+        if not result.get('delete_after'):
+            return
+
+        def delete(path):
+            time.sleep(delay)  # Give the response time to open the file
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                    logger.info(f"Removed result file of job {job.id}: {path}")
+            except Exception as error:
+                logger.error(f"Error removing result file {path}: {error}")
+        threading.Thread(target=delete, args=(result['path'],)).start()
+
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+        for job in expired:
+            self.discard(job)
+
+    def stats(self):
+        with self._lock:
+            finished = self._counters['completed'] + self._counters['failed']
+            stats = dict(self._counters)
+            stats.update({
+                'workers': self.workers,
+                'busy': self._busy,
+                'queued': self._queue.qsize(),
+                'max_queued': self.max_queued,
+                'tracked_jobs': len(self._jobs),
+                'avg_queue_wait_seconds': self._queue_wait_total / finished if finished else 0.0,
+                'avg_run_seconds': self._run_total / finished if finished else 0.0,
+            })
+        return stats
+
+
+def queue_full_response(error):
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+    return response
+
+
+def job_pending_response(job):
+    """202 for a synchronous request that stopped waiting: the job goes on and can be followed at its URL"""
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response
+
+
+def send_job_result(job):
+    """Response for a job: its file when done, an error or its status otherwise"""
+    if job.status == 'failed':
+        return jsonify({'error': job.error, 'job': job.to_dict()}), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 409
+    result = job.result
+    if not result.get('path') or not os.path.exists(result['path']):
+        return jsonify({'error': 'Result file is no longer available'}), 410
+    try:
+        return send_result(result)
+    except FileNotFoundError:
+        return jsonify({'error': 'Result file is no longer available'}), 410
+
+
+def send_result(result):
+    """Send a result dict (see Job) as an attachment; FileNotFoundError if its file has gone"""
+    logger.info(f"Sending {result['path']} as attachment: {result['download_name']}")
+    last_modified = result.get('last_modified')
+    response = send_file(result['path'], as_attachment=True, download_name=result['download_name'],
+                         mimetype=result.get('mimetype'), conditional=True, etag=result.get('etag', True),
+                         last_modified=datetime.fromtimestamp(last_modified) if last_modified else None)
+    response.headers.update(result.get('headers', {}))
+    return response
+
+
+def _event(name, data, event_id=None):
+    lines = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{lines}event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+def job_events(job, first_step=0, keepalive=JOB_EVENTS_KEEPALIVE):
+    """
+    Server-Sent Events for a job: 'status' on every status change, 'step'
+    for each progress step (with its id, so a reconnecting client resumes
+    after Last-Event-ID) and a final 'done' or 'failed' with the job,
+    including its result_url. Waits on the job's condition, not polling.
+    """
+    with job.changed:
+        # A stale or forged Last-Event-ID must not index past the steps or count from the end
+        sent = min(max(first_step, 0), len(job.steps))
+    status = None
+    while True:
+        with job.changed:
+            if sent >= len(job.steps) and status == job.status and not job.done.is_set():
+                job.changed.wait(keepalive)
+            steps = job.steps[sent:]
+            current = job.status
+        previous_at = job.steps[sent - 1]['at'] if sent else job.created_at
+        for index, step in enumerate(steps, start=sent):
+            yield _event('step', {'step': step['step'],
+                                  'elapsed_seconds': round(step['at'] - job.created_at, 3),
+                                  'step_seconds': round(step['at'] - previous_at, 3)}, event_id=index + 1)
+            previous_at = step['at']
+        sent += len(steps)
+        status_changed = current != status
+        if status_changed:
+            status = current
+            yield _event('status', {'status': status})
+        if job.done.is_set() and sent >= len(job.steps):
+            yield _event(job.status if job.status in ('done', 'failed') else 'done', job.to_dict())
+            return
+        if not steps and not status_changed:
+            yield ': keep-alive\n\n'
+
+
+def job_events_response(job):
+    try:
+        first_step = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        first_step = 0
+    return Response(job_events(job, first_step), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def run_job_and_send(job_queue, kind, **params):
+    """Synchronous wrapper: submit a job, wait for it and send its result"""
+    try:
+        job = job_queue.submit(kind, **params)
+    except QueueFull as e:
+        return queue_full_response(e)
+    if not job.done.wait(JOB_WAIT_TIMEOUT):
+        logger.warning(f"Job {job.id} ({kind}) still {job.status} after {JOB_WAIT_TIMEOUT:.0f}s, "
+                       f"leaving it to the job API")
+        return job_pending_response(job)
+
+    @after_this_request
+    def cleanup(response):
+        job_queue.discard(job, delay=2)
+        return response
+
+    return send_job_result(job)
+
+
+def hold_process_lock(name, timeout=PROCESS_LOCK_TIMEOUT):
+    """
+    Make this process the only one serving the job API of app `name`;
+    raises RuntimeError if another process still holds it after timeout seconds
+    """
+    path = os.path.join(JOB_LOCK_DIR, f'ideib-jobs-{name}.lock')
+    if path in _process_locks:
+        return
+    lock_file = open(path, 'a')
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                raise RuntimeError(f"Another process serves the job API of {name} ({path} is locked): jobs live "
+                                   f"in process memory, run the app with a single worker")
+            time.sleep(0.5)
+    _process_locks[path] = lock_file
+
+
+def register_job_routes(app, job_queue):
+    """Add the /jobs endpoints to a Flask app, which must then run in a single process"""
+    hold_process_lock(app.name)
+
+    @app.route('/jobs', methods=['POST'])
+    def create_job():
+        params = dict(request.get_json(silent=True) or request.form)
+        kind = params.pop('kind', None)
+        if not params.get('referencia_catastral') and not params.get('referencias'):
+            return jsonify({'error': 'No cadastral reference provided'}), 400
+        try:
+            job = job_queue.submit(kind, **params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except QueueFull as e:
+            return queue_full_response(e)
+        return jsonify(job.to_dict()), 202, {'Location': f'/jobs/{job.id}'}
+
+    @app.route('/jobs', methods=['GET'])
+    def job_queue_stats():
+        return jsonify(job_queue.stats())
+
+    @app.route('/jobs/<string:job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(job.to_dict())
+
+    @app.route('/jobs/<string:job_id>/events', methods=['GET'])
+    def job_event_stream(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return job_events_response(job)
+
+    @app.route('/jobs/<string:job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return send_job_result(job)
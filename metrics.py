@@ -0,0 +1,218 @@
+"""
+Prometheus metrics for the browser flows, served on /metrics.
+
+Every visor step is timed and counted per flow and step name; a step that
+swallows its exception and returns False (or None, for steps that return a
+value) counts as failed. Jobs report queue wait and end-to-end time, and
+the stats() snapshots of the pool, caches and queue are exported as gauges,
+together with the memory of the browser processes started by this app.
+"""
+import contextvars
+import functools
+import inspect
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest)
+from prometheus_client.core import GaugeMetricFamily
+
+import forensics
+
+logger = logging.getLogger(__name__)
+
+STEP_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180)
+JOB_BUCKETS = (1, 5, 10, 20, 30, 60, 120, 180, 300, 600, 1200)
+
+STEP_SECONDS = Histogram('ideib_step_duration_seconds', 'Duration of a visor step',
+                         ['flow', 'step'], buckets=STEP_BUCKETS)
+STEP_TOTAL = Counter('ideib_steps_total', 'Visor steps run, by outcome', ['flow', 'step', 'outcome'])
+STEP_RETRIES = Counter('ideib_step_retries_total', 'Visor steps retried after failing or missing their post-condition',
+                       ['flow', 'step'])
+JOB_QUEUE_WAIT_SECONDS = Histogram('ideib_job_queue_wait_seconds', 'Time a job waited for a worker',
+                                   ['kind'], buckets=JOB_BUCKETS)
+JOB_SECONDS = Histogram('ideib_job_duration_seconds', 'Time from job submission to its end',
+                        ['kind', 'status'], buckets=JOB_BUCKETS)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Flow label for steps shared by both flows (see async_steps.py); each
+# render sets it in its own asyncio task
+current_flow = contextvars.ContextVar('current_flow', default='unknown')
+
+
+def _record_step(flow, step, started, ok):
+    STEP_SECONDS.labels(flow, step).observe(time.monotonic() - started)
+    STEP_TOTAL.labels(flow, step, 'success' if ok else 'failure').inc()
+    if not ok:
+        logger.warning(f"Step '{step}' ({flow}) failed")
+
+
+def step(flow=None, name=None, returns_value=False):
+    """
+    Decorator timing a step function or coroutine. The step fails if it
+    raises, returns False, or returns None when returns_value is set, and
+    the first failure on a page writes its forensics bundle (the page is the
+    step's first argument). With no flow, the label comes from current_flow.
+    """
+    def decorator(fn):
+        step_name = name or fn.__name__
+
+        def succeeded(result):
+            return result is not False and not (returns_value and result is None)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.monotonic()
+                label = flow or current_flow.get()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    _record_step(label, step_name, started, False)
+                    await forensics.step_failed_async(args[0] if args else None, label, step_name, str(e))
+                    raise
+                ok = succeeded(result)
+                _record_step(label, step_name, started, ok)
+                if not ok:
+                    await forensics.step_failed_async(args[0] if args else None, label, step_name)
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            label = flow or current_flow.get()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                _record_step(label, step_name, started, False)
+                forensics.step_failed(args[0] if args else None, label, step_name, str(e))
+                raise
+            ok = succeeded(result)
+            _record_step(label, step_name, started, ok)
+            if not ok:
+                forensics.step_failed(args[0] if args else None, label, step_name)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed_step(flow, name):
+    """Context manager timing a block as a step; it fails if the block raises"""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        _record_step(flow, name, started, False)
+        raise
+    _record_step(flow, name, started, True)
+
+
+def observe_job(job):
+    """Record a finished job's queue wait and end-to-end time"""
+    if job.started_at is not None:
+        JOB_QUEUE_WAIT_SECONDS.labels(job.kind).observe(job.started_at - job.created_at)
+    if job.finished_at is not None:
+        JOB_SECONDS.labels(job.kind, job.status).observe(job.finished_at - job.created_at)
+
+
+def _children():
+    """pid -> parent pid for every process, read from /proc"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the fields after it do not
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return parents
+
+
+def descendant_pids(pid=None):
+    """Every process started, directly or not, by pid (this process by default)"""
+    pid = pid or os.getpid()
+    parents = _children()
+    found = []
+    frontier = [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [child for child, ppid in parents.items() if ppid == parent]
+        found.extend(children)
+        frontier.extend(children)
+    return found
+
+
+def rss_bytes(pid):
+    """Resident memory of one process, 0 if it has gone"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def browser_server_pids():
+    """The shared browser server's Chromium and its children, if one is in use"""
+    pid_file = os.environ.get('BROWSER_SERVER_PID_FILE')
+    if not pid_file or not os.environ.get('BROWSER_CDP_URL'):
+        return []
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return []
+    return [pid] + descendant_pids(pid)
+
+
+def browser_memory():
+    """RSS of the Playwright driver and the Chromium processes it started or connects to"""
+    if not os.path.isdir('/proc'):
+        return {'processes': 0, 'rss_bytes': 0}
+    pids = descendant_pids() + browser_server_pids()
+    return {'processes': len(pids), 'rss_bytes': sum(rss_bytes(pid) for pid in pids)}
+
+
+class StatsCollector:
+    """Exports the numeric values of stats() snapshots as ideib_<name>_<key> gauges"""
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, name, stats):
+        self.sources[name] = stats
+
+    def collect(self):
+        for name, stats in list(self.sources.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Could not read {name} stats for metrics: {str(e)}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                    continue
+                yield GaugeMetricFamily(f'ideib_{name}_{key}', f'{name} {key.replace("_", " ")}', value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+stats_collector.add('browser_memory', browser_memory)
+
+
+def register_metrics_route(app, **sources):
+    """Add /metrics to a Flask app, exporting each stats() callable in sources as gauges"""
+    for name, stats in sources.items():
+        stats_collector.add(name, stats)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,293 @@
+"""
+Cadastral reference -> parcel geometry, backed by a persistent SQLite index.
+
+The index holds, per parcel, its bounding box and outline (from the Catastro
+INSPIRE WFS or a bulk import) and the map extent the visor showed after
+locating it. Browser flows use the latter to jump straight to the parcel
+instead of going through the locate UI; the browserless engines use the
+former. Unknown references are fetched from Catastro and remembered.
+
+Bulk import from a CSV with columns
+referencia_catastral,xmin,ymin,xmax,ymax[,geometry]:
+
+    python parcel_resolver.py import parcels.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from http_client import session, HTTP_TIMEOUT
+from result_cache import normalise_reference
+
+logger = logging.getLogger(__name__)
+
+PARCEL_INDEX_PATH = os.environ.get('PARCEL_INDEX_PATH', os.path.join(os.getcwd(), 'downloads', 'parcels.sqlite'))
+CATASTRO_WFS_URL = os.environ.get('CATASTRO_WFS_URL', 'https://ovc.catastro.meh.es/INSPIRE/wfsCP.aspx')
+CATASTRO_COORDINATES_URL = os.environ.get(
+    'CATASTRO_COORDINATES_URL',
+    'https://ovc.catastro.meh.es/ovcservweb/OVCSWLocalizacionRC/OVCCoordenadas.asmx/Consulta_CPMRC')
+# Half-size of the box used when Catastro only returns the parcel centroid
+PARCEL_CENTROID_BUFFER = float(os.environ.get('PARCEL_CENTROID_BUFFER', 25))
+
+# ETRS89 / UTM 31N, the visor's spatial reference
+SPATIAL_REFERENCE = 25831
+
+# geometry is a list of rings, each a list of [x, y]; view_extent the map
+# extent (dict with wkid) the visor showed after locating the parcel
+Parcel = namedtuple('Parcel', 'referencia_catastral xmin ymin xmax ymax wkid geometry view_extent source')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parcels (
+    referencia_catastral TEXT PRIMARY KEY,
+    xmin REAL, ymin REAL, xmax REAL, ymax REAL, wkid INTEGER,
+    geometry TEXT,
+    view_extent TEXT,
+    source TEXT,
+    updated_at REAL
+)
+"""
+
+JUMP_TO_EXTENT_SCRIPT = """
+([xmin, ymin, xmax, ymax, wkid]) => new Promise((resolve) => {
+    const map = window._viewerMap;
+    if (!map || !window.require || !map.spatialReference || map.spatialReference.wkid !== wkid) {
+        resolve(false);
+        return;
+    }
+    window.require(['esri/geometry/Extent', 'esri/SpatialReference'], (Extent, SpatialReference) => {
+        map.setExtent(new Extent(xmin, ymin, xmax, ymax, new SpatialReference({wkid: wkid})), true)
+            .then(() => resolve(true), () => resolve(false));
+    });
+})
+"""
+
+READ_EXTENT_SCRIPT = """
+() => {
+    const map = window._viewerMap;
+    if (!map || !map.extent) return null;
+    const e = map.extent;
+    return {xmin: e.xmin, ymin: e.ymin, xmax: e.xmax, ymax: e.ymax, wkid: e.spatialReference.wkid};
+}
+"""
+
+
+class ParcelNotFound(Exception):
+    """Raised when Catastro has no geometry for the reference"""
+
+
+def parcel_key(referencia_catastral):
+    """Parcels are identified by the first 14 characters of the reference"""
+    return normalise_reference(referencia_catastral)[:14]
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def fetch_from_catastro(referencia_catastral):
+    """Parcel outline from the INSPIRE WFS, or a box around the OVC centroid"""
+    key = parcel_key(referencia_catastral)
+    try:
+        response = session.get(CATASTRO_WFS_URL, params={
+            'service': 'wfs', 'version': '2', 'request': 'getfeature',
+            'STOREDQUERIE_ID': 'GetParcel', 'refcat': key, 'srsname': f'EPSG:{SPATIAL_REFERENCE}',
+        }, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        rings = []
+        for element in ET.fromstring(response.content).iter():
+            if _local_name(element.tag) == 'posList' and element.text:
+                values = [float(v) for v in element.text.split()]
+                rings.append([[values[i], values[i + 1]] for i in range(0, len(values) - 1, 2)])
+        if rings:
+            xs = [x for ring in rings for x, _ in ring]
+            ys = [y for ring in rings for _, y in ring]
+            return Parcel(key, min(xs), min(ys), max(xs), max(ys), SPATIAL_REFERENCE, rings, None, 'catastro_wfs')
+    except Exception as e:
+        logger.warning(f"Catastro WFS lookup failed for {key}: {str(e)}")
+
+    response = session.get(CATASTRO_COORDINATES_URL, params={
+        'Provincia': '', 'Municipio': '', 'SRS': f'EPSG:{SPATIAL_REFERENCE}', 'RC': key,
+    }, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    values = {}
+    for element in ET.fromstring(response.content).iter():
+        name = _local_name(element.tag)
+        if name in ('xcen', 'ycen', 'des') and element.text:
+            values.setdefault(name, element.text.strip())
+    if 'xcen' not in values or 'ycen' not in values:
+        raise ParcelNotFound(f"Catastro could not locate {key}: {values.get('des', 'no coordinates')}")
+    x, y = float(values['xcen']), float(values['ycen'])
+    b = PARCEL_CENTROID_BUFFER
+    return Parcel(key, x - b, y - b, x + b, y + b, SPATIAL_REFERENCE, None, None, 'catastro_centroid')
+
+
+class ParcelIndex:
+    """SQLite-backed index of parcel geometries and visor extents"""
+
+    def __init__(self, path=PARCEL_INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        self._counters = {'hits': 0, 'misses': 0, 'fetched': 0, 'remembered_extents': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def lookup(self, referencia_catastral):
+        """The indexed parcel, or None; never touches the network"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT referencia_catastral, xmin, ymin, xmax, ymax, wkid, geometry, view_extent, source '
+                'FROM parcels WHERE referencia_catastral = ?', (parcel_key(referencia_catastral),)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return Parcel(row[0], row[1], row[2], row[3], row[4], row[5],
+                      json.loads(row[6]) if row[6] else None,
+                      json.loads(row[7]) if row[7] else None, row[8])
+
+    def put(self, parcel):
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO parcels (referencia_catastral, xmin, ymin, xmax, ymax, wkid, geometry, source, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(referencia_catastral) DO UPDATE SET xmin=excluded.xmin, ymin=excluded.ymin, '
+                'xmax=excluded.xmax, ymax=excluded.ymax, wkid=excluded.wkid, geometry=excluded.geometry, '
+                'source=excluded.source, updated_at=excluded.updated_at',
+                (parcel_key(parcel.referencia_catastral), parcel.xmin, parcel.ymin, parcel.xmax, parcel.ymax,
+                 parcel.wkid, json.dumps(parcel.geometry) if parcel.geometry else None, parcel.source, time.time()))
+            self._db.commit()
+
+    def remember_view_extent(self, referencia_catastral, extent):
+        """Store the extent the visor showed after locating the parcel"""
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO parcels (referencia_catastral, view_extent, source, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(referencia_catastral) DO UPDATE SET view_extent=excluded.view_extent, '
+                'updated_at=excluded.updated_at',
+                (parcel_key(referencia_catastral), json.dumps(extent), 'visor', time.time()))
+            self._db.commit()
+        self._count('remembered_extents')
+
+    def resolve(self, referencia_catastral):
+        """Parcel with a known bounding box, fetching it from Catastro if needed"""
+        parcel = self.lookup(referencia_catastral)
+        if parcel is not None and parcel.xmin is not None:
+            return parcel
+        fetched = fetch_from_catastro(referencia_catastral)
+        self._count('fetched')
+        self.put(fetched)
+        return fetched._replace(view_extent=parcel.view_extent if parcel is not None else None)
+
+    def import_csv(self, path):
+        """Bulk-load parcels; returns the number of rows imported"""
+        count = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                geometry = json.loads(row['geometry']) if row.get('geometry') else None
+                self.put(Parcel(row['referencia_catastral'], float(row['xmin']), float(row['ymin']),
+                                float(row['xmax']), float(row['ymax']), int(row.get('wkid') or SPATIAL_REFERENCE),
+                                geometry, None, 'import'))
+                count += 1
+        logger.info(f"Imported {count} parcels from {path}")
+        return count
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = self._db.execute('SELECT COUNT(*) FROM parcels').fetchone()[0]
+        return stats
+
+
+def read_map_extent(page):
+    try:
+        return page.evaluate(READ_EXTENT_SCRIPT)
+    except Exception:
+        return None
+
+
+def shows_extent(page, extent):
+    """True if the visor map contains the centre of extent"""
+    current = read_map_extent(page)
+    if extent is None or current is None or current['wkid'] != extent['wkid']:
+        return False
+    x = (extent['xmin'] + extent['xmax']) / 2
+    y = (extent['ymin'] + extent['ymax']) / 2
+    return current['xmin'] <= x <= current['xmax'] and current['ymin'] <= y <= current['ymax']
+
+
+def indexed_extent(parcel):
+    """The extent to show for an indexed parcel: the visor's remembered one, else its bounding box"""
+    if parcel is None:
+        return None
+    if parcel.view_extent is not None:
+        return parcel.view_extent
+    if parcel.xmin is not None:
+        return {'xmin': parcel.xmin, 'ymin': parcel.ymin, 'xmax': parcel.xmax, 'ymax': parcel.ymax,
+                'wkid': parcel.wkid}
+    return None
+
+
+def jump_to_extent(page, extent):
+    """Set the visor map to extent; False if the map is not ready or uses another spatial reference"""
+    try:
+        return bool(page.evaluate(JUMP_TO_EXTENT_SCRIPT, [extent['xmin'], extent['ymin'], extent['xmax'],
+                                                           extent['ymax'], extent['wkid']]))
+    except Exception as e:
+        logger.error(f"Failed to jump to parcel extent: {str(e)}")
+        return False
+
+
+def centre_map_on_parcel(page, referencia_catastral, locate_with_visor, index=None):
+    """
+    Centre the visor map on the parcel. Jumps straight to the extent in the
+    index when there is one; otherwise runs locate_with_visor() (the locate
+    UI, False when it fails) and remembers the extent it produced. Returns
+    the extent the map was moved to, or None if it was not moved to the parcel.
+    """
+    index = index or parcel_index
+    extent = indexed_extent(index.lookup(referencia_catastral))
+    if extent is not None and jump_to_extent(page, extent):
+        logger.info(f"Jumped straight to the indexed extent of {referencia_catastral}")
+        return extent
+
+    before = read_map_extent(page)
+    if locate_with_visor() is False:
+        return None
+    after = read_map_extent(page)
+    # Only remember extents the locate actually moved the map to
+    if after is None or after == before:
+        logger.warning(f"Locating {referencia_catastral} did not move the map")
+        return None
+    index.remember_view_extent(referencia_catastral, after)
+    return after
+
+
+parcel_index = ParcelIndex()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Manage the cadastral parcel index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Bulk-import parcels from a CSV file')
+    import_parser.add_argument('csv_path')
+    lookup_parser = subparsers.add_parser('resolve', help='Resolve a reference (fetching it if unknown)')
+    lookup_parser.add_argument('referencia_catastral')
+    args = parser.parse_args()
+    if args.command == 'import':
+        print(f"Imported {parcel_index.import_csv(args.csv_path)} parcels")
+    else:
+        print(json.dumps(parcel_index.resolve(args.referencia_catastral)._asdict(), indent=2))
@@ -1,11 +1,28 @@
-from playwright.sync_api import sync_playwright
 import time
 import logging
-from flask import Flask, render_template, request, send_file, jsonify, after_this_request
+from flask import Flask, render_template, request, jsonify
 import os
-from datetime import datetime
+import re
+import json
 import tempfile
-import threading
+import zipfile
+from datetime import datetime
+from browser_pool import BrowserPool, chromium_launch_options, VIEWPORT
+from async_engine import AsyncBrowserEngine
+import async_steps
+from result_cache import ResultCache, normalise_reference
+from singleflight import SingleFlight
+import parcel_resolver
+import request_filter
+import asset_cache
+import forensics
+import metrics
+from governor import governor
+from warmup import Warmup, WARMUP_PRELOAD, register_health_routes, wait_until
+import print_service
+from jobs import JOB_WORKERS, JobQueue, register_job_routes, run_job_and_send, send_result
+import waits
+from step_sequence import Step, StepSequence, StepFailed, retry_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +30,9 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# Overridable so the flows can run against the stand-in visor in bench/
+IDEIB_VISOR_URL = os.environ.get('IDEIB_VISOR_URL', 'https://ideib.caib.es/visor/')
+
 def maximize_window(page):
     """Maximize the browser window"""
     try:
@@ -21,20 +41,23 @@ def maximize_window(page):
     except Exception as e:
         logger.error(f"Failed to maximize window: {str(e)}")
 
+OK_SELECTOR = 'div.jimu-btn.jimu-float-trailing.enable-btn[data-dojo-attach-point="okNode"]'
+
+@metrics.step('pdf')
 def close_initial_modal(page):
     """Close the initial modal that appears when the page loads"""
     try:
         logger.info("Waiting for the initial modal to appear...")
-        ok_button = page.locator('div.jimu-btn.jimu-float-trailing.enable-btn[data-dojo-attach-point="okNode"]')
-        time.sleep(5)
-        ok_button.wait_for(state="visible")  # Wait for the button to be visible
+        waits.wait_for_visible(page, OK_SELECTOR, "initial_modal_shown", timeout=60, legacy_sleep=5)
         logger.info("Closing initial modal...")
-        ok_button.click()
-        time.sleep(2)  # Reduced wait time
+        page.locator(OK_SELECTOR).click()
+        waits.wait_for_hidden(page, OK_SELECTOR, "initial_modal_closed", legacy_sleep=2)
         logger.info("Initial modal closed successfully")
     except Exception as e:
         logger.error(f"Failed to close initial modal: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def click_afegir_dades(page):
     """Click the afegir dades button"""
     try:
@@ -45,7 +68,9 @@ def click_afegir_dades(page):
         logger.info("Afegir dades button clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click afegir dades button: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def click_locate_icon(page):
     """Click the locate icon to open the search panel"""
     try:
@@ -54,11 +79,13 @@ def click_locate_icon(page):
         img.wait_for(state="visible")
         parent = img.locator('xpath=..')
         parent.click()
-        time.sleep(1)  # Reduced wait
+        waits.wait_for_visible(page, 'div.tab.jimu-vcenter-text[label="Cadastre"]', "locate_panel_open", legacy_sleep=1)
         logger.info("Locate icon clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click locate icon: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def click_cadastre_tab(page):
     """Click the Cadastre tab in the search panel"""
     try:
@@ -66,11 +93,13 @@ def click_cadastre_tab(page):
         cadastre_tab = page.locator('div.tab.jimu-vcenter-text[label="Cadastre"]')
         cadastre_tab.wait_for(state="visible")
         cadastre_tab.click()
-        time.sleep(1)  # Reduced wait
+        waits.wait_for_visible(page, 'input#RC[name="search"]', "cadastre_tab_open", legacy_sleep=1)
         logger.info("Cadastre tab clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click Cadastre tab: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def enter_cadastral_reference(page, referencia_catastral):
     """Enter the cadastral reference and click search"""
     try:
@@ -82,13 +111,17 @@ def enter_cadastral_reference(page, referencia_catastral):
         logger.info("Clicking search button...")
         search_button = page.locator('div.locate-btn.btn-addressLocate[data-dojo-attach-point="btnRefCat"]')
         search_button.wait_for(state="visible")
-        search_button.click()
-        
-        time.sleep(3)  # Wait for results to load
+        # The map zooms to the parcel once the cadastre lookup answers
+        waits.wait_for_map_update(page, search_button.click, "parcel_located", legacy_sleep=3)
         logger.info("Search completed successfully")
     except Exception as e:
         logger.error(f"Failed to enter cadastral reference: {str(e)}")
+        return False
+
+RISC_INUNDACIO_ADD_BUTTON = ('div.item-card-inner:has(h3.title:text("Xarxa Hidrogràfica i Risc Inundació de les Illes Balears")) '
+                             '[data-dojo-attach-point="addButton"]')
 
+@metrics.step('pdf')
 def input_inundacio_search(page):
     """Input 'inund' into the search box and click the search button"""
     try:
@@ -102,25 +135,28 @@ def input_inundacio_search(page):
         search_button.wait_for(state="visible")
         search_button.click()  # Click the search button
 
-        time.sleep(3)  # Wait for results to load
+        waits.wait_for_visible(page, RISC_INUNDACIO_ADD_BUTTON, "inundacio_results", legacy_sleep=3)
         logger.info("Search completed successfully")
     except Exception as e:
         logger.error(f"Failed to input inundacio search: {str(e)}")
+        return False
 
 
+@metrics.step('pdf')
 def add_layer_risc_inundacio(page):
     """Click the 'Afegir' button for the Risc Inundació layer"""
     try:
         logger.info("Clicking the 'Afegir' button for Risc Inundació...")
         # Locate the button based on the text in the info div and the title of the layer
-        item_card_locator = page.locator('div.item-card-inner:has(h3.title:text("Xarxa Hidrogràfica i Risc Inundació de les Illes Balears"))')
-        add_button = item_card_locator.locator('[data-dojo-attach-point="addButton"]')
+        add_button = page.locator(RISC_INUNDACIO_ADD_BUTTON)
         add_button.wait_for(state="visible")  # Wait for the button to be visible
         add_button.click()  # Click the 'Afegir' button
         logger.info("'Afegir' button for Risc Inundació clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click 'Afegir' button for Risc Inundació: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def close_afegir_dades(page):
     """Close the afegir dades"""
     try:
@@ -131,7 +167,9 @@ def close_afegir_dades(page):
         logger.info("Afegir dades closed successfully")
     except Exception as e:
         logger.error(f"Failed to close afegir dades: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def zoom_in_twice(page):
     """Zoom in two times"""
     try:
@@ -140,12 +178,13 @@ def zoom_in_twice(page):
         zoom_in_button.wait_for(state="visible")
         
         for i in range(2):
-            zoom_in_button.click()
-            time.sleep(0.5)  # Reduced wait
+            waits.wait_for_map_update(page, zoom_in_button.click, "zoom_in", legacy_sleep=0.5)
             logger.info(f"Zoomed in {i+1}/2 times")
     except Exception as e:
         logger.error(f"Failed to zoom in: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def click_print_icon(page):
     """Click the print icon to open the print panel"""
     try:
@@ -154,23 +193,36 @@ def click_print_icon(page):
         img.wait_for(state="visible")
         parent = img.locator('xpath=..')
         parent.click()
-        time.sleep(1)  # Reduced wait
+        waits.wait_for_visible(page, '[data-dojo-attach-point="printButtonDijit"]', "print_panel_open", legacy_sleep=1)
         logger.info("Locate icon clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click locate icon: {str(e)}")
+        return False
 
+PRINT_RESULT_SELECTOR = ':text("Mapa IDEIB")'
+
+# ArcGIS geoprocessing (print) task submissions
+PRINT_JOB_URL_PATTERN = r'/GPServer/.+/(submitJob|execute)'
+# Seconds to wait for the print job's link before submitting it again
+PRINT_JOB_TIMEOUT = float(os.environ.get('PRINT_JOB_TIMEOUT', 180))
+
+@metrics.step('pdf')
 def click_imprimir(page):
     """Click imprimir"""
     try:
         logger.info("Clicking imprimir...")
         print_button = page.locator('[data-dojo-attach-point="printButtonDijit"]')
         print_button.wait_for(state="visible")
-        print_button.click()
-        time.sleep(1)  # Reduced wait
+        # The print widget submits an ExportWebMap job to the ArcGIS print service
+        if not waits.wait_for_response(page, PRINT_JOB_URL_PATTERN, print_button.click, "print_job_submitted",
+                                       timeout=15, legacy_sleep=1):
+            raise Exception("No print job was submitted")
         logger.info("Imprimir clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click imprimir: {str(e)}")
+        return False
 
+@metrics.step('pdf')
 def close_cerca_avancada(page):
     """Close the cerca avançada panel"""
     try:
@@ -178,27 +230,40 @@ def close_cerca_avancada(page):
         close_button = page.locator('div.close-icon.jimu-float-trailing[data-dojo-attach-point="closeNode"]')
         close_button.wait_for(state="visible")
         close_button.click()
-        time.sleep(1)  # Wait for panel to close
+        waits.wait_for_hidden(page, 'div.close-icon.jimu-float-trailing[data-dojo-attach-point="closeNode"]',
+                              "cerca_avancada_closed", legacy_sleep=1)
         logger.info("Cerca avançada panel closed successfully")
     except Exception as e:
         logger.error(f"Failed to close cerca avançada panel: {str(e)}")
+        return False
+
+def count_print_results(page):
+    """Number of "Mapa IDEIB" links already in the print widget's results list"""
+    return page.locator(PRINT_RESULT_SELECTOR).count()
 
-def click_pdf(page):
-    time.sleep(5)
+@metrics.step('pdf', returns_value=True)
+def click_pdf(page, previous_results=0):
+    """
+    Download the PDF of the print job that just finished. previous_results
+    is how many results were already listed, so on a page that printed
+    before the new link is picked instead of an old one.
+    """
     try:
         logger.info("Clicking on the pdf...")
-        mapa_ideib = page.locator(':text("Mapa IDEIB")')
-        mapa_ideib.wait_for(state="visible", timeout=180000)
+        mapa_ideib = page.locator(PRINT_RESULT_SELECTOR).nth(previous_results)
+        # The link appears once the print job has finished
+        if not waits.wait_for_visible(page, PRINT_RESULT_SELECTOR, "print_job_done", timeout=PRINT_JOB_TIMEOUT,
+                                      legacy_sleep=5, nth=previous_results):
+            raise Exception("Print job did not finish")
         with page.expect_download() as download_info:
             mapa_ideib.click()
-            time.sleep(1)
             logger.info("Mapa IDEIB clicked")
             download = download_info.value
             logger.info(f"Download started: {download.suggested_filename}")
             download_dir = os.path.join(os.getcwd(), 'downloads')
             if not os.path.exists(download_dir):
                 os.makedirs(download_dir)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
             original_filename = download.suggested_filename
             safe_filename = "".join([c for c in original_filename if c.isalpha() or c.isdigit() or c in (' ', '.', '_')]).rstrip()
             if not safe_filename.lower().endswith('.pdf'):
@@ -212,12 +277,14 @@ def click_pdf(page):
         logger.error(f"Failed to click mapa IDEIB: {str(e)}")
         return None
 
+@metrics.step('pdf', returns_value=True)
 def next_tab(page):
     """Go to next tab"""
     try:
         logger.info("Switching to next tab...")
         # Wait for the new tab to be created
-        page.wait_for_timeout(5000)  # Increased wait time to 5 seconds
+        if len(page.context.pages) < 2:
+            page.context.wait_for_event("page", timeout=5000)
         # Get all pages
         pages = page.context.pages
         # Switch to the last opened page (the new tab)
@@ -229,31 +296,19 @@ def next_tab(page):
         logger.error(f"Failed to switch to next tab: {str(e)}")
         return None
 
+@metrics.step('pdf')
 def click_download_button(page):
     """Click the download button in the PDF viewer"""
     try:
         logger.info("Waiting for PDF viewer to load...")
-        # Wait longer for the PDF to load
-        page.wait_for_timeout(10000)  # Wait 10 seconds
-        
         # Wait for the page to be fully loaded
-        page.wait_for_load_state('networkidle', timeout=60000)  # Increased timeout to 60 seconds
+        waits.wait_for_network_idle(page, "pdf_viewer_loaded", timeout=60, legacy_sleep=10)
         
         # Get the viewport size
         viewport = page.viewport_size
         if not viewport:
             raise Exception("Could not get viewport size")
             
-        # Take a screenshot first to help with positioning
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        screenshot_path = os.path.join(os.getcwd(), f'pdf_viewer_{timestamp}.png')
-        page.screenshot(path=screenshot_path, full_page=True)
-        logger.info(f"Full page screenshot saved to {screenshot_path}")
-        
-        # Log the page content for debugging
-        logger.info("Page content:")
-        logger.info(page.content())
-        
         # Try to find the download button by various selectors
         download_button = page.locator('button.download-button, a.download-link, [aria-label="Download"], [title="Download"]')
         if download_button.is_visible():
@@ -271,18 +326,9 @@ def click_download_button(page):
         logger.info("Download button clicked successfully")
     except Exception as e:
         logger.error(f"Failed to click download button: {str(e)}")
-        # Log the page content for debugging
-        logger.error("Complete page HTML content:")
-        logger.error(page.content())
-        # Take a screenshot for debugging
-        try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            screenshot_path = os.path.join(os.getcwd(), f'pdf_viewer_error_{timestamp}.png')
-            page.screenshot(path=screenshot_path, full_page=True)
-            logger.info(f"Error screenshot saved to {screenshot_path}")
-        except Exception as screenshot_error:
-            logger.error(f"Failed to take error screenshot: {str(screenshot_error)}")
+        return False
 
+@metrics.step('pdf', returns_value=True)
 def download_pdf(page):
     """Download the PDF from the current page"""
     try:
@@ -322,109 +368,429 @@ def download_pdf(page):
         logger.error(f"Failed to download PDF: {str(e)}")
         return None
 
-def get_flood_area_pdf(referencia_catastral):
+AFEGIR_DADES_SEARCH_BOX = 'input.search-textbox[data-dojo-attach-point="searchTextBox"]'
+AFEGIR_DADES_CLOSE_BUTTON = 'div.close-btn.jimu-vcenter[data-dojo-attach-point="closeNode"]'
+PRINT_BUTTON_SELECTOR = '[data-dojo-attach-point="printButtonDijit"]'
+
+# True once a layer of the flood service is on the map
+FLOOD_LAYER_ADDED_SCRIPT = """
+() => {
+    const map = window._viewerMap;
+    if (!map) return false;
+    const names = (map.layers || []).map(String);
+    for (const id of (map.layerIds || [])) {
+        const layer = map.getLayer(id);
+        names.push(id, (layer && (layer.url || layer.name || layer.title)) || '');
+    }
+    return names.some((name) => /inund/i.test(name));
+}
+"""
+
+def is_visible(selector):
+    return lambda page: page.locator(selector).first.is_visible()
+
+def is_hidden(selector):
+    return lambda page: page.locator(selector).first.is_hidden()
+
+def map_ready(page):
+    return page.evaluate("() => !!window._viewerMap")
+
+def flood_layer_added(page):
+    return page.evaluate(FLOOD_LAYER_ADDED_SCRIPT)
+
+def load_visor(page):
+    logger.info("Navigating to IDEIB visor...")
+    with metrics.timed_step('pdf', 'load_visor'):
+        page.goto(IDEIB_VISOR_URL, timeout=90000)
+        page.wait_for_load_state("networkidle", timeout=90000)
+    logger.info("Page loaded.")
+
+# Steps up to the reference-independent state, each with the state it must leave behind
+PRIME_STEPS = StepSequence('pdf', [
+    Step('load_visor', load_visor, check=map_ready),
+    Step('close_initial_modal', close_initial_modal, check=is_hidden(OK_SELECTOR)),
+    Step('click_afegir_dades', click_afegir_dades, check=is_visible(AFEGIR_DADES_SEARCH_BOX)),
+    Step('input_inundacio_search', input_inundacio_search, check=is_visible(RISC_INUNDACIO_ADD_BUTTON)),
+    Step('add_layer_risc_inundacio', add_layer_risc_inundacio, check=flood_layer_added),
+    Step('close_afegir_dades', close_afegir_dades, check=is_hidden(AFEGIR_DADES_CLOSE_BUTTON)),
+])
+
+def prime_visor_page(page):
+    """
+    Bring a page to the reference-independent starting state: visor loaded,
+    initial modal closed and the flood layer added. Used by the browser pool
+    to keep a standby page ready for the next request. Raises StepFailed if
+    a step keeps failing.
+    """
+    waits.install_map_hooks(page)
+    asset_cache.install(page)
+    request_filter.install(page, 'pdf')
+    PRIME_STEPS.run(page)
+
+def locate_with_visor(page, referencia_catastral):
+    """Centre the map on the parcel through the visor's cadastre search; False if a step failed"""
+    return (click_locate_icon(page) is not False
+            and click_cadastre_tab(page) is not False
+            and enter_cadastral_reference(page, referencia_catastral) is not False
+            and close_cerca_avancada(page) is not False)
+
+def _no_progress(step):
+    pass
+
+def render_steps(referencia_catastral, result):
+    """The steps from a primed page to the downloaded PDF, whose path is stored in result['pdf_path']"""
+    def centre_map_on_parcel(page):
+        with metrics.timed_step('pdf', 'centre_map_on_parcel'):
+            result['parcel_extent'] = parcel_resolver.centre_map_on_parcel(
+                page, referencia_catastral, lambda: locate_with_visor(page, referencia_catastral))
+        result['centred_extent'] = parcel_resolver.read_map_extent(page)
+        return result['parcel_extent'] is not None
+
+    def centred(page):
+        return parcel_resolver.shows_extent(page, result.get('parcel_extent'))
+
+    def zoomed_in(page):
+        # Narrower than the centred view and still on the parcel
+        extent = parcel_resolver.read_map_extent(page)
+        before = result.get('centred_extent')
+        return (extent is not None and before is not None
+                and extent['xmax'] - extent['xmin'] < before['xmax'] - before['xmin'] and centred(page))
+
+    def submit_print(page):
+        # Links already listed, so the new one is picked instead of an old one
+        result['previous_results'] = count_print_results(page)
+        return click_imprimir(page)
+
+    def download(page):
+        result['pdf_path'] = click_pdf(page, result['previous_results'])
+        return result['pdf_path'] is not None
+
+    return StepSequence('pdf', [
+        Step('centre_map_on_parcel', centre_map_on_parcel, check=centred,
+             before="Locating parcel", after="Parcel located"),
+        # Zooming again from a zoomed map would overshoot, so start over from the parcel
+        Step('zoom_in_twice', zoom_in_twice, check=zoomed_in, retry_from='centre_map_on_parcel'),
+        Step('click_print_icon', click_print_icon, check=is_visible(PRINT_BUTTON_SELECTOR), before="Printing map"),
+        Step('click_imprimir', submit_print, after="Print submitted"),
+        # A print job that never finished will not finish on a second wait, submit it again
+        Step('click_pdf', download, retry_from='click_imprimir', before="Downloading PDF"),
+    ])
+
+def render_flood_area_pdf(page, referencia_catastral, progress=None):
+    """Locate the parcel on a primed page and return the path of the downloaded PDF"""
+    progress = progress or _no_progress
+    progress("Visor loaded with the flood layer")
+    result = {}
+    try:
+        render_steps(referencia_catastral, result).run(page, progress)
+    except StepFailed as e:
+        logger.error(f"Flood PDF for {referencia_catastral} failed: {str(e)}")
+        return None
+    finally:
+        request_filter.log_summary(page, f"Flood PDF for {referencia_catastral}")
+    return result['pdf_path']
+
+def render_flood_area_pdfs(page, referencias, progress=None):
+    """
+    Render several references on one primed page, so the visor and the flood
+    layer are set up once. Returns {referencia: (pdf_path or None, error or None)}.
+    """
+    progress = progress or _no_progress
+    results = {}
+    for i, referencia_catastral in enumerate(referencias):
+        progress(f"Rendering {referencia_catastral} ({i + 1}/{len(referencias)})")
+        try:
+            pdf_path = render_flood_area_pdf(page, referencia_catastral)
+        except Exception as e:
+            pdf_path = None
+            logger.error(f"Error rendering {referencia_catastral} in batch: {e}")
+        if pdf_path:
+            results[referencia_catastral] = (pdf_path, None)
+            continue
+        results[referencia_catastral] = (None, 'Failed to generate PDF')
+        if i + 1 < len(referencias):
+            # The visor may be left half-way through a step, start the next one clean
+            logger.info("Re-priming the visor after a failed reference...")
+            try:
+                PRIME_STEPS.run(page)
+            except StepFailed as e:
+                logger.error(f"Could not re-prime the visor, failing the rest of the batch: {str(e)}")
+                for remaining in referencias[i + 1:]:
+                    results[remaining] = (None, 'Visor could not be prepared')
+                break
+    return results
+
+# Warm Chromium instances shared by every request, each with a standby page
+# that already has the flood layer loaded
+browser_pool = BrowserPool(launch_options=chromium_launch_options(headless=True),
+                           primer=prime_visor_page, recycle_check=governor.should_recycle_browser)
+# 'pool' runs each render on a browser thread of its own, 'async' runs them as
+# coroutines on one browser (see async_engine.py), ASYNC_MAX_CONTEXTS at a time
+BROWSER_ENGINE = os.environ.get('BROWSER_ENGINE', 'pool')
+async_engine = AsyncBrowserEngine(launch_options=chromium_launch_options(headless=True),
+                                  recycle_check=governor.should_recycle_browser)
+
+# Everything that shapes the rendered PDF; part of the cache key so a change
+# here never serves a PDF rendered with the old settings
+PDF_RENDER_SETTINGS = {
+    'layer': 'Xarxa Hidrogràfica i Risc Inundació de les Illes Balears',
+    'zoom_in_clicks': 2,
+    'viewport': VIEWPORT,
+}
+CACHE_MODES = ('use', 'refresh', 'bypass')
+# 'browser' drives the visor's print widget, 'direct' calls the print service
+# over HTTP (see print_service.py) and falls back to the browser on failure
+PRINT_ENGINES = ('browser', 'direct')
+PRINT_ENGINE = os.environ.get('PRINT_ENGINE', 'browser')
+BATCH_MAX_REFERENCES = int(os.environ.get('BATCH_MAX_REFERENCES', 100))
+
+# Rendered PDFs on the downloads volume, reused across requests and restarts
+pdf_cache = ResultCache()
+pdf_flight = SingleFlight('flood PDF')
+
+def check_pdf_options(cache_mode, engine):
+    """Raise ValueError for an unknown cache mode or print engine"""
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Invalid cache mode, use one of: {', '.join(CACHE_MODES)}")
+    if engine not in PRINT_ENGINES:
+        raise ValueError(f"Invalid engine, use one of: {', '.join(PRINT_ENGINES)}")
+
+def pdf_cache_key(referencia_catastral, engine):
+    return pdf_cache.key(referencia_catastral, engine=engine, **PDF_RENDER_SETTINGS)
+
+def get_flood_area_pdf(referencia_catastral, progress=None, engine='browser'):
     """
     Navigate to the IDEIB website and generate a PDF for the given cadastral reference
     Returns the path to the generated PDF
     """
-    from flask import current_app
-    import os
-    is_production = os.environ.get('FLY_APP_NAME') is not None
-    with sync_playwright() as p:
-        # Use launch options similar to fotos-aereas-ideib
-        launch_options = {
-            "headless": True,  # or False if you want non-headless
-            "args": [
-                "--disable-dev-shm-usage",
-                "--no-sandbox",
-                "--disable-setuid-sandbox",
-                "--disable-gpu",
-                "--disable-software-rasterizer",
-                "--single-process",
-                "--disable-extensions",
-                "--disable-popup-blocking"
-            ] if is_production else []
-        }
-        browser = p.chromium.launch(**launch_options)
-        context = None
-        page = None
+    if engine == 'direct':
         try:
-            # Set viewport and default timeout as in fotos-aereas-ideib
-            context = browser.new_context(viewport={"width": 1280, "height": 800})
-            page = context.new_page()
-            page.set_default_timeout(60000)  # 60 seconds
-            logger.info("Navigating to IDEIB visor...")
-            page.goto('https://ideib.caib.es/visor/', timeout=90000)
-            page.wait_for_load_state("networkidle", timeout=90000)
-            logger.info("Page loaded.")
-            close_initial_modal(page)
-            click_afegir_dades(page)
-            input_inundacio_search(page)
-            add_layer_risc_inundacio(page)
-            close_afegir_dades(page)
-            click_locate_icon(page)
-            click_cadastre_tab(page)
-            enter_cadastral_reference(page, referencia_catastral)
-            close_cerca_avancada(page)
-            zoom_in_twice(page)
-            click_print_icon(page)
-            click_imprimir(page)
-            # Handle PDF download in the main tab
-            pdf_path = click_pdf(page)
-            return pdf_path
+            return print_service.get_flood_area_pdf_direct(referencia_catastral, progress=progress)
         except Exception as e:
-            logger.error(f"Error in get_flood_area_pdf: {e}")
-            return None
-        finally:
-            if page is not None:
-                try:
-                    page.close()
-                except Exception as e:
-                    logger.error(f"Error closing page: {e}")
-            if context is not None:
-                try:
-                    context.close()
-                except Exception as e:
-                    logger.error(f"Error closing context: {e}")
+            logger.error(f"Direct print failed for {referencia_catastral}, falling back to the browser: {e}")
+    try:
+        if BROWSER_ENGINE == 'async':
+            return async_engine.run(async_steps.render_flood_area_pdf, referencia_catastral, progress=progress,
+                                    visor_url=IDEIB_VISOR_URL)
+        return browser_pool.run(render_flood_area_pdf, referencia_catastral, progress=progress)
+    except Exception as e:
+        logger.error(f"Error in get_flood_area_pdf: {e}")
+        return None
+
+def get_flood_area_pdf_cached(referencia_catastral, cache_mode='use', progress=None, engine='browser'):
+    """
+    Return (pdf_path, cache_entry, cache_status) for the reference.
+    cache_mode is 'use' (serve a cached PDF if there is one), 'refresh'
+    (render again and replace the cached PDF) or 'bypass' (render without
+    touching the cache). When cache_entry is None the caller owns pdf_path
+    and must delete it.
+    """
+    key = pdf_cache_key(referencia_catastral, engine)
+    if cache_mode == 'use':
+        entry = pdf_cache.get(key)
+        if entry is not None:
+            logger.info(f"Serving cached PDF for {referencia_catastral}")
+            return entry['path'], entry, 'HIT'
+
+    if cache_mode == 'bypass':
+        # Each caller owns and deletes its bypassed PDF, so they cannot share one
+        return render_and_cache_pdf(referencia_catastral, key, cache_mode, progress, engine)
+    # Concurrent requests for the same PDF share one browser run and one cached file
+    return pdf_flight.do(key, render_and_cache_pdf, referencia_catastral, key, cache_mode, progress, engine)
+
+def render_and_cache_pdf(referencia_catastral, key, cache_mode, progress=None, engine='browser'):
+    """Render the PDF and, unless bypassing, store it in the cache under key"""
+    pdf_path = get_flood_area_pdf(referencia_catastral, progress=progress, engine=engine)
+    if not pdf_path or not os.path.exists(pdf_path):
+        return None, None, 'MISS'
+    if cache_mode == 'bypass':
+        return pdf_path, None, 'BYPASS'
+    entry = pdf_cache.put(key, pdf_path, referencia_catastral=normalise_reference(referencia_catastral))
+    return entry['path'], entry, 'REFRESH' if cache_mode == 'refresh' else 'MISS'
+
+def flood_pdf_job(job):
+    """Job handler: generate (or fetch from cache) the PDF for job.params"""
+    referencia_catastral = job.params['referencia_catastral']
+    cache_mode = job.params.get('cache', 'use')
+    engine = job.params.get('engine', PRINT_ENGINE)
+    check_pdf_options(cache_mode, engine)
+    pdf_path, entry, cache_status = get_flood_area_pdf_cached(referencia_catastral, cache_mode,
+                                                              progress=job.report, engine=engine)
+    if not pdf_path:
+        raise Exception('Failed to generate PDF')
+    return pdf_result(referencia_catastral, pdf_path, entry, cache_status)
+
+def pdf_result(referencia_catastral, pdf_path, entry, cache_status):
+    """The result dict (see jobs.Job) sending pdf_path, a cached PDF when entry is given"""
+    generated_at = entry['created_at'] if entry is not None else time.time()
+    result = {
+        'path': pdf_path,
+        'download_name': f"flood_area_{referencia_catastral}_{datetime.fromtimestamp(generated_at).strftime('%Y%m%d_%H%M%S')}.pdf",
+        'mimetype': 'application/pdf',
+        'headers': {'X-Cache': cache_status},
+        # Cached PDFs belong to the cache, bypassed ones to the job
+        'delete_after': entry is None,
+    }
+    if entry is not None:
+        result['etag'] = entry['etag']
+        result['last_modified'] = entry['created_at']
+    return result
+
+def parse_references(referencias):
+    """Accept a list or a string of references separated by commas, spaces or new lines"""
+    if isinstance(referencias, str):
+        referencias = re.split(r'[\s,;]+', referencias)
+    unique = []
+    for referencia_catastral in referencias or []:
+        referencia_catastral = str(referencia_catastral).strip()
+        if referencia_catastral and referencia_catastral not in unique:
+            unique.append(referencia_catastral)
+    return unique
+
+def flood_pdf_batch_job(job):
+    """
+    Job handler: PDFs for many references in one browser session, zipped
+    together with a manifest.json reporting each reference's outcome
+    """
+    referencias = parse_references(job.params.get('referencias'))
+    cache_mode = job.params.get('cache', 'use')
+    engine = job.params.get('engine', PRINT_ENGINE)
+    if not referencias:
+        raise ValueError('No cadastral references provided')
+    if len(referencias) > BATCH_MAX_REFERENCES:
+        raise ValueError(f"A batch can hold at most {BATCH_MAX_REFERENCES} references")
+    check_pdf_options(cache_mode, engine)
+
+    pdf_paths = {}
+    manifest = {referencia_catastral: {'referencia_catastral': referencia_catastral}
+                for referencia_catastral in referencias}
+    pending = []
+    for referencia_catastral in referencias:
+        entry = None
+        if cache_mode == 'use':
+            entry = pdf_cache.get(pdf_cache_key(referencia_catastral, engine))
+        if entry is not None:
+            pdf_paths[referencia_catastral] = entry['path']
+            manifest[referencia_catastral]['cache'] = 'HIT'
+        else:
+            pending.append(referencia_catastral)
+
+    temporary_paths = []
+    rendered = {}
+    if pending and engine == 'direct':
+        for referencia_catastral in pending:
+            job.report(f"Printing {referencia_catastral} directly")
             try:
-                browser.close()
+                rendered[referencia_catastral] = (
+                    print_service.get_flood_area_pdf_direct(referencia_catastral), None)
             except Exception as e:
-                logger.error(f"Error closing browser: {e}")
+                logger.error(f"Direct print failed for {referencia_catastral}, falling back to the browser: {e}")
+        pending = [referencia_catastral for referencia_catastral in pending if referencia_catastral not in rendered]
+    if pending:
+        job.report(f"Rendering {len(pending)} of {len(referencias)} PDF(s)")
+        try:
+            if BROWSER_ENGINE == 'async':
+                rendered.update(async_engine.run(async_steps.render_flood_area_pdfs, pending, progress=job.report,
+                                                 visor_url=IDEIB_VISOR_URL))
+            else:
+                rendered.update(browser_pool.run(render_flood_area_pdfs, pending, progress=job.report))
+        except Exception as e:
+            logger.error(f"Error in batch render: {e}")
+            rendered.update({referencia_catastral: (None, str(e)) for referencia_catastral in pending})
+    # Direct prints and browser renders alike
+    for referencia_catastral, (pdf_path, error) in rendered.items():
+        if not pdf_path:
+            manifest[referencia_catastral]['error'] = error
+            continue
+        if cache_mode == 'bypass':
+            temporary_paths.append(pdf_path)
+        else:
+            key = pdf_cache_key(referencia_catastral, engine)
+            pdf_path = pdf_cache.put(key, pdf_path, referencia_catastral=normalise_reference(referencia_catastral))['path']
+        pdf_paths[referencia_catastral] = pdf_path
+        manifest[referencia_catastral]['cache'] = cache_mode.upper() if cache_mode != 'use' else 'MISS'
 
-def process_and_send_pdf(referencia_catastral):
-    """Helper function to generate PDF, send it, and clean up after."""
+    job.report("Creating zip archive")
+    temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip", prefix="flood_areas_")
     try:
-        pdf_path = get_flood_area_pdf(referencia_catastral)
-        if not pdf_path or not os.path.exists(pdf_path):
-            return jsonify({'error': 'Failed to generate PDF'}), 500
-
-        # Schedule the PDF file for deletion after the request is sent, with a delay
-        @after_this_request
-        def cleanup(response):
-            def delayed_delete(path):
-                time.sleep(2)  # Wait 2 seconds to ensure file is closed
-                try:
-                    os.remove(path)
-                    logger.info(f"Successfully removed temporary PDF file: {path}")
-                except Exception as error:
-                    logger.error(f"Error removing temporary PDF file {path}: {error}")
-            threading.Thread(target=delayed_delete, args=(pdf_path,)).start()
-            return response
-
-        # Send the PDF file as an attachment
-        pdf_download_name = f"flood_area_{referencia_catastral}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        logger.info(f"Sending PDF file {pdf_path} as attachment: {pdf_download_name}")
-        return send_file(pdf_path, as_attachment=True, download_name=pdf_download_name)
-
-    except Exception as e:
-        logger.error(f"Error processing PDF request for {referencia_catastral}: {str(e)}")
-        if 'pdf_path' in locals() and os.path.exists(pdf_path):
+        with zipfile.ZipFile(temp_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for referencia_catastral in referencias:
+                item = manifest[referencia_catastral]
+                if referencia_catastral in pdf_paths:
+                    item['status'] = 'ok'
+                    item['filename'] = f"flood_area_{referencia_catastral}.pdf"
+                    zipf.write(pdf_paths[referencia_catastral], item['filename'])
+                else:
+                    item['status'] = 'failed'
+            zipf.writestr('manifest.json', json.dumps([manifest[r] for r in referencias], indent=2))
+        temp_zip.close()
+    except Exception:
+        temp_zip.close()
+        os.remove(temp_zip.name)
+        raise
+    finally:
+        for pdf_path in temporary_paths:
+            os.remove(pdf_path)
+
+    succeeded = sum(1 for item in manifest.values() if item['status'] == 'ok')
+    return {
+        'path': temp_zip.name,
+        'download_name': f"flood_areas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+        'mimetype': 'application/zip',
+        'headers': {'X-Batch-Succeeded': str(succeeded), 'X-Batch-Failed': str(len(referencias) - succeeded)},
+        'delete_after': True,
+    }
+
+def process_and_send_pdf(referencia_catastral, cache_mode='use', engine=PRINT_ENGINE):
+    """Helper function to generate (or fetch from cache) the PDF and send it."""
+    try:
+        check_pdf_options(cache_mode, engine)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if cache_mode == 'use':
+        # A cached PDF is only a file to send: no queueing behind the renders
+        entry = pdf_cache.get(pdf_cache_key(referencia_catastral, engine))
+        if entry is not None:
+            logger.info(f"Serving cached PDF for {referencia_catastral}")
             try:
-                os.remove(pdf_path)
-                logger.info(f"Cleaned up PDF file {pdf_path} after error.")
-            except Exception as cleanup_error:
-                logger.error(f"Error cleaning up PDF file {pdf_path} after error: {cleanup_error}")
-        return jsonify({'error': str(e)}), 500
+                return send_result(pdf_result(referencia_catastral, entry['path'], entry, 'HIT'))
+            except FileNotFoundError:
+                logger.info(f"Cached PDF for {referencia_catastral} was evicted before it was sent")
+    return run_job_and_send(job_queue, 'pdf', referencia_catastral=referencia_catastral,
+                            cache=cache_mode, engine=engine)
+
+def warm_browser():
+    if BROWSER_ENGINE == 'async':
+        async_engine.warm()
+    else:
+        browser_pool.start()
+        wait_until(lambda: browser_pool.stats()['alive'] > 0)
+
+def preload_visor():
+    if BROWSER_ENGINE == 'async':
+        # The async engine keeps no standby page, this only warms the asset cache
+        async_engine.run(async_steps.prime_visor_page, IDEIB_VISOR_URL)
+    else:
+        wait_until(lambda: browser_pool.stats()['standby_pages'] > 0)
+
+warmup = Warmup()
+
+# Every render, synchronous or not, goes through this bounded queue
+job_queue = JobQueue({'pdf': warmup.record_first_result('pdf', flood_pdf_job),
+                      'batch': warmup.record_first_result('batch', flood_pdf_batch_job)},
+                     # Each job worker blocks on its render, the async engine needs one per context to fill them
+                     workers=max(JOB_WORKERS, async_engine.max_contexts) if BROWSER_ENGINE == 'async' else JOB_WORKERS,
+                     governor=governor)
+register_job_routes(app, job_queue)
+register_health_routes(app, warmup)
+metrics.register_metrics_route(app, browser_pool=browser_pool.stats, async_engine=async_engine.stats,
+                               jobs=job_queue.stats,
+                               pdf_cache=pdf_cache.stats, asset_cache=asset_cache.asset_cache.stats,
+                               parcel_index=parcel_resolver.parcel_index.stats, coalescing=pdf_flight.stats,
+                               memory=governor.stats, forensics=forensics.stats,
+                               warmup=warmup.gauges)
+# Launch the browser (and prime its standby page) before the first request
+warmup.start([('browser_start', warm_browser)] + ([('visor_preload', preload_visor)] if WARMUP_PRELOAD else []))
 
 @app.route('/')
 def index():
@@ -434,16 +800,47 @@ def index():
 def favicon():
     return '', 204
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'browser_pool': browser_pool.stats(),
+        'async_engine': async_engine.stats(),
+        'waits': waits.wait_stats.snapshot(),
+        'step_retries': retry_stats.snapshot(),
+        'network': request_filter.stats(),
+        'asset_cache': asset_cache.asset_cache.stats(),
+        'pdf_cache': pdf_cache.stats(),
+        'parcel_index': parcel_resolver.parcel_index.stats(),
+        'coalescing': pdf_flight.stats(),
+        'jobs': job_queue.stats(),
+        'memory': governor.stats(),
+        'forensics': forensics.stats(),
+        'warmup': warmup.stats(),
+    })
+
 @app.route('/get_pdf', methods=['POST'])
 def get_pdf():
     referencia_catastral = request.form.get('referencia_catastral')
     if not referencia_catastral:
         return jsonify({'error': 'No cadastral reference provided'}), 400
-    return process_and_send_pdf(referencia_catastral)
+    return process_and_send_pdf(referencia_catastral, request.form.get('cache', 'use'),
+                                request.form.get('engine', PRINT_ENGINE))
+
+@app.route('/batch', methods=['POST'])
+def get_pdf_batch():
+    payload = request.get_json(silent=True) or request.form
+    referencias = parse_references(payload.get('referencias'))
+    if not referencias:
+        return jsonify({'error': 'No cadastral references provided'}), 400
+    if len(referencias) > BATCH_MAX_REFERENCES:
+        return jsonify({'error': f"A batch can hold at most {BATCH_MAX_REFERENCES} references"}), 400
+    return run_job_and_send(job_queue, 'batch', referencias=referencias, cache=payload.get('cache', 'use'),
+                            engine=payload.get('engine', PRINT_ENGINE))
 
 @app.route('/<string:referencia_catastral>', methods=['GET'])
 def get_pdf_by_url(referencia_catastral):
-    return process_and_send_pdf(referencia_catastral)
+    return process_and_send_pdf(referencia_catastral, request.args.get('cache', 'use'),
+                                request.args.get('engine', PRINT_ENGINE))
 
 if __name__ == '__main__':
     # Test the PDF generation with a sample cadastral reference
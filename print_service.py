@@ -0,0 +1,139 @@
+"""
+Browserless flood PDF engine.
+
+Instead of driving the visor's print widget, build the Web_Map_as_JSON the
+widget would send (basemap + flood layer, extent around the parcel), submit
+it to the ArcGIS ExportWebMap print service over HTTP, poll the job and
+download the PDF. All endpoints are configurable so the engine can run
+against a local stand-in print server.
+"""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import parcel_resolver
+from http_client import session, HTTP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+IDEIB_PRINT_URL = os.environ.get(
+    'IDEIB_PRINT_URL',
+    'https://ideib.caib.es/geoserveis/rest/services/Utilities/PrintingTools/GPServer/Export%20Web%20Map%20Task')
+# 'async' for submitJob + polling, 'sync' for services published as execute
+IDEIB_PRINT_MODE = os.environ.get('IDEIB_PRINT_MODE', 'async')
+IDEIB_FLOOD_LAYER_URL = os.environ.get(
+    'IDEIB_FLOOD_LAYER_URL',
+    'https://ideib.caib.es/geoserveis/rest/services/public/GOIB_XarxaHidrografica_RiscInundacio_IB/MapServer')
+IDEIB_BASEMAP_URL = os.environ.get(
+    'IDEIB_BASEMAP_URL',
+    'https://ideib.caib.es/geoserveis/rest/services/public/GOIB_MapaBase_IB/MapServer')
+
+PRINT_LAYOUT = os.environ.get('PRINT_LAYOUT', 'A4 Portrait')
+PRINT_DPI = int(os.environ.get('PRINT_DPI', 150))
+PRINT_PARCEL_BUFFER = float(os.environ.get('PRINT_PARCEL_BUFFER', 150))  # metres around the parcel
+PRINT_POLL_INTERVAL = float(os.environ.get('PRINT_POLL_INTERVAL', 1))
+PRINT_TIMEOUT = float(os.environ.get('PRINT_TIMEOUT', 120))
+
+FLOOD_LAYER_TITLE = 'Xarxa Hidrogràfica i Risc Inundació de les Illes Balears'
+
+
+class PrintServiceError(Exception):
+    """Raised when the print service rejects or fails the print job"""
+
+
+def extent_around(parcel, buffer=PRINT_PARCEL_BUFFER):
+    """The parcel's bounding box grown by buffer metres on every side"""
+    return {
+        'xmin': parcel.xmin - buffer, 'ymin': parcel.ymin - buffer,
+        'xmax': parcel.xmax + buffer, 'ymax': parcel.ymax + buffer,
+        'spatialReference': {'wkid': parcel.wkid},
+    }
+
+
+def build_web_map(extent, title='Mapa IDEIB'):
+    """The ExportWebMap Web_Map_as_JSON for the flood layer over the basemap"""
+    return {
+        'mapOptions': {'extent': extent, 'showAttribution': True},
+        'operationalLayers': [
+            {'id': 'basemap', 'url': IDEIB_BASEMAP_URL, 'opacity': 1, 'visibility': True},
+            {'id': 'risc_inundacio', 'title': FLOOD_LAYER_TITLE, 'url': IDEIB_FLOOD_LAYER_URL,
+             'opacity': 1, 'visibility': True},
+        ],
+        'exportOptions': {'dpi': PRINT_DPI},
+        'layoutOptions': {'titleText': title, 'scalebarUnit': 'Meters', 'legendOptions': {'operationalLayers': [
+            {'id': 'risc_inundacio'}]}},
+    }
+
+
+def _check(response):
+    response.raise_for_status()
+    data = response.json()
+    if 'error' in data:
+        raise PrintServiceError(f"Print service error: {data['error']}")
+    return data
+
+
+def submit_print_job(web_map, layout=PRINT_LAYOUT):
+    """Run the print job and return the URL of the generated PDF"""
+    params = {
+        'Web_Map_as_JSON': json.dumps(web_map),
+        'Format': 'PDF',
+        'Layout_Template': layout,
+        'f': 'json',
+    }
+    if IDEIB_PRINT_MODE == 'sync':
+        data = _check(session.post(f'{IDEIB_PRINT_URL}/execute', data=params, timeout=PRINT_TIMEOUT))
+        return data['results'][0]['value']['url']
+
+    job = _check(session.post(f'{IDEIB_PRINT_URL}/submitJob', data=params, timeout=HTTP_TIMEOUT))
+    job_url = f"{IDEIB_PRINT_URL}/jobs/{job['jobId']}"
+    deadline = time.monotonic() + PRINT_TIMEOUT
+    status = job.get('jobStatus')
+    while status != 'esriJobSucceeded':
+        if status in ('esriJobFailed', 'esriJobCancelled', 'esriJobTimedOut'):
+            raise PrintServiceError(f"Print job {job['jobId']} ended with {status}")
+        if time.monotonic() > deadline:
+            raise PrintServiceError(f"Print job {job['jobId']} did not finish in {PRINT_TIMEOUT:.0f}s")
+        time.sleep(PRINT_POLL_INTERVAL)
+        status = _check(session.get(job_url, params={'f': 'json'}, timeout=HTTP_TIMEOUT)).get('jobStatus')
+    result = _check(session.get(f'{job_url}/results/Output_File', params={'f': 'json'}, timeout=HTTP_TIMEOUT))
+    return result['value']['url']
+
+
+def download(url, path):
+    """Save url to path; a failed download leaves nothing at path"""
+    tmp_path = f'{path}.part'
+    try:
+        with session.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def get_flood_area_pdf_direct(referencia_catastral, progress=None):
+    """Generate the flood PDF without a browser; returns the path of the PDF"""
+    progress = progress or (lambda step: None)
+    started = time.monotonic()
+    progress("Locating parcel")
+    parcel = parcel_resolver.parcel_index.resolve(referencia_catastral)
+    progress("Parcel located")
+    progress("Printing map")
+    pdf_url = submit_print_job(build_web_map(extent_around(parcel)))
+    progress("Downloading PDF")
+    download_dir = os.path.join(os.getcwd(), 'downloads')
+    os.makedirs(download_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    pdf_path = download(pdf_url, os.path.join(download_dir, f'flood_area_{timestamp}_direct.pdf'))
+    logger.info(f"PDF for {referencia_catastral} printed directly in {time.monotonic() - started:.1f}s: {pdf_path}")
+    return pdf_path
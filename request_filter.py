@@ -0,0 +1,183 @@
+"""
+Network request filtering for the Playwright sessions.
+
+Installs a page.route handler that aborts requests which cannot affect the
+final PDF or screenshot (analytics, web fonts, the street view and overview
+widgets, and for the PDF flow the map tiles, since the print service renders
+the map server-side), and counts requests and bytes per page. Bytes are the
+response bodies as sent (compressed), from content-length or, for chunked
+responses without one, from the request's measured sizes.
+
+Rules are per flow and can be extended through the environment:
+REQUEST_FILTER_DENY_<FLOW> / REQUEST_FILTER_ALLOW_<FLOW> take comma-separated
+regular expressions (allow wins over deny), REQUEST_FILTER=0 disables it.
+"""
+import logging
+import os
+import re
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+REQUEST_FILTER_ENABLED = os.environ.get('REQUEST_FILTER', '1') != '0'
+
+COMMON_DENY = [
+    r'google-analytics\.com', r'googletagmanager\.com', r'doubleclick\.net', r'/gtag/js',
+    r'fonts\.googleapis\.com', r'fonts\.gstatic\.com',
+    r'maps\.googleapis\.com', r'/widgets/ideibStreetView/',
+    r'/widgets/OverviewMap/',
+]
+
+FLOW_RULES = {
+    'pdf': {
+        'deny': COMMON_DENY + [
+            # Map images: the PDF is drawn by the print service, not from these
+            r'/tile/\d+/\d+/\d+', r'[?&]request=GetTile', r'[?&]request=GetMap', r'/MapServer/export\?',
+            r'/ImageServer/exportImage\?',
+        ],
+        'deny_resource_types': ['font', 'media'],
+    },
+    'aerial': {
+        'deny': COMMON_DENY,
+        'deny_resource_types': ['font', 'media'],
+    },
+}
+
+
+def _env_patterns(name):
+    return [p for p in os.environ.get(name, '').split(',') if p.strip()]
+
+
+class _FlowFilter:
+    def __init__(self, flow):
+        rules = FLOW_RULES.get(flow, {'deny': COMMON_DENY, 'deny_resource_types': []})
+        suffix = flow.upper()
+        self.flow = flow
+        self.deny = [re.compile(p, re.IGNORECASE) for p in rules['deny'] + _env_patterns(f'REQUEST_FILTER_DENY_{suffix}')]
+        self.allow = [re.compile(p, re.IGNORECASE) for p in _env_patterns(f'REQUEST_FILTER_ALLOW_{suffix}')]
+        self.deny_resource_types = set(rules['deny_resource_types'])
+
+    def blocks(self, url, resource_type):
+        if any(pattern.search(url) for pattern in self.allow):
+            return False
+        return resource_type in self.deny_resource_types or any(pattern.search(url) for pattern in self.deny)
+
+
+class RequestStats:
+    """Request and byte counts, for one page or totalled per flow"""
+
+    def __init__(self):
+        self.requests = 0
+        self.aborted = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {'requests': self.requests, 'aborted': self.aborted, 'bytes': self.bytes}
+
+
+_filters = {}
+_page_stats = weakref.WeakKeyDictionary()
+_flow_totals = {}
+_lock = threading.Lock()
+
+
+def _filter_for(flow):
+    with _lock:
+        if flow not in _filters:
+            _filters[flow] = _FlowFilter(flow)
+            _flow_totals[flow] = RequestStats()
+        return _filters[flow], _flow_totals[flow]
+
+
+def _content_length(response):
+    length = response.headers.get('content-length')
+    return int(length) if length else None
+
+
+def _page_counters(page, flow):
+    """(should_abort(request), count_bytes(size), stats) keeping the page's and the flow's counts"""
+    flow_filter, totals = _filter_for(flow)
+    stats = RequestStats()
+    _page_stats[page] = stats
+
+    def count_bytes(size):
+        stats.bytes += size
+        with _lock:
+            totals.bytes += size
+
+    def should_abort(request):
+        stats.requests += 1
+        with _lock:
+            totals.requests += 1
+        if REQUEST_FILTER_ENABLED and flow_filter.blocks(request.url, request.resource_type):
+            stats.aborted += 1
+            with _lock:
+                totals.aborted += 1
+            return True
+        return False
+
+    return should_abort, count_bytes, stats
+
+
+def install(page, flow):
+    """Route the page's requests through the flow's rules; call before page.goto"""
+    should_abort, count_bytes, stats = _page_counters(page, flow)
+
+    def on_response(response):
+        size = _content_length(response)
+        if size is None:
+            try:
+                size = response.request.sizes()['responseBodySize']
+            except Exception:
+                size = 0  # The page went away before the body arrived
+        count_bytes(size)
+
+    def handle(route):
+        if should_abort(route.request):
+            route.abort()
+            return
+        route.fallback()
+
+    page.on('response', on_response)
+    page.route('**/*', handle)
+    return stats
+
+
+async def install_async(page, flow):
+    """install() for async_playwright pages"""
+    should_abort, count_bytes, stats = _page_counters(page, flow)
+
+    async def on_response(response):
+        size = _content_length(response)
+        if size is None:
+            try:
+                size = (await response.request.sizes())['responseBodySize']
+            except Exception:
+                size = 0
+        count_bytes(size)
+
+    async def handle(route):
+        if should_abort(route.request):
+            await route.abort()
+            return
+        await route.fallback()
+
+    page.on('response', on_response)
+    await page.route('**/*', handle)
+    return stats
+
+
+def log_summary(page, label):
+    """Log the page's request counts; returns them as a dict (empty if not filtered)"""
+    stats = _page_stats.get(page)
+    if stats is None:
+        return {}
+    logger.info(f"{label}: {stats.requests} requests ({stats.aborted} aborted), "
+                f"{stats.bytes / 1024:.0f} KiB received")
+    return stats.as_dict()
+
+
+def stats():
+    with _lock:
+        return {flow: totals.as_dict() for flow, totals in _flow_totals.items()}
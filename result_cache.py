@@ -0,0 +1,241 @@
+"""
+On-disk cache for generated files (flood PDFs, aerial photos).
+
+Entries are keyed by a hash of the normalised cadastral reference plus the
+settings that affect the output, stored as <dir>/<key>/<original filename>,
+and described in an index.json that survives restarts. Entries expire after
+a TTL and the least recently used ones are evicted once the cache grows past
+its size limit. Hits only update the access time in memory; it reaches the
+index with the next write, or at most every RESULT_CACHE_ACCESS_SAVE_INTERVAL
+seconds. Several worker processes may share the directory: every
+read-modify-write of the index holds an exclusive lock on index.lock.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(os.getcwd(), 'downloads', 'cache'))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 30 * 24 * 3600))  # 30 days
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+RESULT_CACHE_ACCESS_SAVE_INTERVAL = float(os.environ.get('RESULT_CACHE_ACCESS_SAVE_INTERVAL', 60))
+
+INDEX_FILENAME = 'index.json'
+LOCK_FILENAME = 'index.lock'
+
+
+def normalise_reference(referencia_catastral):
+    """Upper-case the reference and drop whitespace, dashes and dots"""
+    return re.sub(r'[\s.\-]', '', referencia_catastral or '').upper()
+
+
+def file_etag(path):
+    """SHA-256 of the file contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of files with per-entry TTL and a persistent index"""
+
+    def __init__(self, directory=RESULT_CACHE_DIR, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 access_save_interval=RESULT_CACHE_ACCESS_SAVE_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.access_save_interval = access_save_interval
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_mtime = None
+        self._saved_at = 0.0
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the thread lock and the index file lock shared with other processes"""
+        with self._lock, open(os.path.join(self.directory, LOCK_FILENAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def key(self, referencia_catastral, **settings):
+        """Cache key for a reference and the settings that shape the output"""
+        material = json.dumps({'ref': normalise_reference(referencia_catastral), 'settings': settings},
+                              sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        """(Re)read the index, dropping entries whose file has disappeared"""
+        try:
+            mtime = os.path.getmtime(self._index_path)
+        except OSError:
+            return
+        if mtime == self._index_mtime:
+            return
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to read cache index {self._index_path}: {str(e)}")
+            return
+        previous = self._index
+        self._index = {key: entry for key, entry in index.items()
+                       if os.path.exists(os.path.join(self.directory, key, entry['filename']))}
+        # Keep the access times of hits that have not been saved yet
+        for key, entry in self._index.items():
+            if key in previous:
+                entry['last_access'] = max(entry['last_access'], previous[key]['last_access'])
+        self._index_mtime = mtime
+
+    def _save(self):
+        tmp_path = f'{self._index_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self._index_path)
+            self._index_mtime = os.path.getmtime(self._index_path)
+            self._saved_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Failed to write cache index {self._index_path}: {str(e)}")
+
+    def _entry(self, key, entry):
+        return dict(entry, key=key, path=os.path.join(self.directory, key, entry['filename']))
+
+    def _expired(self, entry, now):
+        ttl = entry.get('ttl', self.ttl)
+        return ttl is not None and now - entry['created_at'] > ttl
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _get(self, key):
+        """get() with the lock held"""
+        self._load()
+        entry = self._index.get(key)
+        now = time.time()
+        if entry is not None and self._expired(entry, now):
+            logger.info(f"Cache entry {key} expired")
+            self._remove(key)
+            self._save()
+            entry = None
+        elif entry is not None and not os.path.exists(os.path.join(self.directory, key, entry['filename'])):
+            # Removed behind the index's back (by hand, or by a process that crashed mid-write)
+            self._remove(key)
+            self._save()
+            entry = None
+        if entry is None:
+            self._counters['misses'] += 1
+            return None
+        entry['last_access'] = now
+        self._counters['hits'] += 1
+        if time.monotonic() - self._saved_at >= self.access_save_interval:
+            self._save()
+        return self._entry(key, entry)
+
+    def get(self, key):
+        """Return the entry (with its absolute 'path') if present and fresh, else None"""
+        with self._locked():
+            return self._get(key)
+
+    def checkout(self, key, directory):
+        """
+        get(), with the entry's file hard-linked (or copied) into directory
+        while the cache is locked, so a later eviction cannot delete it from
+        under the caller. The returned 'path' is that copy; the caller owns it.
+        """
+        with self._locked():
+            entry = self._get(key)
+            if entry is None:
+                return None
+            path = os.path.join(directory, entry['filename'])
+            try:
+                os.link(entry['path'], path)
+            except OSError:
+                # The directory is on another filesystem
+                shutil.copyfile(entry['path'], path)
+            return dict(entry, path=path)
+
+    def put(self, key, src_path, ttl=None, filename=None, **metadata):
+        """
+        Move src_path into the cache under key and return the new entry.
+        ttl overrides the cache default for this entry; pass float('inf') for
+        entries that never expire.
+        """
+        filename = filename or os.path.basename(src_path)
+        entry_dir = os.path.join(self.directory, key)
+        with self._locked():
+            self._load()
+            self._remove(key)
+            os.makedirs(entry_dir, exist_ok=True)
+            dest_path = os.path.join(entry_dir, filename)
+            shutil.move(src_path, dest_path)
+            now = time.time()
+            entry = {
+                'filename': filename,
+                'size': os.path.getsize(dest_path),
+                'etag': file_etag(dest_path),
+                'created_at': now,
+                'last_access': now,
+            }
+            if ttl is not None:
+                entry['ttl'] = None if ttl == float('inf') else ttl
+            entry.update(metadata)
+            self._index[key] = entry
+            self._counters['stores'] += 1
+            self._evict(protect=key)
+            self._save()
+            return self._entry(key, entry)
+
+    def invalidate(self, key):
+        with self._locked():
+            self._load()
+            self._remove(key)
+            self._save()
+
+    def _evict(self, protect=None):
+        """Drop expired entries, then least recently used ones until under max_bytes"""
+        now = time.time()
+        for key in [k for k, e in self._index.items() if k != protect and self._expired(e, now)]:
+            self._remove(key)
+            self._counters['evictions'] += 1
+        total = sum(entry['size'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if key == protect:
+                continue
+            total -= self._index[key]['size']
+            logger.info(f"Evicting cache entry {key}")
+            self._remove(key)
+            self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'entries': len(self._index),
+                'bytes': sum(entry['size'] for entry in self._index.values()),
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+            })
+        return stats
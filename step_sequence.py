@@ -0,0 +1,243 @@
+"""
+Visor flows as explicit step sequences with post-conditions and retries.
+
+A Step runs its action on the page and then checks its post-condition
+(a cheap DOM or map query). A step fails when the action raises or returns
+False, or when the post-condition does not hold afterwards; it is then
+retried in place after an exponential backoff, up to STEP_RETRIES times.
+
+Before a retry the sequence walks back to the last step whose
+post-condition still holds and resumes right after it, so a step whose
+preconditions were undone (a panel closed, the map gone) gets them back
+without restarting the browser or the flow. A step may also name an
+earlier step to resume from (retry_from) when re-running it alone cannot
+help, like waiting again for a print job that already failed.
+
+Retries and the seconds lost in failed attempts are counted per step on
+/stats and /metrics. Failures that a retry fixes leave no forensics
+bundle; the one that makes the sequence give up does. AsyncStepSequence runs the same kind of steps, with
+coroutine actions and checks, for the asyncio engine.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import forensics
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STEP_RETRIES = int(os.environ.get('STEP_RETRIES', 2))
+STEP_RETRY_BACKOFF = float(os.environ.get('STEP_RETRY_BACKOFF', 2))  # seconds before the first retry
+STEP_RETRY_MAX_BACKOFF = float(os.environ.get('STEP_RETRY_MAX_BACKOFF', 30))
+
+
+class StepFailed(Exception):
+    """Raised when a step still fails after its retries"""
+
+    def __init__(self, step, attempts):
+        super().__init__(f"Step '{step}' failed after {attempts} attempt(s)")
+        self.step = step
+        self.attempts = attempts
+
+
+class RetryStats:
+    """Thread-safe per-step record of attempts, retries and time lost to failures"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._steps = {}
+
+    def record(self, flow, step, seconds, ok, retried=False, exhausted=False):
+        with self._lock:
+            entry = self._steps.setdefault(f'{flow}.{step}', {
+                'attempts': 0, 'retries': 0, 'exhausted': 0, 'wasted_seconds': 0.0,
+            })
+            entry['attempts'] += 1
+            if not ok:
+                entry['wasted_seconds'] += seconds
+            if retried:
+                entry['retries'] += 1
+            if exhausted:
+                entry['exhausted'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._steps.items()}
+
+
+retry_stats = RetryStats()
+
+
+class Step:
+    """action(page), then check(page) must hold; check None means the action's result is trusted"""
+
+    def __init__(self, name, action, check=None, retries=STEP_RETRIES, retry_from=None, before=None, after=None):
+        self.name = name
+        self.action = action
+        self.check = check
+        self.retries = retries
+        self.retry_from = retry_from
+        self.before = before  # progress messages around the step
+        self.after = after
+
+
+def _no_progress(step):
+    pass
+
+
+class StepSequence:
+    """Runs steps in order, retrying failed ones from the last verified state"""
+
+    def __init__(self, flow, steps, backoff=STEP_RETRY_BACKOFF, max_backoff=STEP_RETRY_MAX_BACKOFF,
+                 stats=retry_stats):
+        self.flow = flow
+        self.steps = steps
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = stats
+
+    def _verified(self, step, page):
+        try:
+            return bool(step.check(page))
+        except Exception as e:
+            logger.warning(f"Post-condition of '{step.name}' could not be checked: {str(e)}")
+            return False
+
+    def _attempt(self, step, page):
+        try:
+            if step.action(page) is False:
+                return False
+        except Exception as e:
+            logger.error(f"Step '{step.name}' raised: {str(e)}")
+            return False
+        if step.check is not None and not self._verified(step, page):
+            logger.warning(f"Step '{step.name}' ran but its post-condition does not hold")
+            return False
+        return True
+
+    def _resume_index(self, index, page):
+        """Index to resume at after steps[index] failed"""
+        step = self.steps[index]
+        if step.retry_from is not None:
+            index = next(i for i, s in enumerate(self.steps) if s.name == step.retry_from)
+        # Steps without a check cannot be re-verified and are taken to still hold
+        while index > 0 and self.steps[index - 1].check is not None \
+                and not self._verified(self.steps[index - 1], page):
+            index -= 1
+        return index
+
+    def _failed(self, index, failures, started):
+        """Count a failure of steps[index]; returns the backoff, or raises StepFailed once out of retries"""
+        step = self.steps[index]
+        failures[step.name] = failures.get(step.name, 0) + 1
+        if failures[step.name] > step.retries:
+            self.stats.record(self.flow, step.name, time.monotonic() - started, False, exhausted=True)
+            raise StepFailed(step.name, failures[step.name])
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures[step.name] - 1))
+        # The backoff is browser time lost to the failure as well
+        self.stats.record(self.flow, step.name, time.monotonic() - started + delay, False, retried=True)
+        metrics.STEP_RETRIES.labels(self.flow, step.name).inc()
+        return delay
+
+    def _retrying(self, index, resume, failures, delay, progress):
+        step = self.steps[index]
+        logger.warning(f"Retrying step '{step.name}' ({failures[step.name]}/{step.retries}) in {delay:.0f}s, "
+                       f"resuming at '{self.steps[resume].name}'")
+        progress(f"Retrying {step.name} ({failures[step.name]}/{step.retries})")
+
+    def run(self, page, progress=None):
+        """Run every step on page; raises StepFailed once a step runs out of retries"""
+        try:
+            with forensics.deferred(page):
+                self._run(page, progress)
+        except StepFailed as e:
+            # Only now is the failure final, earlier ones may have been fixed by a retry
+            forensics.step_failed(page, self.flow, e.step, str(e))
+            raise
+
+    def _run(self, page, progress=None):
+        progress = progress or _no_progress
+        failures = {}
+        index = 0
+        while index < len(self.steps):
+            step = self.steps[index]
+            if step.before:
+                progress(step.before)
+            started = time.monotonic()
+            if self._attempt(step, page):
+                self.stats.record(self.flow, step.name, time.monotonic() - started, True)
+                if step.after:
+                    progress(step.after)
+                index += 1
+                continue
+
+            delay = self._failed(index, failures, started)
+            resume = self._resume_index(index, page)
+            self._retrying(index, resume, failures, delay, progress)
+            time.sleep(delay)
+            index = resume
+
+
+class AsyncStepSequence(StepSequence):
+    """StepSequence for async_playwright pages: actions and checks are coroutine functions"""
+
+    async def _verified(self, step, page):
+        try:
+            return bool(await step.check(page))
+        except Exception as e:
+            logger.warning(f"Post-condition of '{step.name}' could not be checked: {str(e)}")
+            return False
+
+    async def _attempt(self, step, page):
+        try:
+            if await step.action(page) is False:
+                return False
+        except Exception as e:
+            logger.error(f"Step '{step.name}' raised: {str(e)}")
+            return False
+        if step.check is not None and not await self._verified(step, page):
+            logger.warning(f"Step '{step.name}' ran but its post-condition does not hold")
+            return False
+        return True
+
+    async def _resume_index(self, index, page):
+        step = self.steps[index]
+        if step.retry_from is not None:
+            index = next(i for i, s in enumerate(self.steps) if s.name == step.retry_from)
+        while index > 0 and self.steps[index - 1].check is not None \
+                and not await self._verified(self.steps[index - 1], page):
+            index -= 1
+        return index
+
+    async def run(self, page, progress=None):
+        try:
+            with forensics.deferred(page):
+                await self._run(page, progress)
+        except StepFailed as e:
+            await forensics.step_failed_async(page, self.flow, e.step, str(e))
+            raise
+
+    async def _run(self, page, progress=None):
+        progress = progress or _no_progress
+        failures = {}
+        index = 0
+        while index < len(self.steps):
+            step = self.steps[index]
+            if step.before:
+                progress(step.before)
+            started = time.monotonic()
+            if await self._attempt(step, page):
+                self.stats.record(self.flow, step.name, time.monotonic() - started, True)
+                if step.after:
+                    progress(step.after)
+                index += 1
+                continue
+
+            delay = self._failed(index, failures, started)
+            resume = await self._resume_index(index, page)
+            self._retrying(index, resume, failures, delay, progress)
+            await asyncio.sleep(delay)
+            index = resume
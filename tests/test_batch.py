@@ -0,0 +1,82 @@
+"""Batch job bookkeeping for references printed by the direct engine."""
+import importlib.util
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('requests')
+pytest.importorskip('playwright')
+pytest.importorskip('prometheus_client')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeJob:
+    def __init__(self, **params):
+        self.params = params
+        self.steps = []
+
+    def report(self, step):
+        self.steps.append(step)
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('app')
+    os.environ.update({
+        'WARMUP': '0',
+        'RESULT_CACHE_DIR': str(workdir / 'cache'),
+        'PARCEL_INDEX_PATH': str(workdir / 'parcels.sqlite'),
+        'ASSET_CACHE_DIR': str(workdir / 'asset_cache'),
+        'FORENSICS_DIR': str(workdir / 'forensics'),
+    })
+    sys.path.insert(0, REPO_DIR)
+    spec = importlib.util.spec_from_file_location('pdf_app', os.path.join(REPO_DIR, 'pdf-inundaciones-ideib.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def direct_prints(app_module, tmp_path, monkeypatch):
+    printed = []
+
+    def get_flood_area_pdf_direct(referencia_catastral, progress=None):
+        path = tmp_path / f'direct_{referencia_catastral}.pdf'
+        path.write_bytes(b'%PDF-1.4 ' + referencia_catastral.encode())
+        printed.append(str(path))
+        return str(path)
+
+    def no_browser(*args, **kwargs):
+        raise AssertionError('the browser must not be used when every direct print succeeds')
+
+    monkeypatch.setattr(app_module.print_service, 'get_flood_area_pdf_direct', get_flood_area_pdf_direct)
+    monkeypatch.setattr(app_module.browser_pool, 'run', no_browser)
+    return printed
+
+
+@pytest.mark.parametrize('cache_mode, referencias', [
+    ('refresh', ['1111111AA1111A0001AA', '2222222BB2222B0001BB']),
+    ('bypass', ['3333333CC3333C0001CC', '4444444DD4444D0001DD']),
+])
+def test_batch_with_every_direct_print_succeeding(app_module, direct_prints, cache_mode, referencias):
+    result = app_module.flood_pdf_batch_job(FakeJob(referencias=referencias, cache=cache_mode, engine='direct'))
+    try:
+        assert result['headers'] == {'X-Batch-Succeeded': '2', 'X-Batch-Failed': '0'}
+        with zipfile.ZipFile(result['path']) as zipf:
+            manifest = json.loads(zipf.read('manifest.json'))
+            assert [item['status'] for item in manifest] == ['ok', 'ok']
+            assert [item['cache'] for item in manifest] == [cache_mode.upper()] * 2
+            for referencia_catastral in referencias:
+                assert zipf.read(f'flood_area_{referencia_catastral}.pdf').endswith(referencia_catastral.encode())
+        # Cached prints were moved into the cache, bypassed ones deleted: nothing is left behind
+        assert not any(os.path.exists(path) for path in direct_prints)
+        for referencia_catastral in referencias:
+            entry = app_module.pdf_cache.get(app_module.pdf_cache_key(referencia_catastral, 'direct'))
+            assert (entry is not None) == (cache_mode != 'bypass')
+    finally:
+        os.remove(result['path'])
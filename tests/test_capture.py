@@ -0,0 +1,57 @@
+"""Spotting a frame identical to the previous one."""
+import os
+import sys
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from capture import DuplicateFilter  # noqa: E402
+
+
+def gradient(reverse=False):
+    """A 64x64 grey ramp, brightening to the right (or left), so neighbouring pixels differ"""
+    image = Image.new('RGB', (64, 64))
+    image.putdata([((63 - x if reverse else x) * 4,) * 3 for y in range(64) for x in range(64)])
+    return image
+
+
+def saved(image, tmp_path, name, **kwargs):
+    path = str(tmp_path / name)
+    image.save(path, **kwargs)
+    return path
+
+
+def test_same_pixels_in_another_encoding_are_a_duplicate(tmp_path):
+    image = gradient()
+    frames = DuplicateFilter(method='pixels')
+    assert frames.check('2001', saved(image, tmp_path, '2001.png')) is None
+    assert frames.check('2002', saved(image, tmp_path, '2002.png', optimize=True, compress_level=9)) == '2001'
+    assert frames.check('2003', saved(gradient(reverse=True), tmp_path, '2003.png')) is None
+
+
+def test_near_identical_frames_only_match_with_dhash(tmp_path):
+    image = gradient()
+    first = saved(image, tmp_path, '2001.png')
+    image.putpixel((10, 10), (255, 0, 0))
+    second = saved(image, tmp_path, '2002.png')
+
+    exact = DuplicateFilter()
+    exact.check('2001', first)
+    assert exact.check('2002', second) is None
+
+    perceptual = DuplicateFilter(method='dhash', distance=2)
+    perceptual.check('2001', first)
+    assert perceptual.check('2002', second) == '2001'
+    assert perceptual.check('2003', saved(gradient(reverse=True), tmp_path, '2003.png')) is None
+
+
+def test_unreadable_frame_is_not_a_duplicate(tmp_path):
+    broken = tmp_path / 'broken.png'
+    broken.write_bytes(b'not a png')
+    frames = DuplicateFilter()
+    assert frames.check('2001', str(broken)) is None
+    assert frames.check('2002', str(broken)) is None
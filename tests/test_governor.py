@@ -0,0 +1,108 @@
+"""Admission control and browser recycling of the memory governor."""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('prometheus_client')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import governor as governor_module  # noqa: E402
+import metrics  # noqa: E402
+from governor import MB, MemoryGovernor, Overloaded  # noqa: E402
+
+
+class FakePool:
+    def __init__(self, alive):
+        self.alive = alive
+
+    def stats(self):
+        return {'alive': self.alive}
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(governor_module, 'GOVERNOR_POLL_SECONDS', 0.01)
+
+
+def make_governor(used_mb, enabled=True, settle_seconds=10):
+    """A governor on a 1000 MB machine whose usage() reads used_mb[0]"""
+    governor = MemoryGovernor(enabled=enabled, limit_mb=1000, job_mb=200, reject_mb=900,
+                              recycle_mb=500, settle_seconds=settle_seconds)
+    governor.usage = lambda: (used_mb[0] * MB, (1000 - used_mb[0]) * MB)
+    return governor
+
+
+def test_submission_is_rejected_past_the_threshold():
+    used = [950]
+    governor = make_governor(used)
+    with pytest.raises(Overloaded):
+        governor.check_submission()
+    used[0] = 500
+    governor.check_submission()
+    assert governor.stats()['rejected'] == 1
+
+
+def test_job_with_headroom_is_admitted_at_once():
+    steps = []
+    governor = make_governor([300])
+    governor.wait_for_headroom(lambda: 1, steps.append)
+    assert steps == []
+    assert governor.stats()['admitted'] == 1
+    assert governor.stats()['delayed'] == 0
+
+
+def test_job_waits_until_memory_is_freed():
+    used = [900]
+    steps = []
+
+    def running():
+        # The running job finishes after a few polls
+        running.calls += 1
+        if running.calls == 3:
+            used[0] = 300
+        return 1
+    running.calls = 0
+
+    governor = make_governor(used)
+    governor.wait_for_headroom(running, steps.append)
+    assert steps == ['Waiting for memory']
+    stats = governor.stats()
+    assert (stats['admitted'], stats['delayed'], stats['forced']) == (1, 1, 0)
+
+
+def test_job_is_forced_through_when_nothing_runs():
+    governor = make_governor([900])
+    governor.wait_for_headroom(lambda: 0)
+    stats = governor.stats()
+    assert (stats['admitted'], stats['forced']) == (1, 1)
+
+
+def test_admitted_job_holds_its_share_until_it_settles():
+    # Room for one job: the second waits for the first one's reservation to lapse
+    governor = make_governor([700], settle_seconds=0.1)
+    governor.wait_for_headroom(lambda: 1)
+    assert governor.stats()['reserved_bytes'] == 200 * MB
+    steps = []
+    governor.wait_for_headroom(lambda: 1, steps.append)
+    assert steps == ['Waiting for memory']
+    assert governor.stats()['admitted'] == 2
+
+
+def test_disabled_governor_lets_everything_through():
+    governor = make_governor([1000], enabled=False)
+    governor.check_submission()
+    governor.wait_for_headroom(lambda: 5)
+    assert governor.should_recycle_browser(FakePool(1)) is False
+    assert governor.stats()['admitted'] == 0
+
+
+def test_browser_is_recycled_past_its_share(monkeypatch):
+    monkeypatch.setattr(metrics, 'browser_memory', lambda: {'rss_bytes': 800 * MB})
+    governor = make_governor([800])
+    assert governor.should_recycle_browser(FakePool(1)) is True
+    assert governor.should_recycle_browser(FakePool(2)) is False
+    assert governor.stats()['recycles'] == 1
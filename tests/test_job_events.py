@@ -0,0 +1,94 @@
+"""Server-Sent Events of a job and resuming them after Last-Event-ID."""
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+flask = pytest.importorskip('flask')
+pytest.importorskip('prometheus_client')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from jobs import Job, job_events, job_events_response  # noqa: E402
+
+
+def parse(events):
+    """(id, event, data) of each SSE message, skipping keep-alives"""
+    parsed = []
+    for message in events:
+        if message.startswith(':'):
+            continue
+        fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+        parsed.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+    return parsed
+
+
+def finished_job(steps, status='done'):
+    job = Job('test', {})
+    for step in steps:
+        job.report(step)
+    job.status = status
+    job.done.set()
+    return job
+
+
+def test_stream_sends_steps_status_and_the_final_job():
+    events = parse(job_events(finished_job(['Locating parcel', 'Printing map'])))
+    assert [(event_id, name) for event_id, name, _ in events] == [
+        ('1', 'step'), ('2', 'step'), (None, 'status'), (None, 'done')]
+    assert events[0][2]['step'] == 'Locating parcel'
+    assert events[3][2]['result_url'].endswith('/result')
+
+
+def test_resume_skips_the_steps_already_sent():
+    events = parse(job_events(finished_job(['a', 'b', 'c']), first_step=2))
+    steps = [(event_id, data['step']) for event_id, name, data in events if name == 'step']
+    assert steps == [('3', 'c')]
+
+
+@pytest.mark.parametrize('first_step', [-1, 99])
+def test_out_of_range_event_id_is_clamped(first_step):
+    events = parse(job_events(finished_job(['a', 'b']), first_step=first_step))
+    steps = [data['step'] for _, name, data in events if name == 'step']
+    assert steps == (['a', 'b'] if first_step < 0 else [])
+    assert events[-1][1] == 'done'
+
+
+def test_failed_job_ends_with_failed():
+    job = finished_job(['a'], status='failed')
+    job.error = 'visor down'
+    events = parse(job_events(job))
+    assert events[-1][1] == 'failed'
+    assert events[-1][2]['error'] == 'visor down'
+
+
+def test_stream_follows_a_running_job():
+    job = Job('test', {})
+    job.status = 'running'
+
+    def work():
+        job.report('a')
+        job.report('b')
+        job.status = 'done'
+        job.done.set()
+        job.notify()
+
+    stream = job_events(job, keepalive=5)
+    assert parse([next(stream)]) == [(None, 'status', {'status': 'running'})]
+    threading.Thread(target=work).start()
+    events = parse(stream)
+    assert [data['step'] for _, name, data in events if name == 'step'] == ['a', 'b']
+    assert events[-1][1] == 'done'
+
+
+@pytest.mark.parametrize('header, expected', [('1', ['b']), ('junk', ['a', 'b'])])
+def test_response_resumes_after_last_event_id(header, expected):
+    app = flask.Flask(__name__)
+    with app.test_request_context(headers={'Last-Event-ID': header}):
+        response = job_events_response(finished_job(['a', 'b']))
+    events = parse(response.get_data(as_text=True).split('\n\n')[:-1])
+    assert [data['step'] for _, name, data in events if name == 'step'] == expected
+    assert response.mimetype == 'text/event-stream'
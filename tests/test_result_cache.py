@@ -0,0 +1,108 @@
+"""Keys, TTL, LRU eviction, checkouts and cross-process locking of the on-disk result cache."""
+import multiprocessing
+import os
+import sys
+import time
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from result_cache import ResultCache, normalise_reference  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(directory=str(tmp_path / 'cache'), ttl=60, max_bytes=100)
+
+
+def stored(cache, tmp_path, name, size=10, **kwargs):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return cache.put(cache.key(name), str(path), **kwargs)
+
+
+def test_key_normalises_the_reference(cache):
+    assert normalise_reference(' 07040a-049.00017 ') == '07040A04900017'
+    assert cache.key('07040a04900017', engine='browser') == cache.key('07040A-04900017', engine='browser')
+    assert cache.key('07040A04900017', engine='browser') != cache.key('07040A04900017', engine='direct')
+
+
+def test_put_moves_the_file_in_and_get_returns_it(cache, tmp_path):
+    entry = stored(cache, tmp_path, 'a.pdf')
+    assert not (tmp_path / 'a.pdf').exists()
+    hit = cache.get(cache.key('a.pdf'))
+    assert hit['path'] == entry['path'] and hit['etag'] == entry['etag']
+    assert cache.stats()['hits'] == 1
+
+
+def test_expired_entries_are_misses(cache, tmp_path, monkeypatch):
+    stored(cache, tmp_path, 'a.pdf')
+    stored(cache, tmp_path, 'b.pdf', ttl=float('inf'))
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert cache.get(cache.key('a.pdf')) is None
+    assert cache.get(cache.key('b.pdf')) is not None
+
+
+def test_least_recently_used_entries_are_evicted(cache, tmp_path, monkeypatch):
+    now = [time.time()]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    for name in ('a', 'b', 'c'):
+        stored(cache, tmp_path, name, size=40)
+        now[0] += 1
+    # c took the cache past its size, a was the oldest
+    assert cache.get(cache.key('a')) is None
+    # Reading b makes c the least recently used
+    assert cache.get(cache.key('b')) is not None
+    now[0] += 1
+    stored(cache, tmp_path, 'd', size=40)
+    assert cache.get(cache.key('c')) is None
+    assert cache.get(cache.key('b')) is not None
+    assert cache.stats()['bytes'] <= 100
+
+
+def test_index_survives_a_restart(cache, tmp_path):
+    stored(cache, tmp_path, 'a.pdf')
+    reopened = ResultCache(directory=cache.directory, ttl=60, max_bytes=100)
+    assert reopened.get(reopened.key('a.pdf')) is not None
+
+
+def test_missing_file_is_a_miss(cache, tmp_path):
+    entry = stored(cache, tmp_path, 'a.pdf')
+    os.remove(entry['path'])
+    assert cache.get(cache.key('a.pdf')) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_checkout_survives_eviction(cache, tmp_path):
+    stored(cache, tmp_path, 'a.pdf', size=60)
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+    checked_out = cache.checkout(cache.key('a.pdf'), str(workdir))
+    stored(cache, tmp_path, 'b.pdf', size=60)
+    assert cache.get(cache.key('a.pdf')) is None
+    with open(checked_out['path'], 'rb') as f:
+        assert f.read() == b'x' * 60
+
+
+def _store_many(directory, prefix, count):
+    cache = ResultCache(directory=directory, ttl=60, max_bytes=10 ** 9)
+    for i in range(count):
+        path = os.path.join(directory, f'{prefix}{i}.tmp')
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        cache.put(cache.key(f'{prefix}{i}'), path)
+
+
+def test_processes_sharing_the_directory_keep_each_others_entries(tmp_path):
+    directory = str(tmp_path / 'cache')
+    os.makedirs(directory)
+    workers = [multiprocessing.Process(target=_store_many, args=(directory, prefix, 20)) for prefix in 'abcd']
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert ResultCache(directory=directory, ttl=60, max_bytes=10 ** 9).stats()['entries'] == 80
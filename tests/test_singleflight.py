@@ -0,0 +1,81 @@
+"""Concurrent calls for one key share a single run."""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from singleflight import SingleFlight  # noqa: E402
+
+
+def run_concurrently(flight, key, fn, callers):
+    """Start callers threads calling flight.do(key, fn) while fn is held; returns their results"""
+    results = [None] * callers
+
+    def call(index):
+        try:
+            results[index] = flight.do(key, fn)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_concurrent_callers_share_one_execution():
+    flight = SingleFlight('test')
+    release = threading.Event()
+    runs = []
+
+    def render():
+        runs.append(1)
+        release.wait(5)
+        return 'pdf'
+
+    threads, results = run_concurrently(flight, 'ref', render, 4)
+    wait_for(lambda: flight.stats()['waiting'] == 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert runs == [1]
+    assert results == ['pdf'] * 4
+    assert flight.stats() == {'executions': 1, 'coalesced': 3, 'in_flight': 0, 'waiting': 0}
+
+
+def test_callers_share_the_exception():
+    flight = SingleFlight('test')
+    release = threading.Event()
+
+    def render():
+        release.wait(5)
+        raise RuntimeError('visor down')
+
+    threads, results = run_concurrently(flight, 'ref', render, 3)
+    wait_for(lambda: flight.stats()['waiting'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_keys_run_independently_and_finished_runs_are_forgotten():
+    flight = SingleFlight('test')
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    assert flight.do('a', lambda: 3) == 3
+    with pytest.raises(ValueError):
+        flight.do('a', int, 'not a number')
+    assert flight.stats()['executions'] == 4
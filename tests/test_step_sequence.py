@@ -0,0 +1,128 @@
+"""Retries, resume points and forensics of the checked step sequences."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('prometheus_client')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import forensics  # noqa: E402
+from step_sequence import AsyncStepSequence, RetryStats, Step, StepFailed, StepSequence  # noqa: E402
+
+
+class FakePage:
+    """Just enough state for the steps below: which panels are open"""
+
+    def __init__(self):
+        self.state = set()
+        self.calls = []
+
+
+def opens(name, fail_times=0):
+    """Action adding name to the page state, returning False the first fail_times calls"""
+    failures = [fail_times]
+
+    def action(page):
+        page.calls.append(name)
+        if failures[0]:
+            failures[0] -= 1
+            return False
+        page.state.add(name)
+    return action
+
+
+def is_open(name):
+    return lambda page: name in page.state
+
+
+def sequence(steps, stats=None):
+    return StepSequence('test', steps, backoff=0, stats=stats or RetryStats())
+
+
+def test_runs_every_step_in_order():
+    page = FakePage()
+    sequence([Step('a', opens('a'), check=is_open('a')), Step('b', opens('b'), check=is_open('b'))]).run(page)
+    assert page.calls == ['a', 'b']
+
+
+def test_failed_step_is_retried_in_place():
+    page = FakePage()
+    stats = RetryStats()
+    sequence([Step('a', opens('a'), check=is_open('a')), Step('b', opens('b', fail_times=1))], stats).run(page)
+    assert page.calls == ['a', 'b', 'b']
+    assert stats.snapshot()['test.b']['retries'] == 1
+
+
+def test_retry_resumes_after_the_last_step_that_still_holds():
+    page = FakePage()
+
+    def closes_a(page):
+        # Fails and undoes the previous step, like a panel closing under it
+        page.calls.append('b')
+        if page.calls.count('b') == 1:
+            page.state.discard('a')
+            return False
+
+    sequence([Step('a', opens('a'), check=is_open('a')), Step('b', closes_a)]).run(page)
+    assert page.calls == ['a', 'b', 'a', 'b']
+
+
+def test_retry_from_resumes_at_the_named_step():
+    page = FakePage()
+    sequence([
+        Step('submit', opens('submit')),
+        Step('wait', opens('wait', fail_times=1), retry_from='submit'),
+    ]).run(page)
+    assert page.calls == ['submit', 'wait', 'submit', 'wait']
+
+
+def test_post_condition_must_hold():
+    page = FakePage()
+    with pytest.raises(StepFailed) as failure:
+        sequence([Step('a', lambda page: page.calls.append('a'), check=is_open('a'), retries=1)]).run(page)
+    assert failure.value.step == 'a'
+    assert failure.value.attempts == 2
+
+
+def test_exhausted_step_is_counted():
+    stats = RetryStats()
+    with pytest.raises(StepFailed):
+        sequence([Step('a', opens('a', fail_times=5), retries=2)], stats).run(FakePage())
+    assert stats.snapshot()['test.a'] == {'attempts': 3, 'retries': 2, 'exhausted': 1,
+                                          'wasted_seconds': pytest.approx(0, abs=0.5)}
+
+
+def test_forensics_wait_for_the_sequence_to_give_up(monkeypatch):
+    bundles = []
+    monkeypatch.setattr(forensics, 'step_failed', lambda page, flow, step, error=None: bundles.append(step))
+    sequence([Step('a', opens('a', fail_times=1))]).run(FakePage())
+    assert bundles == []
+    with pytest.raises(StepFailed):
+        sequence([Step('a', opens('a', fail_times=5), retries=1)]).run(FakePage())
+    assert bundles == ['a']
+
+
+def test_async_sequence_retries_like_the_sync_one():
+    page = FakePage()
+
+    def async_step(action):
+        async def step(page):
+            return action(page)
+        return step
+
+    def async_check(check):
+        async def verify(page):
+            return check(page)
+        return verify
+
+    steps = [
+        Step('a', async_step(opens('a')), check=async_check(is_open('a'))),
+        Step('b', async_step(opens('b', fail_times=1)), retry_from='a'),
+    ]
+    asyncio.run(AsyncStepSequence('test', steps, backoff=0, stats=RetryStats()).run(page))
+    assert page.calls == ['a', 'b', 'a', 'b']
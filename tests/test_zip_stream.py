@@ -0,0 +1,60 @@
+"""ZIP archives streamed while their entries are still being added."""
+import io
+import os
+import sys
+import threading
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from zip_stream import ZipStream  # noqa: E402
+
+
+def test_stream_is_a_valid_zip(tmp_path):
+    photo = tmp_path / 'foto_2001.png'
+    photo.write_bytes(os.urandom(50000))
+    stream = ZipStream()
+    stream.add_file(str(photo), 'foto_2001.png')
+    stream.add_bytes('manifest.json', '[]')
+    stream.close()
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(stream)))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['foto_2001.png', 'manifest.json']
+    assert archive.read('foto_2001.png') == photo.read_bytes()
+
+
+def test_entries_are_sent_as_they_are_added(tmp_path):
+    stream = ZipStream()
+    chunks = iter(stream)
+    stream.add_bytes('first.txt', 'one')
+    first = next(chunks)
+    assert b'first.txt' in first
+    stream.add_bytes('second.txt', 'two')
+    stream.close()
+    archive = zipfile.ZipFile(io.BytesIO(first + b''.join(chunks)))
+    assert archive.read('second.txt') == b'two'
+
+
+def test_files_can_go_once_added(tmp_path):
+    photo = tmp_path / 'foto.png'
+    photo.write_bytes(b'png')
+    stream = ZipStream()
+    stream.add_file(str(photo), 'foto.png')
+    photo.unlink()
+    stream.close()
+    assert zipfile.ZipFile(io.BytesIO(b''.join(stream))).read('foto.png') == b'png'
+
+
+def test_wait_started():
+    stream = ZipStream()
+    assert stream.wait_started(timeout=0.01) is False
+    assert not stream.closed
+    threading.Timer(0.05, stream.add_bytes, args=('a.txt', 'a')).start()
+    assert stream.wait_started(timeout=5) is True
+
+    empty = ZipStream()
+    empty.close()
+    assert empty.wait_started(timeout=5) is False
+    assert empty.closed
+    assert zipfile.ZipFile(io.BytesIO(b''.join(empty))).namelist() == []
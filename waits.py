@@ -0,0 +1,164 @@
+"""
+Condition-based waits for the IDEIB visor flows.
+
+Every wait blocks on something observable (a DOM state, a network response,
+the map finishing its update) instead of a fixed sleep, gives up after a
+timeout, and records how long it actually took next to the sleep it replaced
+so the saving can be seen on /stats.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WAIT_TIMEOUT = float(os.environ.get('WAIT_TIMEOUT', 30))  # seconds
+
+# Counts the esri map's update-end events. _viewerMap is the global the
+# Web AppBuilder map manager sets once the map is created.
+MAP_HOOK_SCRIPT = """
+(() => {
+    window.__ideibMapUpdates = 0;
+    const hook = () => {
+        const map = window._viewerMap;
+        if (!map || !map.on) { setTimeout(hook, 250); return; }
+        map.on('update-end', () => { window.__ideibMapUpdates += 1; });
+        window.__ideibMapHooked = true;
+    };
+    hook();
+})();
+"""
+
+MAP_UPDATED_SCRIPT = """
+(before) => (window.__ideibMapUpdates || 0) > before
+    && !!window._viewerMap && !window._viewerMap.updating
+"""
+
+
+class WaitStats:
+    """Thread-safe record of how long each named wait took"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits = {}
+
+    def record(self, name, seconds, ok, legacy_sleep):
+        with self._lock:
+            entry = self._waits.setdefault(name, {
+                'count': 0, 'timeouts': 0, 'total_seconds': 0.0,
+                'max_seconds': 0.0, 'legacy_sleep_seconds': legacy_sleep,
+            })
+            entry['count'] += 1
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            if not ok:
+                entry['timeouts'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, entry in self._waits.items():
+                avg = entry['total_seconds'] / entry['count']
+                result[name] = dict(entry, avg_seconds=avg,
+                                    avg_saved_seconds=entry['legacy_sleep_seconds'] - avg)
+            return result
+
+
+wait_stats = WaitStats()
+
+
+def _timed_wait(name, legacy_sleep, wait):
+    """Run wait(), record its duration and return False instead of raising on timeout"""
+    started = time.monotonic()
+    ok = True
+    try:
+        wait()
+    except Exception as e:
+        ok = False
+        logger.warning(f"Wait '{name}' gave up after {time.monotonic() - started:.1f}s: {str(e)}")
+    elapsed = time.monotonic() - started
+    wait_stats.record(name, elapsed, ok, legacy_sleep)
+    logger.info(f"Wait '{name}' took {elapsed:.2f}s (was a fixed {legacy_sleep}s sleep)")
+    return ok
+
+
+def _ms(timeout):
+    return (WAIT_TIMEOUT if timeout is None else timeout) * 1000
+
+
+def install_map_hooks(page):
+    """Register the update-end counter; must be called before page.goto"""
+    page.add_init_script(MAP_HOOK_SCRIPT)
+
+
+def wait_for_visible(page, selector, name, timeout=None, legacy_sleep=0, nth=0):
+    """Wait until the nth element matching the selector is visible"""
+    return _timed_wait(name, legacy_sleep, lambda: page.locator(selector).nth(nth).wait_for(
+        state="visible", timeout=_ms(timeout)))
+
+
+def wait_for_hidden(page, selector, name, timeout=None, legacy_sleep=0):
+    """Wait until the selector is hidden or detached"""
+    return _timed_wait(name, legacy_sleep, lambda: page.locator(selector).first.wait_for(
+        state="hidden", timeout=_ms(timeout)))
+
+
+def wait_for_function(page, expression, name, arg=None, timeout=None, legacy_sleep=0):
+    """Wait until a JS predicate evaluated in the page returns truthy"""
+    return _timed_wait(name, legacy_sleep, lambda: page.wait_for_function(
+        expression, arg=arg, timeout=_ms(timeout)))
+
+
+def wait_for_response(page, url_pattern, action, name, timeout=None, legacy_sleep=0):
+    """Run action() and wait for a response whose URL matches url_pattern"""
+    pattern = re.compile(url_pattern, re.IGNORECASE)
+
+    def wait():
+        with page.expect_response(lambda response: bool(pattern.search(response.url)),
+                                  timeout=_ms(timeout)):
+            action()
+    return _timed_wait(name, legacy_sleep, wait)
+
+
+def wait_for_network_idle(page, name, timeout=None, legacy_sleep=0):
+    """Wait until no requests (e.g. map tiles) have been in flight for 500 ms"""
+    return _timed_wait(name, legacy_sleep, lambda: page.wait_for_load_state(
+        "networkidle", timeout=_ms(timeout)))
+
+
+def map_update_count(page):
+    """Number of update-end events seen so far, or None if the map is not hooked"""
+    try:
+        return page.evaluate("() => window.__ideibMapHooked ? window.__ideibMapUpdates : null")
+    except Exception:
+        return None
+
+
+def start_map_update(page, action):
+    """
+    Run action() without waiting for the map; returns the update count to
+    hand to finish_map_update. Lets several pages update at the same time.
+    """
+    before = map_update_count(page)
+    action()
+    return before
+
+
+def finish_map_update(page, before, name, timeout=None, legacy_sleep=0):
+    """Wait for the update started by start_map_update"""
+    if before is None:
+        return wait_for_network_idle(page, name, timeout=timeout, legacy_sleep=legacy_sleep)
+    return wait_for_function(page, MAP_UPDATED_SCRIPT, name, arg=before,
+                             timeout=timeout, legacy_sleep=legacy_sleep)
+
+
+def wait_for_map_update(page, action, name, timeout=None, legacy_sleep=0):
+    """
+    Run action() and wait for the map to fire update-end with no update in
+    progress, i.e. every tile for the new extent or layer has been drawn.
+    Falls back to network idle if the map could not be hooked.
+    """
+    before = start_map_update(page, action)
+    return finish_map_update(page, before, name, timeout=timeout, legacy_sleep=legacy_sleep)
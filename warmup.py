@@ -0,0 +1,179 @@
+"""
+Boot-time warmup and health endpoints.
+
+Fly stops idle machines (min_machines_running = 0), so the first request
+after a pause would otherwise pay for the Playwright driver, the Chromium
+launch and a cold visor load. Right after the app is imported, a
+background thread runs the app's warmup phases in order: launch the browser,
+then optionally (WARMUP_PRELOAD) bring a visor page up so the asset cache
+and the pool's standby page are warm. Each phase is timed, and retried
+with an exponential backoff (WARMUP_RETRIES times) when it fails.
+
+/healthz answers 200 as soon as the app serves requests (liveness);
+/readyz answers 200 once the warmup has finished and 503 before, with the
+phase timings either way. If the warmup gives up, the first successful job
+marks the app ready: requests evidently work, they just started cold. The seconds from process start to the first
+successful result of each job kind are recorded too, so time-to-first-PDF
+after a cold start can be tracked in /stats and /metrics.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+WARMUP = os.environ.get('WARMUP', '1') != '0'
+WARMUP_PRELOAD = os.environ.get('WARMUP_PRELOAD', '1') != '0'
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', 180))
+WARMUP_RETRIES = int(os.environ.get('WARMUP_RETRIES', 5))
+WARMUP_RETRY_BACKOFF = float(os.environ.get('WARMUP_RETRY_BACKOFF', 5))  # seconds before the first retry
+WARMUP_RETRY_MAX_BACKOFF = 60
+WARMUP_POLL_SECONDS = 0.2
+
+
+def process_started_at():
+    """Wall-clock time the process started, from /proc; now where it cannot be read"""
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, the fields after it do not
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+def wait_until(condition, timeout=WARMUP_TIMEOUT):
+    """Poll condition() until it is true; raises TimeoutError after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Not ready after {timeout:.0f}s")
+        time.sleep(WARMUP_POLL_SECONDS)
+
+
+class Warmup:
+    """Runs the startup phases in the background and tracks readiness"""
+
+    def __init__(self, enabled=WARMUP, retries=WARMUP_RETRIES, backoff=WARMUP_RETRY_BACKOFF):
+        self.enabled = enabled
+        self.retries = retries
+        self.backoff = backoff
+        self.process_started_at = process_started_at()
+        self.state = 'starting'
+        self.error = None
+        self.phases = {}
+        self.first_results = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, phases):
+        """Run [(name, fn), ...] in order on a background thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.phases['import'] = time.time() - self.process_started_at
+            if not self.enabled:
+                self.state = 'ready'
+                return
+            self.state = 'warming'
+            self._thread = threading.Thread(target=self._run, args=(phases,), name='warmup', daemon=True)
+            self._thread.start()
+
+    def _run_phase(self, name, fn):
+        """Run fn, retrying after a growing delay; returns whether it succeeded"""
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                fn()
+            except Exception as e:
+                with self._lock:
+                    self.error = f"{name}: {str(e)}"
+                if attempt == self.retries:
+                    logger.error(f"Warmup phase '{name}' failed after {time.monotonic() - started:.1f}s: {str(e)}")
+                    return False
+                delay = min(WARMUP_RETRY_MAX_BACKOFF, self.backoff * 2 ** attempt)
+                logger.warning(f"Warmup phase '{name}' failed ({attempt + 1}/{self.retries + 1}), "
+                               f"retrying in {delay:.0f}s: {str(e)}")
+                time.sleep(delay)
+                continue
+            with self._lock:
+                self.phases[name] = time.monotonic() - started
+                self.error = None
+            logger.info(f"Warmup phase '{name}' took {self.phases[name]:.1f}s")
+            return True
+
+    def _run(self, phases):
+        for name, fn in phases:
+            if not self._run_phase(name, fn):
+                # Requests still work, they just pay for whatever did not warm up
+                with self._lock:
+                    if self.state != 'ready':
+                        self.state = 'failed'
+                return
+        self._mark_ready()
+
+    def _mark_ready(self):
+        with self._lock:
+            if self.state == 'ready':
+                return
+            self.state = 'ready'
+            self.phases['boot_to_ready'] = time.time() - self.process_started_at
+        logger.info(f"Ready {self.phases['boot_to_ready']:.1f}s after process start")
+
+    def ready(self):
+        return self.state == 'ready'
+
+    def record_first_result(self, kind, handler):
+        """Wrap a job handler to record the seconds from process start to its first success"""
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            result = handler(*args, **kwargs)
+            with self._lock:
+                if kind not in self.first_results:
+                    self.first_results[kind] = time.time() - self.process_started_at
+                    logger.info(f"First {kind} result {self.first_results[kind]:.1f}s after process start")
+                failed = self.state == 'failed'
+            if failed:
+                logger.info("Warmup had failed but a job succeeded, marking the app ready")
+                self._mark_ready()
+            return result
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'state': self.state,
+                'ready': self.state == 'ready',
+                'error': self.error,
+                'uptime_seconds': time.time() - self.process_started_at,
+                'phase_seconds': dict(self.phases),
+                'first_result_seconds': dict(self.first_results),
+            }
+
+    def gauges(self):
+        """stats() flattened into numbers for /metrics"""
+        stats = self.stats()
+        values = {'ready': int(stats['ready']), 'uptime_seconds': stats['uptime_seconds']}
+        values.update({f'{name}_seconds': seconds for name, seconds in stats['phase_seconds'].items()})
+        values.update({f'first_{kind}_seconds': seconds for kind, seconds in stats['first_result_seconds'].items()})
+        return values
+
+
+def register_health_routes(app, warmup):
+    """Add /healthz and /readyz to a Flask app"""
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        stats = warmup.stats()
+        return jsonify(stats), 200 if stats['ready'] else 503
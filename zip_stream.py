@@ -0,0 +1,85 @@
+"""
+ZIP archives streamed to the client while their entries are still being
+produced.
+
+A worker thread adds files as they become available and the response
+iterates the stream: each entry is compressed into memory and sent as soon
+as it is added, with no temporary file. zipfile writes data descriptors
+when its output cannot seek, so no entry has to be rewritten afterwards.
+Files are opened when they are added, so the producer may delete them
+(or a cache evict them) before the response gets to them.
+"""
+import queue
+import shutil
+import threading
+import zipfile
+
+
+class _Sink:
+    """Unseekable file object collecting what ZipFile writes until it is taken"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """Thread-safe: producers call add_file/add_bytes and close, the response iterates"""
+
+    def __init__(self, compression=zipfile.ZIP_DEFLATED):
+        self.compression = compression
+        self.entries = 0
+        self.closed = False
+        self._queue = queue.Queue()
+        self._started = threading.Event()
+
+    def add_file(self, path, arcname):
+        info = zipfile.ZipInfo.from_file(path, arcname)
+        info.compress_type = self.compression
+        self._put(('file', open(path, 'rb'), info))
+
+    def add_bytes(self, arcname, data):
+        self._put(('bytes', data, arcname))
+
+    def _put(self, item):
+        self.entries += 1
+        self._queue.put(item)
+        self._started.set()
+
+    def close(self):
+        """No more entries; the central directory is written and the stream ends"""
+        self.closed = True
+        self._queue.put(None)
+        self._started.set()
+
+    def wait_started(self, timeout=None):
+        """Block until the first entry or close(); True if there is something to send"""
+        self._started.wait(timeout)
+        return self.entries > 0
+
+    def __iter__(self):
+        sink = _Sink()
+        with zipfile.ZipFile(sink, 'w', self.compression) as zipf:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                kind, source, arcname = item
+                if kind == 'file':
+                    with source, zipf.open(arcname, 'w') as entry:
+                        shutil.copyfileobj(source, entry)
+                else:
+                    zipf.writestr(arcname, source)
+                yield sink.take()
+        yield sink.take()